@@ -0,0 +1,174 @@
+"""
+Non-blocking transport for the Braintree XML API on top of asyncio streams.
+
+Connections are kept alive and reused, and a semaphore bounds how many requests are in flight at once.
+"""
+import asyncio
+import gzip
+import ssl
+from base64 import b64encode
+
+import braintree
+from braintree.environment import Environment
+from braintree.exceptions.http.connection_error import ConnectionError as GatewayConnectionError
+from braintree.exceptions.http.timeout_error import ReadTimeoutError
+from braintree.util.http import Http
+from braintree.util.xml_util import XmlUtil
+
+DEFAULT_MAX_CONCURRENCY = 100
+# Requests that can be resent when the connection drops before their response, without risking acting twice
+IDEMPOTENT_VERBS = frozenset(('GET', 'HEAD', 'PUT', 'DELETE', 'OPTIONS'))
+
+
+class NoResponseError(ConnectionError):
+    """The connection failed before the first byte of the response arrived."""
+
+
+class AsyncHttp:
+    def __init__(self, config, max_concurrency=DEFAULT_MAX_CONCURRENCY):
+        self.config = config
+        self.environment = config.environment
+        self.max_concurrency = max_concurrency
+        self.connections_opened = 0
+        # Created in the running loop on first use, asyncio primitives bind to the loop current when they are created
+        self._semaphore = None
+        self._loop = None
+        self._idle_connections = []
+        self._ssl_context = self._get_ssl_context()
+        credentials = f'{config.public_key}:{config.private_key}'.encode('ascii')
+        self._headers = {
+            'Host': self.environment.server,
+            'Accept': 'application/xml',
+            'Authorization': 'Basic ' + b64encode(credentials).decode('ascii'),
+            'User-Agent': 'Braintree Python ' + braintree.version.Version,
+            'Accept-Encoding': 'gzip',
+            'X-ApiVersion': braintree.Configuration.api_version(),
+            'Content-Type': Http.ContentType.Xml,
+        }
+
+    def _get_ssl_context(self):
+        if not self.environment.is_ssl:
+            return None
+        if self.environment == Environment.Development:
+            context = ssl.create_default_context()
+            context.check_hostname = False
+            context.verify_mode = ssl.CERT_NONE
+            return context
+        return ssl.create_default_context(cafile=self.environment.ssl_certificate)
+
+    async def post(self, path, params=None):
+        return await self._make_request('POST', path, params)
+
+    async def delete(self, path):
+        return await self._make_request('DELETE', path)
+
+    async def get(self, path):
+        return await self._make_request('GET', path)
+
+    async def put(self, path, params=None):
+        return await self._make_request('PUT', path, params)
+
+    def _bind_loop(self):
+        """Create the semaphore for the running loop, dropping the connections of a previous loop."""
+        loop = asyncio.get_running_loop()
+        if loop is not self._loop:
+            self._semaphore = asyncio.Semaphore(self.max_concurrency)
+            self._loop = loop
+            self._idle_connections = []
+
+    async def _make_request(self, http_verb, path, params=None):
+        request_body = XmlUtil.xml_from_dict(params).encode('utf-8') if params else b''
+        self._bind_loop()
+        async with self._semaphore:
+            try:
+                status, response_body = await asyncio.wait_for(
+                    self._http_do(http_verb, self.config.base_merchant_path() + path, request_body), self.config.timeout
+                )
+            except asyncio.TimeoutError as err:
+                raise ReadTimeoutError(err)
+            except OSError as err:
+                raise GatewayConnectionError(err)
+
+        if Http.is_error_status(status):
+            Http.raise_exception_from_status(status)
+        if len(response_body.strip()) == 0:
+            return {}
+        return XmlUtil.dict_from_xml(response_body)
+
+    async def _http_do(self, http_verb, path, request_body):
+        headers = dict(self._headers, **{'Content-Length': str(len(request_body))})
+        request = f'{http_verb} {path} HTTP/1.1\r\n' + ''.join(f'{key}: {value}\r\n' for key, value in headers.items()) + '\r\n'
+        request = request.encode('ascii') + request_body
+
+        connection = self._idle_connection()
+        if connection is not None:
+            try:
+                return await self._exchange(*connection, request)
+            except NoResponseError:
+                # The server may have closed the pooled connection while idle, resend once on a fresh one unless it
+                # may have acted on the request
+                if http_verb not in IDEMPOTENT_VERBS:
+                    raise
+        reader, writer = await asyncio.open_connection(self.environment.server, self.environment.port, ssl=self._ssl_context)
+        self.connections_opened += 1
+        return await self._exchange(reader, writer, request)
+
+    def _idle_connection(self):
+        """A pooled connection, skipping those the server is known to have closed, or None."""
+        while self._idle_connections:
+            reader, writer = self._idle_connections.pop()
+            if not reader.at_eof() and not writer.is_closing():
+                return reader, writer
+            writer.close()
+        return None
+
+    async def _exchange(self, reader, writer, request):
+        try:
+            try:
+                writer.write(request)
+                await writer.drain()
+                # Read the first byte on its own to tell a connection dropped before the response from one dropped during it
+                status_line = await reader.readexactly(1)
+            except (asyncio.IncompleteReadError, OSError) as err:
+                raise NoResponseError(str(err)) from err
+            status_line += await reader.readuntil(b'\r\n')
+            status = int(status_line.split()[1])
+            headers = {}
+            while True:
+                line = await reader.readuntil(b'\r\n')
+                if line == b'\r\n':
+                    break
+                key, _, value = line.decode('latin-1').partition(':')
+                headers[key.strip().lower()] = value.strip()
+
+            if headers.get('transfer-encoding', '').lower() == 'chunked':
+                body = b''
+                while True:
+                    size = int((await reader.readuntil(b'\r\n')).split(b';')[0], 16)
+                    chunk = await reader.readexactly(size + 2)
+                    if size == 0:
+                        break
+                    body += chunk[:-2]
+            elif 'content-length' in headers:
+                body = await reader.readexactly(int(headers['content-length']))
+            else:
+                body = await reader.read()
+                headers['connection'] = 'close'
+        except BaseException:
+            writer.close()
+            raise
+
+        if headers.get('connection', '').lower() == 'close':
+            writer.close()
+        else:
+            self._idle_connections.append((reader, writer))
+        if headers.get('content-encoding') == 'gzip':
+            body = gzip.decompress(body)
+        return status, body.decode('utf-8')
+
+    async def close(self):
+        self._bind_loop()
+        connections, self._idle_connections = self._idle_connections, []
+        for _reader, writer in connections:
+            writer.close()
+            await writer.wait_closed()
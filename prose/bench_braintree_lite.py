@@ -0,0 +1,245 @@
+"""
+Client-side cost of BraintreeClient methods (request building, XML parsing, error handling and logging) against a
+FakeBraintreeGateway running in a child process, so its threads neither compete for the GIL nor show in the traced
+allocations.
+
+    python -m prose.bench_braintree_lite --calls 200 --latency 0.005 --output .bench/HEAD.json
+    python -m prose.bench_braintree_lite --output .bench/new.json --compare .bench/old.json
+
+Each benchmark reports its sequential throughput, p50/p99 latency, and the peak memory allocated during a call as
+traced by ``tracemalloc`` in a separate, untimed pass. Use ``--latency`` to see how the client overhead weighs
+against a realistic round trip.
+"""
+import argparse
+import json
+import logging
+import multiprocessing
+import os
+import platform
+import statistics
+import subprocess
+import time
+import tracemalloc
+from uuid import uuid4
+
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'prose.settings')
+
+import braintree  # noqa: E402
+import django  # noqa: E402
+
+django.setup()
+
+from prose.fake_gateway import PAYPAL_NONCE, PROCESSOR_DECLINED_NONCE, VALID_NONCE, FakeBraintreeGateway  # noqa: E402
+from prose.test_braintree_lite import (  # noqa: E402
+    CURRENCY_MERCHANT_ACCOUNT_MAP,
+    SEARCH_PAGE_SIZE,
+    BraintreeClient,
+    CustomerFactory,
+    PaymentClientError,
+)
+
+DEFAULT_CALLS = 200
+DEFAULT_ALLOCATION_CALLS = 20
+WARMUP_CALLS = 5
+
+
+def _serve(latency, connection):
+    fake_gateway = FakeBraintreeGateway(latency=latency).start()
+    connection.send(fake_gateway.environment.port)
+    # Serve until the parent is done
+    connection.recv()
+    fake_gateway.stop()
+
+
+def _customer_payload():
+    customer = CustomerFactory.build()
+    return {
+        'id': str(customer.pubkey),
+        'first_name': customer.first_name,
+        'last_name': customer.last_name,
+        'email': customer.username,
+        'phone': customer.phone,
+    }
+
+
+def _sale_options(customer_id, nonce=VALID_NONCE, amount='100'):
+    return {
+        'amount': amount,
+        'options': {'submit_for_settlement': True, 'store_in_vault_on_success': True},
+        'order_id': str(uuid4()),
+        'merchant_account_id': CURRENCY_MERCHANT_ACCOUNT_MAP.USD,
+        'customer_id': customer_id,
+        'payment_method_nonce': nonce,
+    }
+
+
+def _benchmarks(client, customer_id):
+    """``name -> (prepare(count) -> arguments, call(argument))``, arguments being prepared outside of the measures."""
+
+    def sales(count, nonce=VALID_NONCE, settle=False):
+        sale_ids = [client.create_payment_mode(None, _sale_options(customer_id, nonce)) for _ in range(count)]
+        for sale_id in sale_ids if settle else ():
+            client.gateway.testing.settle_transaction(sale_id)
+        return sale_ids
+
+    def customers(count):
+        return [client.create_customer(**_customer_payload()) for _ in range(count)]
+
+    def declined_sale(options):
+        try:
+            client.create_payment_mode(None, options)
+        except PaymentClientError:
+            pass
+
+    paypal_ids = sales(SEARCH_PAGE_SIZE, nonce=PAYPAL_NONCE)
+    fast_xml_client = BraintreeClient(gateway=client.gateway, fast_xml=True)
+    return {
+        'get_token': (lambda count: [customer_id] * count, client.get_token),
+        'create_customer': (
+            lambda count: [_customer_payload() for _ in range(count)],
+            lambda kwargs: client.create_customer(**kwargs),
+        ),
+        'retrieve_customer': (lambda count: [customer_id] * count, client.retrieve_customer),
+        'delete_customer': (customers, client.delete_customer),
+        'create_payment_mode': (
+            lambda count: [_sale_options(customer_id) for _ in range(count)],
+            lambda options: client.create_payment_mode(None, options),
+        ),
+        'create_payment_mode_declined': (
+            lambda count: [_sale_options(customer_id, PROCESSOR_DECLINED_NONCE) for _ in range(count)],
+            declined_sale,
+        ),
+        'refund_payment': (
+            lambda count: sales(count, settle=True),
+            lambda sale_id: client.refund_payment({'transaction_id': sale_id, 'refund_data': {'amount': '25.00'}}, None),
+        ),
+        'refund_payment_unsettled': (
+            sales,
+            lambda sale_id: client.refund_payment({'transaction_id': sale_id, 'refund_data': {'amount': '25.00'}}, None),
+        ),
+        'get_payment_source_info': (lambda count: paypal_ids[:1] * count, client.get_payment_source_info),
+        'get_payment_source_infos': (lambda count: [paypal_ids] * count, client.get_payment_source_infos),
+        'get_payment_source_infos_fast_xml': (lambda count: [paypal_ids] * count, fast_xml_client.get_payment_source_infos),
+        'iter_transactions': (
+            lambda count: [paypal_ids[:10]] * count,
+            lambda ids: list(client.iter_transactions(braintree.TransactionSearch.ids.in_list(ids))),
+        ),
+    }
+
+
+def _percentile(latencies, quantile):
+    return latencies[min(len(latencies) - 1, int(len(latencies) * quantile))]
+
+
+def _run(prepare, call, calls, allocation_calls):
+    arguments = prepare(WARMUP_CALLS + calls + allocation_calls)
+    for argument in arguments[:WARMUP_CALLS]:
+        call(argument)
+
+    latencies = []
+    started_at = time.perf_counter()
+    for argument in arguments[WARMUP_CALLS : WARMUP_CALLS + calls]:
+        call_started_at = time.perf_counter()
+        call(argument)
+        latencies.append(time.perf_counter() - call_started_at)
+    elapsed = time.perf_counter() - started_at
+
+    allocations = []
+    tracemalloc.start()
+    try:
+        for argument in arguments[WARMUP_CALLS + calls :]:
+            tracemalloc.reset_peak()
+            baseline = tracemalloc.get_traced_memory()[0]
+            call(argument)
+            allocations.append(tracemalloc.get_traced_memory()[1] - baseline)
+    finally:
+        tracemalloc.stop()
+
+    latencies.sort()
+    return {
+        'calls': calls,
+        'throughput': calls / elapsed,
+        'mean': statistics.mean(latencies),
+        'p50': _percentile(latencies, 0.5),
+        'p99': _percentile(latencies, 0.99),
+        'allocated_bytes': round(statistics.mean(allocations)) if allocations else None,
+    }
+
+
+def _commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def _change(old, new):
+    if not old or new is None:
+        return ''
+    return f'{(new - old) / old * 100:+6.1f}%'
+
+
+def _report(results, baseline=None):
+    baseline_benchmarks = (baseline or {}).get('benchmarks', {})
+    if baseline:
+        print(f'compared with {baseline.get("commit")} ({baseline.get("python")}, latency={baseline.get("latency")}s)')
+    print(f'{"benchmark":<34} {"calls/s":>9} {"p50":>10} {"p99":>10} {"allocated":>11}')
+    for name, result in results['benchmarks'].items():
+        old = baseline_benchmarks.get(name, {})
+        print(
+            f'{name:<34} {result["throughput"]:9.1f} {result["p50"] * 1000:8.3f}ms {result["p99"] * 1000:8.3f}ms '
+            f'{result["allocated_bytes"] or 0:9d} B'
+        )
+        if old:
+            print(
+                f'{"":<34} {_change(old["throughput"], result["throughput"]):>9} {_change(old["p50"], result["p50"]):>10} '
+                f'{_change(old["p99"], result["p99"]):>10} {_change(old["allocated_bytes"], result["allocated_bytes"]):>11}'
+            )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--calls', type=int, default=DEFAULT_CALLS)
+    parser.add_argument('--allocation-calls', type=int, default=DEFAULT_ALLOCATION_CALLS)
+    parser.add_argument('--latency', type=float, default=0, help='seconds added by the fake gateway to every response')
+    parser.add_argument('--only', action='append', help='run this benchmark only, can be repeated')
+    parser.add_argument('--output', help='write the results to this JSON file')
+    parser.add_argument('--compare', help='JSON file of a previous run to compare with')
+    args = parser.parse_args()
+
+    # Declined sales are logged, keep the records flowing without printing them
+    logging.getLogger('prose.test_braintree_lite').addHandler(logging.NullHandler())
+    connection, child_connection = multiprocessing.Pipe()
+    server = multiprocessing.Process(target=_serve, args=(args.latency, child_connection), daemon=True)
+    server.start()
+    try:
+        port = connection.recv()
+        client = BraintreeClient(environment=braintree.Environment('fake', '127.0.0.1', str(port), '', False, None))
+        customer_id = client.create_customer(**_customer_payload())
+        results = {
+            'commit': _commit(),
+            'python': platform.python_version(),
+            'latency': args.latency,
+            'benchmarks': {
+                name: _run(prepare, call, args.calls, args.allocation_calls)
+                for name, (prepare, call) in _benchmarks(client, customer_id).items()
+                if not args.only or name in args.only
+            },
+        }
+    finally:
+        connection.send(None)
+        server.join(timeout=5)
+
+    baseline = None
+    if args.compare:
+        with open(args.compare) as baseline_file:
+            baseline = json.load(baseline_file)
+    _report(results, baseline)
+    if args.output:
+        os.makedirs(os.path.dirname(args.output) or '.', exist_ok=True)
+        with open(args.output, 'w') as output_file:
+            json.dump(results, output_file, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,168 @@
+"""
+Parse time and peak memory of a transaction search response through braintree's default path (``XmlUtil.dict_from_xml``
+then ``braintree.Transaction`` objects, as ``BraintreeClient.iter_transactions`` does) against ``prose.fast_xml``.
+
+    python -m prose.bench_fast_xml --transactions 50 --repeat 20
+
+Responses are generated with the fields and nesting of real gateway transactions (card, addresses, status history,
+descriptor, disbursement and PayPal details), around 4.5 KiB each.
+"""
+import argparse
+import re
+import statistics
+import time
+import tracemalloc
+from datetime import datetime
+
+import braintree
+from braintree.util.xml_util import XmlUtil
+
+from prose.fast_xml import parse_transactions
+
+DEFAULT_TRANSACTIONS = 50
+DEFAULT_REPEAT = 20
+
+
+def _address(index):
+    return {
+        'id': f'address{index}',
+        'first_name': 'John',
+        'last_name': 'Doe',
+        'company': 'Prose',
+        'street_address': f'{index} Broadway',
+        'extended_address': 'Suite 100',
+        'locality': 'New York',
+        'region': 'NY',
+        'postal_code': '10001',
+        'country_name': 'United States of America',
+        'country_code_alpha2': 'US',
+        'country_code_alpha3': 'USA',
+        'country_code_numeric': '840',
+    }
+
+
+def _transaction(index):
+    created_at = datetime(2024, 1, 1, 12, 0, index % 60)
+    return {
+        'id': f'txn{index:06d}',
+        'status': 'settled',
+        'type': 'sale',
+        'currency_iso_code': 'USD',
+        'amount': '100.00',
+        'merchant_account_id': 'prose-usd',
+        'order_id': f'order-{index}',
+        'created_at': created_at,
+        'updated_at': created_at,
+        'customer': {'id': f'customer{index}', 'first_name': 'John', 'last_name': 'Doe', 'email': 'john@example.com'},
+        'billing': _address(index),
+        'shipping': _address(index),
+        'credit_card': {
+            'token': f'token{index}',
+            'bin': '411111',
+            'last_4': '1111',
+            'card_type': 'Visa',
+            'expiration_month': '12',
+            'expiration_year': '2030',
+            'customer_location': 'US',
+            'cardholder_name': 'John Doe',
+            'prepaid': 'No',
+            'healthcare': 'No',
+            'debit': 'Unknown',
+            'durbin_regulated': 'No',
+            'commercial': 'Unknown',
+            'payroll': 'No',
+            'issuing_bank': 'Unknown',
+            'country_of_issuance': 'USA',
+            'product_id': 'A',
+        },
+        'status_history': [
+            {'timestamp': created_at, 'status': status, 'amount': '100.00', 'user': 'prose', 'transaction_source': 'api'}
+            for status in ('authorized', 'submitted_for_settlement', 'settling', 'settled')
+        ],
+        'descriptor': {'name': 'PROSE*HAIRCARE', 'phone': '8005551234', 'url': 'prose.com'},
+        'disbursement_details': {
+            'settlement_amount': '100.00',
+            'settlement_currency_iso_code': 'USD',
+            'settlement_currency_exchange_rate': '1',
+            'funds_held': False,
+            'success': True,
+            'disbursement_date': '2024-01-03',
+        },
+        'paypal': {
+            'payer_email': 'payer@example.com',
+            'payer_first_name': 'John',
+            'payer_last_name': 'Doe',
+            'payer_id': f'PAYER{index:06d}',
+            'payment_id': f'PAYID-{index:06d}',
+            'authorization_id': f'AUTH{index:06d}',
+            'capture_id': f'CAPTURE{index:06d}',
+            'seller_protection_status': 'ELIGIBLE',
+            'transaction_fee_amount': '3.20',
+            'transaction_fee_currency_iso_code': 'USD',
+        },
+        'processor_response_code': '1000',
+        'processor_response_text': 'Approved',
+        'processor_authorization_code': f'A{index:05d}',
+        'network_transaction_id': f'{index:015d}',
+        'avs_postal_code_response_code': 'M',
+        'avs_street_address_response_code': 'M',
+        'cvv_response_code': 'M',
+        'recurring': False,
+        'refund_ids': [],
+        'add_ons': [],
+        'discounts': [],
+        'tax_exempt': False,
+        'service_fee_amount': None,
+        'purchase_order_number': None,
+        'risk_data': {'id': f'risk{index}', 'decision': 'Approve', 'device_data_captured': True, 'fraud_service_provider': 'kount'},
+    }
+
+
+def search_response(transactions) -> str:
+    """A gateway search response of ``transactions`` transactions, with dasherized tag names like the real gateway."""
+    xml = (
+        '<credit-card-transactions type="collection">'
+        + ''.join(XmlUtil.xml_from_dict({'transaction': _transaction(index)}) for index in range(transactions))
+        + '</credit-card-transactions>'
+    )
+    return '<?xml version="1.0" encoding="UTF-8"?>\n' + re.sub(r'</?[a-z0-9_]+', lambda tag: tag[0].replace('_', '-'), xml)
+
+
+def _default_path(xml):
+    response = XmlUtil.dict_from_xml(xml)
+    items = braintree.ResourceCollection._extract_as_array(response['credit_card_transactions'], 'transaction')
+    return [braintree.Transaction(None, item) for item in items]
+
+
+def _measure(parse, xml, repeat):
+    latencies = []
+    for _ in range(repeat):
+        started_at = time.perf_counter()
+        parse(xml)
+        latencies.append(time.perf_counter() - started_at)
+    tracemalloc.start()
+    try:
+        parse(xml)
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    return statistics.median(latencies), peak
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--transactions', type=int, default=DEFAULT_TRANSACTIONS)
+    parser.add_argument('--repeat', type=int, default=DEFAULT_REPEAT)
+    args = parser.parse_args()
+
+    xml = search_response(args.transactions)
+    print(f'{args.transactions} transactions, {len(xml) / 1024:.0f} KiB')
+    default_latency, default_peak = _measure(_default_path, xml, args.repeat)
+    fast_latency, fast_peak = _measure(parse_transactions, xml, args.repeat)
+    for label, latency, peak in (('default', default_latency, default_peak), ('fast_xml', fast_latency, fast_peak)):
+        print(f'{label:<10} p50={latency * 1000:8.3f}ms peak={peak / 1024:8.0f}KiB')
+    print(f'speedup    x{default_latency / fast_latency:.1f}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,86 @@
+"""
+Per-call latency of a fresh BraintreeGateway per call (previous BraintreeClient behaviour) against the pooled,
+shared gateway from ``prose.gateway_pool``, both talking to a local keep-alive stand-in server.
+
+    python -m prose.bench_gateway_pool --calls 500 --pool-size 10
+"""
+import argparse
+import statistics
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import braintree
+
+from prose.gateway_pool import GatewayRegistry
+
+CLIENT_TOKEN_RESPONSE = b'<?xml version="1.0" encoding="UTF-8"?><client-token><value>bench-token</value></client-token>'
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get('Content-Length') or 0))
+        self.send_response(201)
+        self.send_header('Content-Type', 'application/xml')
+        self.send_header('Content-Length', str(len(CLIENT_TOKEN_RESPONSE)))
+        self.end_headers()
+        self.wfile.write(CLIENT_TOKEN_RESPONSE)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def _credentials(environment):
+    return {
+        'environment': environment,
+        'merchant_id': 'bench-merchant',
+        'public_key': 'bench-public-key',
+        'private_key': 'bench-private-key',
+    }
+
+
+def _measure(get_gateway, calls):
+    latencies = []
+    for _ in range(calls):
+        start = time.perf_counter()
+        get_gateway().client_token.generate({'customer_id': 'bench-customer'})
+        latencies.append(time.perf_counter() - start)
+    return latencies
+
+
+def _report(label, latencies):
+    latencies = sorted(latencies)
+    p99 = latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))]
+    print(
+        f'{label:<18} mean={statistics.mean(latencies) * 1000:7.3f}ms '
+        f'p50={statistics.median(latencies) * 1000:7.3f}ms p99={p99 * 1000:7.3f}ms'
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--calls', type=int, default=500)
+    parser.add_argument('--pool-size', type=int, default=10)
+    args = parser.parse_args()
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), StandInHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    environment = braintree.Environment('bench', '127.0.0.1', str(server.server_port), '', False, None)
+    registry = GatewayRegistry()
+    try:
+        per_call = _measure(lambda: braintree.BraintreeGateway(braintree.Configuration(**_credentials(environment))), args.calls)
+        pooled = _measure(lambda: registry.get_gateway(pool_size=args.pool_size, **_credentials(environment)), args.calls)
+    finally:
+        registry.clear()
+        server.shutdown()
+        server.server_close()
+
+    _report('gateway per call', per_call)
+    _report('pooled gateway', pooled)
+
+
+if __name__ == '__main__':
+    main()
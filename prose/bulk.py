@@ -0,0 +1,154 @@
+"""
+Helpers for streaming bulk operations through a bounded thread pool.
+"""
+import os
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+DEFAULT_MAX_WORKERS = 8
+
+
+class RateLimiter:
+    """
+    Token bucket allowing ``rate`` calls per second, in bursts of up to ``burst`` calls.
+    """
+
+    def __init__(self, rate, burst=1, clock=time.monotonic, sleep=time.sleep):
+        self.rate = rate
+        self.burst = burst
+        self.clock = clock
+        self.sleep = sleep
+        self._tokens = burst
+        self._updated_at = clock()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        with self._lock:
+            now = self.clock()
+            self._tokens = min(self.burst, self._tokens + (now - self._updated_at) * self.rate)
+            self._updated_at = now
+            # Reserve a token even when the bucket is empty, and wait until it is due
+            self._tokens -= 1
+            wait = -self._tokens / self.rate if self._tokens < 0 else 0
+        if wait > 0:
+            self.sleep(wait)
+
+
+class BulkStats:
+    """
+    Throughput and latency counters of a bulk run, safe to read from another thread while it progresses.
+    """
+
+    def __init__(self, clock=time.monotonic):
+        self.clock = clock
+        self.succeeded = 0
+        self.failed = 0
+        self.total_latency = 0.0
+        self.max_latency = 0.0
+        self.started_at = clock()
+        self._lock = threading.Lock()
+
+    def record(self, latency, success):
+        with self._lock:
+            if success:
+                self.succeeded += 1
+            else:
+                self.failed += 1
+            self.total_latency += latency
+            self.max_latency = max(self.max_latency, latency)
+
+    @property
+    def completed(self) -> int:
+        return self.succeeded + self.failed
+
+    @property
+    def throughput(self) -> float:
+        """Completed calls per second since the run started."""
+        elapsed = self.clock() - self.started_at
+        return self.completed / elapsed if elapsed > 0 else 0.0
+
+    @property
+    def mean_latency(self) -> float:
+        return self.total_latency / self.completed if self.completed else 0.0
+
+    def snapshot(self) -> dict:
+        return {
+            'succeeded': self.succeeded,
+            'failed': self.failed,
+            'throughput': self.throughput,
+            'mean_latency': self.mean_latency,
+            'max_latency': self.max_latency,
+        }
+
+
+def _call(func, item, rate_limiter, stats):
+    if rate_limiter is not None:
+        rate_limiter.acquire()
+    started_at = time.perf_counter()
+    try:
+        result, error = func(item), None
+    except Exception as err:
+        result, error = None, err
+    if stats is not None:
+        stats.record(time.perf_counter() - started_at, error is None)
+    return result, error
+
+
+def error_message(err) -> str:
+    return str(err) or type(err).__name__
+
+
+def bounded_map(func, iterable, max_workers=DEFAULT_MAX_WORKERS, max_pending=None, rate_limiter=None, stats=None):
+    """
+    Yield ``(item, result, error)`` for each item of ``iterable``, in input order, calling ``func`` on a thread pool.
+
+    The input is consumed lazily: at most ``max_pending`` items (twice the workers by default) are held at once.
+    Calls wait on the optional ``rate_limiter`` and are recorded in the optional ``stats``.
+    """
+    max_pending = max_pending or max_workers * 2
+    executor = ThreadPoolExecutor(max_workers=max_workers)
+    pending = deque()
+    try:
+        for item in iterable:
+            pending.append((item, executor.submit(_call, func, item, rate_limiter, stats)))
+            if len(pending) >= max_pending:
+                item, future = pending.popleft()
+                yield (item, *future.result())
+        while pending:
+            item, future = pending.popleft()
+            yield (item, *future.result())
+    finally:
+        executor.shutdown(wait=True, cancel_futures=True)
+
+
+class Checkpoint:
+    """
+    Number of leading input records already processed, persisted to ``path`` so a bulk run can resume after a crash.
+    """
+
+    def __init__(self, path, every=100):
+        self.path = path
+        self.every = every
+        self.position = self.load()
+        self._saved_position = self.position
+
+    def load(self) -> int:
+        try:
+            with open(self.path) as checkpoint_file:
+                return int(checkpoint_file.read().strip() or 0)
+        except FileNotFoundError:
+            return 0
+
+    def advance(self, position):
+        self.position = position
+        if self.position - self._saved_position >= self.every:
+            self.save()
+
+    def save(self):
+        tmp_path = f'{self.path}.tmp'
+        with open(tmp_path, 'w') as checkpoint_file:
+            checkpoint_file.write(str(self.position))
+        os.replace(tmp_path, self.path)
+        self._saved_position = self.position
@@ -0,0 +1,171 @@
+"""
+Opt-in caches in front of BraintreeClient gateway calls, with pluggable storage.
+
+Storages implement ``get(key, default)``, ``set(key, value, ttl)`` and ``delete(key)``:
+``LocMemStorage`` is an in-process LRU, ``DjangoCacheStorage`` delegates to a Django cache alias.
+"""
+import threading
+import time
+from collections import OrderedDict
+
+DEFAULT_MAX_ENTRIES = 10_000
+# Client tokens stay valid for 24 hours, keep them well below that
+DEFAULT_CLIENT_TOKEN_TTL = 60 * 60
+DEFAULT_CUSTOMER_TTL = 5 * 60
+DEFAULT_CUSTOMER_NOT_FOUND_TTL = 30
+# Statuses move on with settlement batches, only trust them briefly unless a feed keeps them up to date
+DEFAULT_TRANSACTION_STATUS_TTL = 30
+
+MISSING = object()
+
+
+class LocMemStorage:
+    def __init__(self, max_entries=DEFAULT_MAX_ENTRIES, clock=time.monotonic):
+        self.max_entries = max_entries
+        self.clock = clock
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return default
+            value, expires_at = entry
+            if expires_at is not None and expires_at <= self.clock():
+                del self._entries[key]
+                return default
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key, value, ttl=None):
+        expires_at = None if ttl is None else self.clock() + ttl
+        with self._lock:
+            self._entries[key] = (value, expires_at)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class DjangoCacheStorage:
+    def __init__(self, alias='default'):
+        from django.core.cache import caches
+
+        self.cache = caches[alias]
+
+    def get(self, key, default=None):
+        return self.cache.get(key, default)
+
+    def set(self, key, value, ttl=None):
+        self.cache.set(key, value, timeout=ttl)
+
+    def delete(self, key):
+        self.cache.delete(key)
+
+
+class KeyedCache:
+    namespace = 'braintree'
+
+    def __init__(self, storage=None, ttl=None):
+        self.storage = LocMemStorage() if storage is None else storage
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._stats_lock = threading.Lock()
+
+    def _key(self, key):
+        return f'{self.namespace}:{key}'
+
+    def _count(self, hit):
+        with self._stats_lock:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+
+    def get(self, key, default=None):
+        value = self.storage.get(self._key(key), MISSING)
+        self._count(value is not MISSING)
+        return default if value is MISSING else value
+
+    def set(self, key, value, ttl=None):
+        self.storage.set(self._key(key), value, self.ttl if ttl is None else ttl)
+
+    def get_or_set(self, key, compute):
+        value = self.get(key, MISSING)
+        if value is MISSING:
+            value = compute()
+            self.set(key, value)
+        return value
+
+    def invalidate(self, key):
+        self.storage.delete(self._key(key))
+
+    @property
+    def stats(self) -> dict:
+        return {'hits': self.hits, 'misses': self.misses}
+
+
+class ClientTokenCache(KeyedCache):
+    """Client tokens keyed by customer pubkey."""
+
+    namespace = 'braintree:client_token'
+
+    def __init__(self, storage=None, ttl=DEFAULT_CLIENT_TOKEN_TTL):
+        super().__init__(storage=storage, ttl=ttl)
+
+
+class CustomerLookupCache(KeyedCache):
+    """Customer ids found in the vault, and ``None`` (with a shorter TTL) for customers that were not found."""
+
+    namespace = 'braintree:customer'
+
+    def __init__(self, storage=None, ttl=DEFAULT_CUSTOMER_TTL, not_found_ttl=DEFAULT_CUSTOMER_NOT_FOUND_TTL):
+        super().__init__(storage=storage, ttl=ttl)
+        self.not_found_ttl = not_found_ttl
+
+    def set(self, key, value, ttl=None):
+        if ttl is None and value is None:
+            ttl = self.not_found_ttl
+        super().set(key, value, ttl)
+
+
+class TransactionStatusCache(KeyedCache):
+    """
+    Last known status of transactions, from the client's own gateway calls and from ``update`` calls of a status feed
+    such as settlement webhooks.
+    """
+
+    namespace = 'braintree:transaction_status'
+
+    def __init__(self, storage=None, ttl=DEFAULT_TRANSACTION_STATUS_TTL):
+        super().__init__(storage=storage, ttl=ttl)
+        self.round_trips_saved = 0
+
+    def update(self, transaction_id, status):
+        self.set(str(transaction_id), status)
+
+    def count_round_trip_saved(self):
+        with self._stats_lock:
+            self.round_trips_saved += 1
+
+    @property
+    def stats(self) -> dict:
+        return dict(super().stats, round_trips_saved=self.round_trips_saved)
+
+
+class PaymentSourceInfoCache(KeyedCache):
+    """PaypalPaymentInfoDataClass keyed by payment mode (transaction) id. Payer details never change, entries do not expire."""
+
+    namespace = 'braintree:payment_source_info'
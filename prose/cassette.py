@@ -0,0 +1,160 @@
+"""
+Record/replay of the raw HTTP exchanges between ``BraintreeClient`` and the gateway.
+
+    cassette = Cassette('prose/cassettes/test_get_token.json.gz', mode=Cassette.RECORD)
+    client = BraintreeClient(gateway=cassette.wrap(BraintreeClient().gateway))
+    ...
+    cassette.save()
+
+Volatile values (uuids such as ``order_id`` and customer pubkeys, and the Faker generated names and phone numbers) are
+replaced by placeholders numbered in order of first appearance, so a replayed session with fresh uuids still matches
+the recording and gets its own values back in the responses.
+"""
+import gzip
+import hashlib
+import json
+import os
+import re
+import threading
+from collections import defaultdict, deque
+from functools import partial
+from urllib.parse import urlsplit
+
+import braintree
+from braintree.util.http import Http
+
+UUID_RE = re.compile(r'[0-9a-fA-F]{8}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{12}')
+VOLATILE_ELEMENTS = ('order_id', 'first_name', 'last_name', 'phone')
+# Requests use underscored tags, gateway responses dashed ones
+VOLATILE_ELEMENT_RE = re.compile(
+    r'(<(%s)(?: [^>]*)?>)([^<]+)(</\2>)' % '|'.join(name.replace('_', '[_-]') for name in VOLATILE_ELEMENTS)
+)
+PLACEHOLDER_RE = re.compile(r'\{\{volatile:\d+\}\}')
+WHITESPACE_BETWEEN_TAGS_RE = re.compile(r'>\s+<')
+
+CASSETTE_VERSION = 1
+
+
+class CassetteError(Exception):
+    pass
+
+
+class _Masker:
+    def __init__(self):
+        self._placeholders = {}
+        self._values = {}
+
+    def _placeholder(self, value):
+        if PLACEHOLDER_RE.fullmatch(value):
+            return value
+        placeholder = self._placeholders.get(value)
+        if placeholder is None:
+            placeholder = '{{volatile:%d}}' % len(self._placeholders)
+            self._placeholders[value] = placeholder
+            self._values[placeholder] = value
+        return placeholder
+
+    def mask(self, text):
+        if not text:
+            return text
+        text = VOLATILE_ELEMENT_RE.sub(lambda m: m.group(1) + self._placeholder(m.group(3)) + m.group(4), text)
+        return UUID_RE.sub(lambda m: self._placeholder(m.group(0)), text)
+
+    def unmask(self, text):
+        if not text:
+            return text
+        return PLACEHOLDER_RE.sub(lambda m: self._values.get(m.group(0), m.group(0)), text)
+
+
+class Cassette:
+    RECORD = 'record'
+    REPLAY = 'replay'
+
+    def __init__(self, path, mode=REPLAY):
+        if mode not in (self.RECORD, self.REPLAY):
+            raise ValueError(f'Unknown cassette mode: {mode}')
+        self.path = path
+        self.mode = mode
+        self.interactions = []
+        self._index = defaultdict(deque)
+        self._masker = _Masker()
+        self._lock = threading.Lock()
+        if mode == self.REPLAY:
+            self.load()
+
+    @staticmethod
+    def _body_hash(body):
+        body = WHITESPACE_BETWEEN_TAGS_RE.sub('><', body or '').strip()
+        return hashlib.sha1(body.encode('utf-8')).hexdigest()
+
+    def _key(self, http_verb, url, request_body):
+        url = urlsplit(url)
+        path = url.path + ('?' + url.query if url.query else '')
+        return http_verb, self._masker.mask(path), self._body_hash(self._masker.mask(request_body))
+
+    def load(self):
+        with gzip.open(self.path, 'rt', encoding='utf-8') as cassette_file:
+            data = json.load(cassette_file)
+        if data.get('version') != CASSETTE_VERSION:
+            raise CassetteError(f'Unsupported cassette version in {self.path}: {data.get("version")}')
+        self.interactions = data['interactions']
+        self._index.clear()
+        for position, (http_verb, path, body_hash, _status, _body) in enumerate(self.interactions):
+            self._index[(http_verb, path, body_hash)].append(position)
+
+    def save(self):
+        if self.mode != self.RECORD:
+            return
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        with gzip.open(self.path, 'wt', encoding='utf-8') as cassette_file:
+            json.dump({'version': CASSETTE_VERSION, 'interactions': self.interactions}, cassette_file, separators=(',', ':'))
+
+    def interact(self, http_verb, url, request_body, send):
+        if isinstance(request_body, bytes):
+            request_body = request_body.decode('utf-8')
+        with self._lock:
+            key = self._key(http_verb, url, request_body if isinstance(request_body, str) else None)
+            if self.mode == self.REPLAY:
+                positions = self._index.get(key)
+                if not positions:
+                    raise CassetteError(f'No recorded interaction for {http_verb} {key[1]} (body {key[2][:12]}) in {self.path}')
+                _http_verb, _path, _body_hash, status, response_body = self.interactions[positions.popleft()]
+                return [status, self._masker.unmask(response_body)]
+
+        status, response_body = send()
+        with self._lock:
+            self.interactions.append([*key, status, self._masker.mask(response_body)])
+            self._index[key].append(len(self.interactions) - 1)
+        return [status, response_body]
+
+    def wrap(self, gateway) -> 'braintree.BraintreeGateway':
+        """Return a gateway with ``gateway``'s configuration whose traffic goes through this cassette."""
+        config = gateway.config
+        return braintree.BraintreeGateway(
+            braintree.Configuration(
+                environment=config.environment,
+                merchant_id=config.merchant_id,
+                public_key=config.public_key,
+                private_key=config.private_key,
+                timeout=config.timeout,
+                wrap_http_exceptions=config.wrap_http_exceptions,
+                http_strategy=partial(CassetteHttp, cassette=self, inner=config.http_strategy()),
+            )
+        )
+
+
+class CassetteHttp(Http):
+    def __init__(self, config, environment=None, cassette=None, inner=None):
+        super().__init__(config, environment)
+        self.cassette = cassette
+        self.inner = inner or Http(config, environment)
+
+    def http_do(self, http_verb, path, headers, request_body):
+        return self.cassette.interact(
+            http_verb, path, request_body, lambda: self.inner.http_do(http_verb, path, headers, request_body)
+        )
+
+    def handle_exception(self, exception):
+        if isinstance(exception, CassetteError):
+            raise exception
+        self.inner.handle_exception(exception)
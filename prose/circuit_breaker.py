@@ -0,0 +1,166 @@
+"""
+Circuit breakers around gateway calls, one per operation type, with timeouts following the observed latency.
+
+A breaker opens after ``failure_threshold`` consecutive gateway failures (timeouts, dropped connections, 5xx and 429
+responses; declines and validation errors are answers, not failures) and rejects calls until ``recovery_timeout`` has
+passed. It then lets a single probe call through: its success closes the breaker, its failure opens it again.
+
+Timeouts follow the latency of the gateway requests made under the breaker, not of the guarded calls, which may be
+answered from a cache or make several requests.
+"""
+import functools
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+
+import braintree
+import requests
+from braintree.exceptions.http.connection_error import ConnectionError as GatewayConnectionError
+from braintree.exceptions.http.timeout_error import TimeoutError as GatewayTimeoutError
+
+from prose.gateway_pool import DEFAULT_TIMEOUT, request_latency_observer, request_timeout
+
+OPERATIONS = ('token', 'customer', 'sale', 'refund')
+
+DEFAULT_FAILURE_THRESHOLD = 5
+DEFAULT_RECOVERY_TIMEOUT = 30
+# Timeouts are set to TIMEOUT_MULTIPLIER times the p99 of the last LATENCY_WINDOW gateway responses
+LATENCY_WINDOW = 200
+MIN_LATENCY_SAMPLES = 20
+TIMEOUT_MULTIPLIER = 3
+DEFAULT_MIN_TIMEOUT = 1.0
+
+GATEWAY_FAILURES = (
+    braintree.exceptions.ServerError,
+    braintree.exceptions.ServiceUnavailableError,
+    braintree.exceptions.GatewayTimeoutError,
+    braintree.exceptions.TooManyRequestsError,
+    braintree.exceptions.RequestTimeoutError,
+    GatewayConnectionError,
+    GatewayTimeoutError,
+    requests.exceptions.ConnectionError,
+    requests.exceptions.Timeout,
+)
+
+
+class CircuitOpenError(Exception):
+    pass
+
+
+class CircuitBreaker:
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+
+    def __init__(
+        self,
+        name,
+        failure_threshold=DEFAULT_FAILURE_THRESHOLD,
+        recovery_timeout=DEFAULT_RECOVERY_TIMEOUT,
+        min_timeout=DEFAULT_MIN_TIMEOUT,
+        max_timeout=DEFAULT_TIMEOUT,
+        clock=time.monotonic,
+    ):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.recovery_timeout = recovery_timeout
+        self.min_timeout = min_timeout
+        self.max_timeout = max_timeout
+        self.clock = clock
+        self.state = self.CLOSED
+        self.failures = 0
+        self.rejected = 0
+        self.timeout = max_timeout
+        self._opened_at = None
+        self._probing = False
+        self._latencies = deque(maxlen=LATENCY_WINDOW)
+        self._lock = threading.Lock()
+
+    def _allow(self):
+        with self._lock:
+            if self.state == self.OPEN and self.clock() - self._opened_at >= self.recovery_timeout:
+                self.state = self.HALF_OPEN
+            if self.state == self.CLOSED:
+                return
+            if self.state == self.HALF_OPEN and not self._probing:
+                self._probing = True
+                return
+            self.rejected += 1
+        raise CircuitOpenError(f'Braintree {self.name} calls are suspended after repeated failures')
+
+    def _record_success(self):
+        with self._lock:
+            self.state, self.failures, self._probing = self.CLOSED, 0, False
+
+    def record_latency(self, latency):
+        """Record the duration of a gateway request, adapting the timeout to them."""
+        with self._lock:
+            self._latencies.append(latency)
+            # Adapt every MIN_LATENCY_SAMPLES requests rather than sorting the window on each one
+            if len(self._latencies) >= MIN_LATENCY_SAMPLES and len(self._latencies) % MIN_LATENCY_SAMPLES == 0:
+                latencies = sorted(self._latencies)
+                p99 = latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))]
+                self.timeout = min(self.max_timeout, max(self.min_timeout, p99 * TIMEOUT_MULTIPLIER))
+
+    def _record_failure(self):
+        with self._lock:
+            self.failures += 1
+            self._probing = False
+            if self.state == self.HALF_OPEN or self.failures >= self.failure_threshold:
+                self.state = self.OPEN
+                self._opened_at = self.clock()
+
+    @contextmanager
+    def guard(self):
+        """Run the block under this breaker, with the adaptive timeout applied to its gateway requests and their latency recorded."""
+        self._allow()
+        token = request_timeout.set(self.timeout)
+        observer_token = request_latency_observer.set(self.record_latency)
+        try:
+            yield
+        except GATEWAY_FAILURES:
+            self._record_failure()
+            raise
+        except Exception:
+            # Declines and validation errors are answers from a healthy gateway
+            self._record_success()
+            raise
+        except BaseException:
+            with self._lock:
+                self._probing = False
+            raise
+        else:
+            self._record_success()
+        finally:
+            request_latency_observer.reset(observer_token)
+            request_timeout.reset(token)
+
+
+class CircuitBreakers(dict):
+    """A CircuitBreaker per operation type, sharing the same settings."""
+
+    def __init__(self, operations=OPERATIONS, **kwargs):
+        super().__init__((operation, CircuitBreaker(operation, **kwargs)) for operation in operations)
+
+
+def guarded(operation, error_class):
+    """
+    Run the decorated method under the ``operation`` breaker of its instance's ``circuit_breakers``, when it has some,
+    raising ``error_class`` while the circuit is open.
+    """
+
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(self, *args, **kwargs):
+            if self.circuit_breakers is None:
+                return func(self, *args, **kwargs)
+            try:
+                with self.circuit_breakers[operation].guard():
+                    return func(self, *args, **kwargs)
+            except CircuitOpenError as err:
+                raise error_class(message=str(err))
+
+        return wrapper
+
+    return decorator
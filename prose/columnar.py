@@ -0,0 +1,237 @@
+"""
+Columnar export of transaction search results for reconciliation.
+
+    columns = export_transactions(client, 'transactions.col', braintree.TransactionSearch.settled_at.between(start, end))
+    columns = TransactionColumns.open('transactions.col')  # memory-mapped, nothing is read up front
+    columns.totals(by=('currency_iso_code', 'status'))  # {('USD', 'settled'): (Decimal('1234.50'), 12), ...}
+
+Amounts are int64 minor units, timestamps int64 epoch seconds, low-cardinality strings (currency, status, type,
+merchant account, customer) int32 codes into a per-column dictionary, and ids UTF-8 strings stored as an int64 offsets
+column plus a bytes column. A file is a JSON header followed by the column buffers, 8-byte aligned, which ``open``
+maps without copying. With numpy installed, ``numpy_column`` views a column as an array and ``totals`` is vectorized.
+"""
+import json
+import math
+import mmap
+import struct
+import sys
+from array import array
+from datetime import datetime
+from typing import TYPE_CHECKING
+
+from prose.minor_units import from_minor_units, to_minor_units
+from prose.money_batch import MoneyBatch
+
+if TYPE_CHECKING:
+    from prose.test_braintree_lite import TransactionRecord
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+MAGIC = b'PROSECOL'
+VERSION = 1
+ALIGNMENT = 8
+EPOCH = datetime(1970, 1, 1)
+
+INT64_COLUMNS = ('amount', 'created_at')
+DICTIONARY_COLUMNS = ('currency_iso_code', 'status', 'type', 'merchant_account_id', 'customer_id')
+STRING_COLUMNS = ('id', 'order_id')
+
+
+def _typecode(column) -> str:
+    if isinstance(column, array):
+        return column.typecode
+    return 'B' if isinstance(column, bytearray) else column.format
+
+
+class TransactionColumns:
+    """
+    Transactions stored column by column, appended to in memory or read-only when opened from a file.
+
+    ``None`` strings are kept in dictionary columns and stored as empty strings in the ``id`` and ``order_id`` columns.
+    """
+
+    def __init__(self):
+        self.rows = 0
+        self.columns = {name: array('q') for name in INT64_COLUMNS}
+        self.columns.update((name, array('i')) for name in DICTIONARY_COLUMNS)
+        for name in STRING_COLUMNS:
+            self.columns[f'{name}.offsets'] = array('q', [0])
+            self.columns[f'{name}.data'] = bytearray()
+        self.dictionaries = {name: [] for name in DICTIONARY_COLUMNS}
+        self._codes = {name: {} for name in DICTIONARY_COLUMNS}
+        self._mmap = None
+
+    def __len__(self):
+        return self.rows
+
+    def _code(self, name, value) -> int:
+        code = self._codes[name].get(value)
+        if code is None:
+            code = self._codes[name][value] = len(self.dictionaries[name])
+            self.dictionaries[name].append(value)
+        return code
+
+    def append(self, record: 'TransactionRecord'):
+        """Append ``record``, raising ValueError if it has no amount or currency."""
+        if record.amount is None or record.currency_iso_code is None:
+            raise ValueError(f'Transaction {record.id} has no amount or currency')
+        columns = self.columns
+        columns['amount'].append(to_minor_units(record.amount, record.currency_iso_code))
+        columns['created_at'].append(int((record.created_at - EPOCH).total_seconds()) if record.created_at else 0)
+        for name in DICTIONARY_COLUMNS:
+            columns[name].append(self._code(name, getattr(record, name)))
+        for name in STRING_COLUMNS:
+            data = columns[f'{name}.data']
+            data += (getattr(record, name) or '').encode()
+            columns[f'{name}.offsets'].append(len(data))
+        self.rows += 1
+
+    def extend(self, records):
+        for record in records:
+            self.append(record)
+
+    def value(self, name, index):
+        """Decoded value of column ``name`` in row ``index``: minor units, epoch seconds or strings."""
+        if name in DICTIONARY_COLUMNS:
+            return self.dictionaries[name][self.columns[name][index]]
+        if name in STRING_COLUMNS:
+            offsets = self.columns[f'{name}.offsets']
+            return bytes(self.columns[f'{name}.data'][offsets[index] : offsets[index + 1]]).decode()
+        return self.columns[name][index]
+
+    def amounts(self) -> 'MoneyBatch':
+        """The amounts as a MoneyBatch sharing the amount and currency columns."""
+        return MoneyBatch(self.columns['amount'], self.columns['currency_iso_code'], self.dictionaries['currency_iso_code'])
+
+    def numpy_column(self, name) -> 'numpy.ndarray':
+        """A read-only numpy view of column ``name`` (codes for dictionary columns), sharing its memory."""
+        if numpy is None:
+            raise ImportError('numpy is required for numpy_column')
+        column = self.columns[name]
+        return numpy.frombuffer(column, dtype=numpy.dtype(_typecode(column)))
+
+    def totals(self, by=('currency_iso_code',)) -> dict:
+        """
+        Sum of the amounts and number of rows per distinct values of the ``by`` dictionary columns, which must include
+        ``currency_iso_code``: ``{(value, ...): (Decimal total, count)}``.
+        """
+        if 'currency_iso_code' not in by:
+            raise ValueError('Amounts can only be totalled per currency')
+        sums = self._sums_numpy(by) if numpy is not None else self._sums_python(by)
+        currency_index = by.index('currency_iso_code')
+        return {
+            key: (from_minor_units(units, key[currency_index]), count)
+            for key, (units, count) in sorted(sums.items(), key=lambda item: [str(value) for value in item[0]])
+        }
+
+    def _sums_python(self, by) -> dict:
+        sums = {}
+        for *codes, amount in zip(*(self.columns[name] for name in by), self.columns['amount']):
+            key = tuple(codes)
+            units, count = sums.get(key, (0, 0))
+            sums[key] = (units + amount, count + 1)
+        return {self._decode_key(by, codes): value for codes, value in sums.items()}
+
+    def _sums_numpy(self, by) -> dict:
+        if not self.rows:
+            return {}
+        amounts = self.numpy_column('amount')
+        if max(-int(amounts.min()), int(amounts.max())) * self.rows > numpy.iinfo(numpy.int64).max:
+            # Sums could wrap around int64, add Python integers instead
+            return self._sums_python(by)
+        columns = [self.numpy_column(name) for name in by]
+        cardinalities = [len(self.dictionaries[name]) for name in by]
+        if math.prod(cardinalities) <= numpy.iinfo(numpy.int64).max:
+            # One int64 key per row combining the codes
+            keys = numpy.zeros(self.rows, dtype=numpy.int64)
+            for column, cardinality in zip(columns, cardinalities):
+                keys = keys * cardinality + column
+            keys, inverse = numpy.unique(keys, return_inverse=True)
+            group_codes = []
+            for key in keys.tolist():
+                codes = []
+                for cardinality in reversed(cardinalities):
+                    key, code = divmod(key, cardinality)
+                    codes.append(code)
+                group_codes.append(codes[::-1])
+        else:
+            # Combined keys would overflow, compare the rows of codes instead
+            keys, inverse = numpy.unique(numpy.stack(columns, axis=1), axis=0, return_inverse=True)
+            group_codes = keys.tolist()
+        # Sums of the amounts of each group once the rows are ordered by group
+        inverse = inverse.reshape(-1)
+        counts = numpy.bincount(inverse, minlength=len(group_codes))
+        starts = numpy.concatenate(([0], numpy.cumsum(counts)[:-1]))
+        sums = numpy.add.reduceat(amounts[numpy.argsort(inverse, kind='stable')], starts)
+        return {
+            self._decode_key(by, codes): (units, count)
+            for codes, units, count in zip(group_codes, sums.tolist(), counts.tolist())
+        }
+
+    def _decode_key(self, by, codes) -> tuple:
+        return tuple(self.dictionaries[name][code] for name, code in zip(by, codes))
+
+    def save(self, path):
+        buffers, offset = {}, 0
+        for name, column in self.columns.items():
+            length = memoryview(column).nbytes
+            buffers[name] = {'typecode': _typecode(column), 'offset': offset, 'length': length}
+            offset += -(-length // ALIGNMENT) * ALIGNMENT
+        header = json.dumps(
+            {
+                'version': VERSION,
+                'byteorder': sys.byteorder,
+                'rows': self.rows,
+                'columns': buffers,
+                'dictionaries': self.dictionaries,
+            }
+        ).encode()
+        header += b' ' * (-(len(MAGIC) + 8 + len(header)) % ALIGNMENT)
+        with open(path, 'wb') as columns_file:
+            columns_file.write(MAGIC + struct.pack('<Q', len(header)) + header)
+            for name, column in self.columns.items():
+                columns_file.write(column)
+                columns_file.write(b'\0' * (-buffers[name]['length'] % ALIGNMENT))
+
+    @classmethod
+    def open(cls, path) -> 'TransactionColumns':
+        with open(path, 'rb') as columns_file:
+            if columns_file.read(len(MAGIC)) != MAGIC:
+                raise ValueError(f'{path} is not a transaction columns file')
+            (header_length,) = struct.unpack('<Q', columns_file.read(8))
+            header = json.loads(columns_file.read(header_length))
+            if header['version'] != VERSION or header['byteorder'] != sys.byteorder:
+                raise ValueError(f'{path} was written by an incompatible version or platform')
+            mapped = mmap.mmap(columns_file.fileno(), 0, access=mmap.ACCESS_READ)
+        columns = cls()
+        columns.rows = header['rows']
+        columns.dictionaries = header['dictionaries']
+        start = len(MAGIC) + 8 + header_length
+        view = memoryview(mapped)
+        columns.columns = {
+            name: view[start + buffer['offset'] : start + buffer['offset'] + buffer['length']].cast(buffer['typecode'])
+            for name, buffer in header['columns'].items()
+        }
+        view.release()
+        columns._mmap = mapped
+        return columns
+
+    def close(self):
+        if self._mmap is not None:
+            for column in self.columns.values():
+                column.release()
+            self._mmap.close()
+            self._mmap = None
+
+
+def export_transactions(client, path, *query) -> 'TransactionColumns':
+    """
+    Stream the transactions matching the TransactionSearch ``query`` terms into columns and save them to ``path``.
+    """
+    columns = TransactionColumns()
+    columns.extend(client.search_transaction_records(*query))
+    columns.save(path)
+    return columns
@@ -0,0 +1,78 @@
+"""
+Cheap structured logging of gateway errors.
+
+``log_error`` leaves formatting to the logging framework and only builds the ``err__dict`` extra for records that will
+be handled, keeping a bounded set of error attributes. ``RepeatedErrorFilter`` can be attached to the logger or its
+handlers to let through a few records per interval of the same error from the same logging call and count the rest:
+
+    logging.getLogger('prose.test_braintree_lite').addFilter(RepeatedErrorFilter())
+"""
+import logging
+import threading
+import time
+from collections import OrderedDict
+
+ERROR_ATTRIBUTES = ('code', 'message', 'user_message', 'status')
+MAX_ATTRIBUTE_LENGTH = 256
+
+DEFAULT_BURST = 5
+DEFAULT_INTERVAL = 60
+DEFAULT_MAX_KEYS = 1000
+
+
+def error_attributes(err) -> dict:
+    attributes = {}
+    for name in ERROR_ATTRIBUTES:
+        value = err.__dict__.get(name)
+        if value is not None:
+            attributes[name] = value[:MAX_ATTRIBUTE_LENGTH] if isinstance(value, str) else value
+    return attributes
+
+
+def log_error(logger, msg, err, *args, level=logging.ERROR):
+    """Log ``msg % (err, *args)`` with the selected attributes of ``err`` as ``err__dict``."""
+    if logger.isEnabledFor(level):
+        # Attribute the record to the caller rather than to this helper
+        logger.log(level, msg, err, *args, extra={'err__dict': error_attributes(err)}, stacklevel=2)
+
+
+class RepeatedErrorFilter(logging.Filter):
+    """
+    Let through ``burst`` records of the same error from the same logging call per ``interval`` seconds and drop the
+    others.
+
+    Records are told apart by logger, level, format string, source line and the class and ``code`` of their first
+    argument (the error, for ``log_error`` records), without formatting their message, so dropped records cost no
+    formatting. The first record let through after some were dropped carries their number as ``suppressed``.
+    """
+
+    def __init__(self, burst=DEFAULT_BURST, interval=DEFAULT_INTERVAL, max_keys=DEFAULT_MAX_KEYS, clock=time.monotonic):
+        super().__init__()
+        self.burst = burst
+        self.interval = interval
+        self.max_keys = max_keys
+        self.clock = clock
+        self.suppressed = 0
+        # key -> [window start, records let through in the window, records dropped since the last one let through]
+        self._windows = OrderedDict()
+        self._lock = threading.Lock()
+
+    def filter(self, record):
+        err = record.args[0] if isinstance(record.args, tuple) and record.args else None
+        key = (record.name, record.levelno, record.msg, record.pathname, record.lineno, type(err), getattr(err, 'code', None))
+        now = self.clock()
+        with self._lock:
+            window = self._windows.get(key)
+            if window is None or now - window[0] >= self.interval:
+                window = [now, 0, window[2] if window else 0]
+                self._windows[key] = window
+            self._windows.move_to_end(key)
+            while len(self._windows) > self.max_keys:
+                self._windows.popitem(last=False)
+            if window[1] >= self.burst:
+                window[2] += 1
+                self.suppressed += 1
+                return False
+            window[1] += 1
+            record.suppressed, window[2] = window[2], 0
+        return True
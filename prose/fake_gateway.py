@@ -0,0 +1,489 @@
+"""
+In-process stand-in for the subset of the Braintree XML API used by ``BraintreeClient``.
+
+    with FakeBraintreeGateway() as fake_gateway:
+        client = BraintreeClient(environment=fake_gateway.environment)
+"""
+import base64
+import json
+import re
+import secrets
+import threading
+import time
+from datetime import datetime, timezone
+from decimal import Decimal, InvalidOperation
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import braintree
+from braintree.util.xml_util import XmlUtil
+
+MERCHANT_ACCOUNT_CURRENCIES = {
+    'prose-usd': 'USD',
+    'prose-cad': 'CAD',
+}
+DEFAULT_MERCHANT_ACCOUNT_ID = 'prose-usd'
+SEARCH_PAGE_SIZE = 50
+
+VALID_NONCE = 'fake-valid-nonce'
+PROCESSOR_DECLINED_NONCE = 'fake-processor-declined-visa-nonce'
+PAYPAL_NONCE = 'fake-paypal-one-time-nonce'
+PAYPAL_PAYER = {'payer_email': 'payer@example.com', 'payer_first_name': 'John', 'payer_last_name': 'Doe'}
+PROCESSOR_DECLINED_CODE = '2001'
+PROCESSOR_DECLINED_MESSAGE = (
+    'Do Not Honor - Insufficient Funds: The transaction was declined due to insufficient funds in your account. '
+    'Please use a different card or contact your bank.'
+)
+
+VOIDABLE_STATUSES = ('authorized', 'submitted_for_settlement', 'settlement_pending')
+REFUNDABLE_STATUSES = ('settled', 'settling')
+
+
+class _ValidationError(Exception):
+    def __init__(self, code, message, attribute='base', object_key='transaction', transaction=None):
+        super().__init__(message)
+        self.code = code
+        self.message = message
+        self.attribute = attribute
+        self.object_key = object_key
+        self.transaction = transaction
+
+
+class _NotFound(Exception):
+    pass
+
+
+def _money(value):
+    try:
+        return Decimal(str(value)).quantize(Decimal('0.01'))
+    except InvalidOperation:
+        raise _ValidationError('81503', 'Amount is an invalid format.', attribute='amount')
+
+
+def _now():
+    # Naive UTC, matching what braintree's datetime parser hands back for search criteria
+    return datetime.now(timezone.utc).replace(tzinfo=None)
+
+
+class FakeBraintreeGateway:
+    """
+    Threaded HTTP server keeping customers and transactions in memory.
+
+    Behaviour is deterministic: ``fake-processor-declined-visa-nonce`` is always declined, a second sale with the same
+    ``order_id`` and amount is gateway rejected as a duplicate, and only settled transactions can be refunded
+    (use ``gateway.testing.settle_transaction`` to settle one). Every response is delayed by ``latency`` seconds.
+    """
+
+    def __init__(self, host='127.0.0.1', port=0, latency=0):
+        self.latency = latency
+        self.customers = {}
+        self.transactions = {}
+        self.payment_methods = {}
+        self.requests_count = 0
+        self._sequence = 0
+        self._failures = []
+        self._lock = threading.RLock()
+        self._server = ThreadingHTTPServer((host, port), _handler_for(self))
+        self._server.daemon_threads = True
+        self._thread = None
+
+    @property
+    def environment(self) -> 'braintree.Environment':
+        host, port = self._server.server_address[:2]
+        return braintree.Environment('fake', host, str(port), '', False, None)
+
+    def start(self) -> 'FakeBraintreeGateway':
+        self._thread = threading.Thread(
+            target=self._server.serve_forever, kwargs={'poll_interval': 0.05}, name='fake-braintree-gateway', daemon=True
+        )
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+        if self._thread is not None:
+            self._thread.join()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def fail_next(self, count, status=503, route=None, processed=False):
+        """
+        Answer the next ``count`` requests (to ``route``, a handler name such as ``refund``) with an empty ``status``.
+
+        With ``processed``, the requests are carried out before failing, as when a response is lost.
+        """
+        with self._lock:
+            self._failures.extend([(status, route, processed)] * count)
+
+    def _next_id(self):
+        self._sequence += 1
+        return f'{secrets.token_hex(3)}{self._sequence:02x}'
+
+    # Customers
+
+    def create_customer(self, params):
+        params = params.get('customer') or {}
+        customer_id = params.get('id') or str(secrets.randbelow(10**9))
+        if customer_id in self.customers:
+            raise _ValidationError('91609', 'Customer ID has already been taken.', attribute='id', object_key='customer')
+        now = _now()
+        customer = {
+            'id': customer_id,
+            'first_name': params.get('first_name'),
+            'last_name': params.get('last_name'),
+            'email': params.get('email'),
+            'phone': params.get('phone'),
+            'company': params.get('company'),
+            'created_at': now,
+            'updated_at': now,
+            'credit_cards': [],
+        }
+        self.customers[customer_id] = customer
+        return 201, {'customer': customer}
+
+    def find_customer(self, customer_id):
+        if customer_id not in self.customers:
+            raise _NotFound()
+        return 200, {'customer': self.customers[customer_id]}
+
+    def delete_customer(self, customer_id):
+        customer = self.customers.pop(customer_id, None)
+        if customer is None:
+            raise _NotFound()
+        for credit_card in customer['credit_cards']:
+            self.payment_methods.pop(credit_card['token'], None)
+        return 200, None
+
+    def generate_client_token(self, params):
+        customer_id = (params.get('client_token') or {}).get('customer_id')
+        if customer_id and customer_id not in self.customers:
+            message = 'Customer specified by customer_id does not exist'
+            return 422, {'api_error_response': {'errors': {'errors': []}, 'message': message}}
+        token = {'version': 2, 'authorizationFingerprint': secrets.token_hex(16), 'customerId': customer_id}
+        return 201, {'client_token': {'value': base64.b64encode(json.dumps(token).encode()).decode()}}
+
+    # Transactions
+
+    def _new_transaction(self, type, amount, currency_iso_code, merchant_account_id, order_id, customer, **fields):
+        now = _now()
+        transaction = {
+            'id': self._next_id(),
+            'type': type,
+            'status': 'authorized',
+            'amount': str(amount),
+            'currency_iso_code': currency_iso_code,
+            'merchant_account_id': merchant_account_id,
+            'order_id': order_id,
+            'created_at': now,
+            'updated_at': now,
+            'customer': {key: customer.get(key) for key in ('id', 'first_name', 'last_name', 'email', 'phone')},
+            'refund_ids': [],
+            'refunded_transaction_id': None,
+            'processor_response_code': '1000',
+            'processor_response_text': 'Approved',
+            'gateway_rejection_reason': None,
+        }
+        transaction.update(fields)
+        transaction['_sequence'] = self._sequence
+        self.transactions[transaction['id']] = transaction
+        return transaction
+
+    def _is_duplicate(self, order_id, amount):
+        return order_id and any(
+            t['order_id'] == order_id
+            and t['type'] == 'sale'
+            and Decimal(t['amount']) == amount
+            and t['status'] not in ('gateway_rejected', 'processor_declined')
+            for t in self.transactions.values()
+        )
+
+    def sale(self, params):
+        params = params.get('transaction') or {}
+        amount = _money(params.get('amount'))
+        merchant_account_id = params.get('merchant_account_id') or DEFAULT_MERCHANT_ACCOUNT_ID
+        if merchant_account_id not in MERCHANT_ACCOUNT_CURRENCIES:
+            raise _ValidationError('91577', 'Merchant account ID is invalid.', attribute='merchant_account_id')
+        customer_id = params.get('customer_id')
+        if customer_id and customer_id not in self.customers:
+            raise _ValidationError('91510', 'Customer ID is invalid.', attribute='customer_id')
+        customer = self.customers.get(customer_id) or {}
+        options = params.get('options') or {}
+        nonce = params.get('payment_method_nonce')
+        token = params.get('payment_method_token')
+        credit_card = paypal = None
+
+        if token:
+            if token not in self.payment_methods:
+                raise _ValidationError('91518', 'Payment method token is invalid.', attribute='payment_method_token')
+            credit_card = dict(self.payment_methods[token])
+        elif nonce in (VALID_NONCE, PROCESSOR_DECLINED_NONCE):
+            credit_card = {
+                'token': None,
+                'bin': '411111',
+                'last_4': '1111',
+                'card_type': 'Visa',
+                'expiration_month': '12',
+                'expiration_year': '2030',
+                'expired': False,
+                'customer_id': customer_id,
+            }
+        elif nonce == PAYPAL_NONCE:
+            paypal = dict(PAYPAL_PAYER, payer_id=secrets.token_hex(6).upper(), payment_id=f'PAYID-{secrets.token_hex(8).upper()}')
+        else:
+            raise _ValidationError('91565', 'Unknown payment_method_nonce.', attribute='payment_method_nonce')
+
+        transaction_fields = {
+            'type': 'sale',
+            'amount': amount,
+            'currency_iso_code': MERCHANT_ACCOUNT_CURRENCIES[merchant_account_id],
+            'merchant_account_id': merchant_account_id,
+            'order_id': params.get('order_id'),
+            'customer': customer,
+        }
+        if paypal is not None:
+            transaction_fields.update(paypal=paypal, payment_instrument_type='paypal_account')
+        else:
+            transaction_fields.update(credit_card=credit_card, payment_instrument_type='credit_card')
+        if self._is_duplicate(params.get('order_id'), amount):
+            transaction = self._new_transaction(status='gateway_rejected', gateway_rejection_reason='duplicate', **transaction_fields)
+            raise _ValidationError(None, 'Gateway Rejected: duplicate', transaction=transaction)
+        if nonce == PROCESSOR_DECLINED_NONCE:
+            transaction = self._new_transaction(
+                status='processor_declined',
+                processor_response_code=PROCESSOR_DECLINED_CODE,
+                processor_response_text='Insufficient Funds',
+                **transaction_fields,
+            )
+            raise _ValidationError(None, PROCESSOR_DECLINED_MESSAGE, transaction=transaction)
+
+        if credit_card is not None and not token and options.get('store_in_vault_on_success') and customer:
+            credit_card['token'] = secrets.token_hex(4)
+            self.payment_methods[credit_card['token']] = credit_card
+            customer['credit_cards'].append(credit_card)
+        status = 'submitted_for_settlement' if options.get('submit_for_settlement') else 'authorized'
+        return 201, {'transaction': self._new_transaction(status=status, **transaction_fields)}
+
+    def _get_transaction(self, transaction_id):
+        if transaction_id not in self.transactions:
+            raise _NotFound()
+        return self.transactions[transaction_id]
+
+    def find_transaction(self, transaction_id):
+        return 200, {'transaction': self._get_transaction(transaction_id)}
+
+    def void(self, transaction_id):
+        transaction = self._get_transaction(transaction_id)
+        if transaction['status'] not in VOIDABLE_STATUSES:
+            raise _ValidationError(
+                '91504',
+                'Transaction can only be voided if status is authorized, submitted_for_settlement, '
+                'or - for PayPal - settlement_pending.',
+            )
+        transaction.update(status='voided', updated_at=_now())
+        return 200, {'transaction': transaction}
+
+    def refund(self, transaction_id, params):
+        transaction = self._get_transaction(transaction_id)
+        if transaction['type'] != 'sale':
+            raise _ValidationError('91505', 'Cannot refund credit')
+        if transaction['status'] not in REFUNDABLE_STATUSES:
+            raise _ValidationError('91506', 'Cannot refund transaction unless it is settled.')
+        refunded = sum((Decimal(self.transactions[refund_id]['amount']) for refund_id in transaction['refund_ids']), Decimal('0.00'))
+        remaining = Decimal(transaction['amount']) - refunded
+        if remaining <= 0:
+            raise _ValidationError('91512', 'Transaction has already been completely refunded.')
+        options = params.get('transaction') or {}
+        amount = _money(options['amount']) if options.get('amount') else remaining
+        if amount > remaining:
+            raise _ValidationError('91521', 'Refund amount is too large.', attribute='amount')
+
+        refund = self._new_transaction(
+            type='credit',
+            status='submitted_for_settlement',
+            amount=amount,
+            currency_iso_code=transaction['currency_iso_code'],
+            merchant_account_id=transaction['merchant_account_id'],
+            order_id=options.get('order_id') or transaction['order_id'],
+            customer=transaction['customer'],
+            credit_card=transaction.get('credit_card'),
+            refunded_transaction_id=transaction_id,
+        )
+        transaction['refund_ids'].append(refund['id'])
+        return 201, {'transaction': refund}
+
+    def settle(self, transaction_id):
+        transaction = self._get_transaction(transaction_id)
+        if transaction['status'] not in ('submitted_for_settlement', 'settling', 'settlement_pending'):
+            raise _ValidationError('91575', 'Cannot transition transaction to settled, settlement_confirmed, or settlement_declined')
+        transaction.update(status='settled', updated_at=_now())
+        return 200, {'transaction': transaction}
+
+    # Search
+
+    _SEARCH_FIELDS = {
+        'id': lambda t: t['id'],
+        'ids': lambda t: t['id'],
+        'customer_id': lambda t: t['customer'].get('id'),
+        'order_id': lambda t: t['order_id'],
+        'status': lambda t: t['status'],
+        'type': lambda t: t['type'],
+        'merchant_account_id': lambda t: t['merchant_account_id'],
+        'amount': lambda t: Decimal(t['amount']),
+        'created_at': lambda t: t['created_at'],
+        'payment_method_token': lambda t: (t.get('credit_card') or {}).get('token'),
+        'refund': lambda t: bool(t['refund_ids']),
+    }
+
+    @staticmethod
+    def _matches(value, condition):
+        if isinstance(condition, list):
+            return value in condition
+        if not isinstance(condition, dict):
+            return str(value) == str(condition)
+        for operator, expected in condition.items():
+            if operator in ('min', 'max') and isinstance(value, Decimal):
+                expected = Decimal(expected)
+            if operator == 'is' and str(value) != str(expected):
+                return False
+            if operator == 'is_not' and str(value) == str(expected):
+                return False
+            if operator == 'starts_with' and not str(value).startswith(expected):
+                return False
+            if operator == 'ends_with' and not str(value).endswith(expected):
+                return False
+            if operator == 'contains' and expected not in str(value):
+                return False
+            if operator == 'min' and value < expected:
+                return False
+            if operator == 'max' and value > expected:
+                return False
+        return True
+
+    def _search(self, params):
+        criteria = params.get('search') or {}
+        unsupported = set(criteria) - set(self._SEARCH_FIELDS)
+        if unsupported:
+            raise ValueError(f'Unsupported search criteria: {sorted(unsupported)}')
+        matches = [
+            transaction
+            for transaction in self.transactions.values()
+            if all(self._matches(self._SEARCH_FIELDS[field](transaction), condition) for field, condition in criteria.items())
+        ]
+        # Newest first, like the real gateway
+        return sorted(matches, key=lambda t: (t['created_at'], t['_sequence']), reverse=True)
+
+    def search_ids(self, params):
+        ids = [transaction['id'] for transaction in self._search(params)]
+        return 200, {'search_results': {'page_size': SEARCH_PAGE_SIZE, 'ids': ids}}
+
+    def search(self, params):
+        return 200, _RawXml(
+            '<credit-card-transactions type="collection">'
+            + ''.join(XmlUtil.xml_from_dict({'transaction': _public(t)}) for t in self._search(params))
+            + '</credit-card-transactions>'
+        )
+
+    # Routing
+
+    _ROUTES = (
+        ('POST', r'/customers', 'create_customer'),
+        ('GET', r'/customers/(?P<customer_id>[^/]+)', 'find_customer'),
+        ('DELETE', r'/customers/(?P<customer_id>[^/]+)', 'delete_customer'),
+        ('POST', r'/client_token', 'generate_client_token'),
+        ('POST', r'/transactions', 'sale'),
+        ('POST', r'/transactions/advanced_search_ids', 'search_ids'),
+        ('POST', r'/transactions/advanced_search', 'search'),
+        ('GET', r'/transactions/(?P<transaction_id>[^/]+)', 'find_transaction'),
+        ('PUT', r'/transactions/(?P<transaction_id>[^/]+)/void', 'void'),
+        ('POST', r'/transactions/(?P<transaction_id>[^/]+)/refund', 'refund'),
+        ('PUT', r'/transactions/(?P<transaction_id>[^/]+)/settle', 'settle'),
+    )
+    _COMPILED_ROUTES = tuple((method, re.compile(r'/merchants/[^/]+' + pattern + '$'), name) for method, pattern, name in _ROUTES)
+
+    def handle(self, method, path, body):
+        if self.latency:
+            time.sleep(self.latency)
+        path = path.split('?', 1)[0]
+        for route_method, pattern, name in self._COMPILED_ROUTES:
+            match = route_method == method and pattern.match(path)
+            if not match:
+                continue
+            kwargs = match.groupdict()
+            if method in ('POST', 'PUT') and name not in ('void', 'settle'):
+                kwargs['params'] = XmlUtil.dict_from_xml(body) if body.strip() else {}
+            with self._lock:
+                self.requests_count += 1
+                failure = next((failure for failure in self._failures if failure[1] in (None, name)), None)
+                if failure is not None:
+                    self._failures.remove(failure)
+                    if not failure[2]:
+                        return failure[0], None
+                try:
+                    if failure is not None:
+                        getattr(self, name)(**kwargs)
+                        return failure[0], None
+                    return getattr(self, name)(**kwargs)
+                except _NotFound:
+                    return 404, None
+                except _ValidationError as err:
+                    return 422, {'api_error_response': _error_response(err)}
+                except (KeyError, ValueError):
+                    return 400, None
+        return 404, None
+
+
+class _RawXml(str):
+    pass
+
+
+def _public(value):
+    """Strip bookkeeping keys (prefixed with ``_``) before serializing."""
+    if isinstance(value, dict):
+        return {key: _public(item) for key, item in value.items() if not key.startswith('_')}
+    if isinstance(value, list):
+        return [_public(item) for item in value]
+    return value
+
+
+def _error_response(err):
+    errors = {'errors': []}
+    if err.code:
+        errors[err.object_key] = {'errors': [{'code': err.code, 'attribute': err.attribute, 'message': err.message}]}
+    response = {'errors': errors, 'message': err.message}
+    if err.transaction is not None:
+        response['transaction'] = err.transaction
+    return response
+
+
+def _handler_for(fake_gateway):
+    class FakeBraintreeHandler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+        disable_nagle_algorithm = True
+
+        def _dispatch(self):
+            body = self.rfile.read(int(self.headers.get('Content-Length') or 0))
+            status, response = fake_gateway.handle(self.command, self.path, body.decode('utf-8'))
+            if response is None:
+                payload = b''
+            elif isinstance(response, _RawXml):
+                payload = response.encode('utf-8')
+            else:
+                payload = XmlUtil.xml_from_dict(_public(response)).encode('utf-8')
+            if payload:
+                payload = b'<?xml version="1.0" encoding="UTF-8"?>\n' + payload
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/xml; charset=utf-8')
+            self.send_header('Content-Length', str(len(payload)))
+            self.end_headers()
+            self.wfile.write(payload)
+
+        do_GET = do_POST = do_PUT = do_DELETE = _dispatch
+
+        def log_message(self, format, *args):
+            pass
+
+    return FakeBraintreeHandler
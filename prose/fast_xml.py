@@ -0,0 +1,153 @@
+"""
+Streaming parser of gateway transaction search responses keeping only the fields BraintreeClient reads.
+
+``braintree`` turns a response into nested dicts through ``xml.dom.minidom`` (building the whole DOM first), then into
+``Transaction`` objects with dozens of attributes and sub-objects. ``parse_transactions`` feeds the response to a
+pull parser a chunk at a time, keeps ``TRANSACTION_FIELDS``, ``customer.id`` and the ``paypal`` attributes of each
+transaction and frees the transaction element once read, so memory does not grow with the page:
+
+    xml = RawXmlHttp(gateway.config).post(gateway.config.base_merchant_path() + '/transactions/advanced_search', params)
+    transactions = parse_transactions(xml)  # [{'id': ..., 'amount': Decimal(...), ..., 'customer': {'id': ...}}]
+
+The dicts keep the shape of braintree's raw attributes (``customer`` and ``paypal`` rather than ``customer_details`` and
+``paypal_details``), with nil fields as ``None``, amounts as ``Decimal`` and timestamps as naive UTC datetimes.
+"""
+from base64 import b64encode
+from datetime import datetime
+from decimal import Decimal
+from xml.etree.ElementTree import ParseError, XMLPullParser
+
+import braintree
+from braintree.util.http import Http
+from braintree.util.xml_util import XmlUtil
+
+TRANSACTION_FIELDS = (
+    'id',
+    'type',
+    'status',
+    'amount',
+    'currency_iso_code',
+    'merchant_account_id',
+    'order_id',
+    'created_at',
+    'updated_at',
+)
+TRANSACTIONS_ROOT = 'credit-card-transactions'
+CHUNK_SIZE = 64 * 1024
+# RawXmlHttp builds requests the way this major version of the SDK does
+SDK_MAJOR_VERSION = '4'
+
+if braintree.version.Version.split('.')[0] != SDK_MAJOR_VERSION:
+    raise ImportError(f'prose.fast_xml supports braintree {SDK_MAJOR_VERSION}.x, not {braintree.version.Version}')
+
+
+class NotACollectionError(ValueError):
+    pass
+
+
+class RawXmlHttp:
+    """
+    POST to the XML API through the gateway's HTTP strategy, as ``braintree.util.http.Http`` does, handing the response
+    body back unparsed.
+    """
+
+    def __init__(self, config):
+        self.config = config
+
+    def _headers(self) -> dict:
+        config = self.config
+        if config.has_client_credentials():
+            authorization = 'Basic ' + b64encode(f'{config.client_id}:{config.client_secret}'.encode('ascii')).decode('ascii')
+        elif config.has_access_token():
+            authorization = 'Bearer ' + config.access_token
+        else:
+            authorization = 'Basic ' + b64encode(f'{config.public_key}:{config.private_key}'.encode('ascii')).decode('ascii')
+        return {
+            'Accept': 'application/xml',
+            'Authorization': authorization,
+            'User-Agent': 'Braintree Python ' + braintree.version.Version,
+            'Accept-Encoding': 'gzip',
+            'X-ApiVersion': braintree.Configuration.api_version(),
+            'Content-type': Http.ContentType.Xml,
+        }
+
+    def post(self, path, params=None) -> str:
+        http_strategy = self.config.http_strategy()
+        request_body = XmlUtil.xml_from_dict(params) if params else ''
+        try:
+            status, response_body = http_strategy.http_do('POST', self.config.base_url() + path, self._headers(), request_body)
+        except Exception as err:
+            if not self.config.wrap_http_exceptions:
+                raise
+            http_strategy.handle_exception(err)
+        if Http.is_error_status(status):
+            Http.raise_exception_from_status(status)
+        return response_body
+
+
+def _text(element):
+    if element is None or element.get('nil') == 'true':
+        return None
+    return element.text or ''
+
+
+def _key(element) -> str:
+    # The gateway dasherizes tag names, braintree.util.xml_util and the fake gateway do not
+    return element.tag.replace('-', '_')
+
+
+def _transaction(element) -> dict:
+    transaction = dict.fromkeys(TRANSACTION_FIELDS)
+    transaction['customer'] = transaction['paypal'] = None
+    for child in element:
+        key = _key(child)
+        if key in transaction:
+            if key == 'customer':
+                transaction[key] = {'id': next((_text(item) for item in child if item.tag == 'id'), None)}
+            elif key == 'paypal':
+                transaction[key] = {_key(item): _text(item) for item in child}
+            else:
+                transaction[key] = _text(child)
+    if transaction['amount'] is not None:
+        transaction['amount'] = Decimal(transaction['amount'])
+    for key in ('created_at', 'updated_at'):
+        if transaction[key]:
+            # Naive UTC, like braintree's parser
+            transaction[key] = datetime.fromisoformat(transaction[key].rstrip('Z'))
+    return transaction
+
+
+def iter_transactions(xml):
+    """
+    Yield the transactions of a search response as dicts of the selected fields.
+
+    Raise ``NotACollectionError`` if ``xml`` is not a transaction collection, as when the gateway timed out the search.
+    Malformed documents and field values raise the ``ParseError``, ``ValueError`` or ``decimal.InvalidOperation`` of
+    their parsers.
+    """
+    parser = XMLPullParser(events=('start', 'end'))
+    depth = 0
+    root_seen = False
+    for start in range(0, len(xml), CHUNK_SIZE):
+        parser.feed(xml[start : start + CHUNK_SIZE])
+        for event, element in parser.read_events():
+            if event == 'start':
+                if depth == 0 and element.tag != TRANSACTIONS_ROOT:
+                    raise NotACollectionError(f'Expected a {TRANSACTIONS_ROOT} response, got {element.tag}')
+                root_seen = True
+                depth += 1
+                continue
+            depth -= 1
+            if depth == 1 and element.tag == 'transaction':
+                yield _transaction(element)
+                element.clear()
+    try:
+        parser.close()
+    except ParseError as err:
+        if root_seen:
+            raise
+        raise NotACollectionError(f'Expected a {TRANSACTIONS_ROOT} response') from err
+
+
+def parse_transactions(xml) -> 'list[dict]':
+    return list(iter_transactions(xml))
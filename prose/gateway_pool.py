@@ -0,0 +1,126 @@
+import hashlib
+import threading
+import time
+from contextvars import ContextVar
+from functools import partial
+
+import braintree
+import requests
+from braintree.environment import Environment
+from braintree.util.http import Http
+
+DEFAULT_POOL_SIZE = 10
+DEFAULT_TIMEOUT = 60
+
+# Overrides the configured timeout of the gateway calls made in the current context
+request_timeout = ContextVar('request_timeout', default=None)
+# Called with the duration of each gateway response received in the current context
+request_latency_observer = ContextVar('request_latency_observer', default=None)
+
+
+class PooledHttp(Http):
+    """
+    Braintree HTTP strategy sharing one keep-alive ``requests.Session`` across calls.
+
+    The stock ``Http.http_do`` opens a new session (and so a new TCP/TLS connection) for every request.
+    """
+
+    def __init__(self, config, environment=None, pool_size=DEFAULT_POOL_SIZE):
+        super().__init__(config, environment)
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session = requests.Session()
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+        # Same proxy workaround as braintree.util.http.Http, see https://github.com/psf/requests/issues/5677
+        self.session.proxies.update(requests.utils.getproxies())
+        if self.config.environment == Environment.Development:
+            self.verify = False
+        else:
+            self.verify = self.environment.ssl_certificate or True
+
+    def http_do(self, http_verb, path, headers, request_body):
+        data = request_body
+        files = None
+        if type(request_body) is tuple:
+            data, files = request_body
+
+        # Http._make_request always hands us the full url
+        request = requests.Request(method=http_verb, url=path, headers=headers, data=data, files=files)
+        prepared_request = self.session.prepare_request(request)
+        prepared_request.url = path
+        timeout = request_timeout.get() or self.config.timeout
+        started_at = time.perf_counter()
+        response = self.session.send(prepared_request, verify=self.verify, timeout=timeout)
+        observer = request_latency_observer.get()
+        if observer is not None:
+            observer(time.perf_counter() - started_at)
+        return [response.status_code, response.text]
+
+    def close(self):
+        self.session.close()
+
+
+class GatewayRegistry:
+    """
+    Process-wide registry handing out one shared, pooled ``BraintreeGateway`` per merchant credentials/environment.
+    """
+
+    def __init__(self):
+        self._gateways = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _key(environment, merchant_id, public_key, private_key):
+        private_key_digest = hashlib.sha256(private_key.encode()).hexdigest()
+        return environment.base_url, merchant_id, public_key, private_key_digest
+
+    def get_gateway(
+        self,
+        environment,
+        merchant_id,
+        public_key,
+        private_key,
+        pool_size=DEFAULT_POOL_SIZE,
+        timeout=DEFAULT_TIMEOUT,
+    ) -> 'braintree.BraintreeGateway':
+        """
+        Return the shared gateway for these credentials, creating it on first use.
+
+        ``pool_size`` and ``timeout`` only apply when the gateway is created.
+        """
+        environment = Environment.parse_environment(environment)
+        key = self._key(environment, merchant_id, public_key, private_key)
+        gateway = self._gateways.get(key)
+        if gateway is not None:
+            return gateway
+        with self._lock:
+            gateway = self._gateways.get(key)
+            if gateway is None:
+                gateway = braintree.BraintreeGateway(
+                    braintree.Configuration(
+                        environment=environment,
+                        merchant_id=merchant_id,
+                        public_key=public_key,
+                        private_key=private_key,
+                        http_strategy=partial(PooledHttp, pool_size=pool_size),
+                        timeout=timeout,
+                    )
+                )
+                self._gateways[key] = gateway
+        return gateway
+
+    def clear(self):
+        with self._lock:
+            gateways, self._gateways = self._gateways, {}
+        for gateway in gateways.values():
+            gateway.config.http_strategy().close()
+
+    def __len__(self):
+        return len(self._gateways)
+
+
+gateway_registry = GatewayRegistry()
+
+
+def get_gateway(environment, merchant_id, public_key, private_key, **kwargs) -> 'braintree.BraintreeGateway':
+    return gateway_registry.get_gateway(environment, merchant_id, public_key, private_key, **kwargs)
@@ -0,0 +1,195 @@
+"""
+Local ledgers of BraintreeClient payment operations, persisted in the SQLite database of the Django ``DATABASES`` setting.
+"""
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+
+from prose.caching import LocMemStorage
+
+# A claim older than this is considered left behind by a crashed worker and can be taken over
+DEFAULT_CLAIM_TTL = 10 * 60
+DEFAULT_WAIT_TIMEOUT = 60
+POLL_INTERVAL = 0.05
+DEFAULT_MAX_CACHED_ORDERS = 10_000
+
+
+class OrderInProgressError(Exception):
+    pass
+
+
+def sqlite_database_path(alias='default'):
+    database = settings.DATABASES[alias]
+    if not database['ENGINE'].endswith('sqlite3'):
+        raise ImproperlyConfigured(f'DATABASES[{alias!r}] must be a SQLite database')
+    return str(database['NAME'])
+
+
+class SqliteStore:
+    """A dedicated autocommit connection, shareable between threads, on the SQLite database."""
+
+    schema = ()
+
+    def __init__(self, database=None, alias='default'):
+        self.database = str(database or sqlite_database_path(alias))
+        self._connection = sqlite3.connect(self.database, timeout=30, isolation_level=None, check_same_thread=False)
+        self._connection_lock = threading.Lock()
+        for statement in self.schema:
+            self._execute(statement)
+
+    def _execute(self, sql, params=()):
+        with self._connection_lock:
+            cursor = self._connection.execute(sql, params)
+            return cursor.rowcount, cursor.fetchall()
+
+    def close(self):
+        self._connection.close()
+
+
+class IdempotencyLedger(SqliteStore):
+    """
+    Transaction ids of successful sales keyed by ``order_id``.
+
+    The ``max_cached_orders`` most recently used settled orders are answered from memory, the others from the table.
+    Concurrent submissions of an order wait on a per-order lock within the process, and on a claim row across processes,
+    so only one sale reaches the gateway.
+    """
+
+    schema = (
+        'CREATE TABLE IF NOT EXISTS braintree_idempotency ('
+        'order_id TEXT PRIMARY KEY, transaction_id TEXT, claimed_at REAL NOT NULL)',
+    )
+
+    def __init__(
+        self,
+        database=None,
+        alias='default',
+        claim_ttl=DEFAULT_CLAIM_TTL,
+        wait_timeout=DEFAULT_WAIT_TIMEOUT,
+        max_cached_orders=DEFAULT_MAX_CACHED_ORDERS,
+    ):
+        super().__init__(database=database, alias=alias)
+        self.claim_ttl = claim_ttl
+        self.wait_timeout = wait_timeout
+        self.hits = 0
+        self._transaction_ids = LocMemStorage(max_entries=max_cached_orders)
+        self._order_locks = {}
+        self._order_locks_lock = threading.Lock()
+
+    def get(self, order_id) -> str:
+        transaction_id = self._transaction_ids.get(order_id)
+        if transaction_id is None:
+            _rowcount, rows = self._execute('SELECT transaction_id FROM braintree_idempotency WHERE order_id = ?', (order_id,))
+            transaction_id = rows[0][0] if rows else None
+            if transaction_id is not None:
+                self._transaction_ids.set(order_id, transaction_id)
+        return transaction_id
+
+    @contextmanager
+    def _order_lock(self, order_id):
+        with self._order_locks_lock:
+            lock_and_waiters = self._order_locks.setdefault(order_id, [threading.Lock(), 0])
+            lock_and_waiters[1] += 1
+        try:
+            with lock_and_waiters[0]:
+                yield
+        finally:
+            with self._order_locks_lock:
+                lock_and_waiters[1] -= 1
+                if lock_and_waiters[1] == 0:
+                    del self._order_locks[order_id]
+
+    def _claim(self, order_id):
+        """Claim the order for this process, or return the transaction id once another process recorded it."""
+        deadline = time.monotonic() + self.wait_timeout
+        while True:
+            now = time.time()
+            rowcount, _rows = self._execute(
+                'INSERT INTO braintree_idempotency (order_id, transaction_id, claimed_at) VALUES (?, NULL, ?) '
+                'ON CONFLICT (order_id) DO UPDATE SET claimed_at = excluded.claimed_at '
+                'WHERE transaction_id IS NULL AND claimed_at < ?',
+                (order_id, now, now - self.claim_ttl),
+            )
+            if rowcount:
+                return None
+            transaction_id = self.get(order_id)
+            if transaction_id is not None:
+                return transaction_id
+            if time.monotonic() > deadline:
+                raise OrderInProgressError(f'Payment for order {order_id} is already in progress')
+            time.sleep(POLL_INTERVAL)
+
+    def run_once(self, order_id, sale) -> str:
+        """
+        Return the transaction id recorded for ``order_id``, or call ``sale()`` and record the id it returns.
+
+        A failed sale releases the order so it can be retried.
+        """
+        transaction_id = self._transaction_ids.get(order_id)
+        if transaction_id is not None:
+            self.hits += 1
+            return transaction_id
+        with self._order_lock(order_id):
+            transaction_id = self._claim(order_id)
+            if transaction_id is not None:
+                self.hits += 1
+                return transaction_id
+            try:
+                transaction_id = sale()
+            except BaseException:
+                self._execute('DELETE FROM braintree_idempotency WHERE order_id = ? AND transaction_id IS NULL', (order_id,))
+                raise
+            self._execute('UPDATE braintree_idempotency SET transaction_id = ? WHERE order_id = ?', (transaction_id, order_id))
+            self._transaction_ids.set(order_id, transaction_id)
+            return transaction_id
+
+
+class ResaleLedger(SqliteStore):
+    """
+    Partial refunds of unsettled transactions, recorded as the voided original and the sale replacing it, or as the
+    voided original and the amount left to charge when that sale failed.
+    """
+
+    schema = (
+        'CREATE TABLE IF NOT EXISTS braintree_resale ('
+        'original_transaction_id TEXT PRIMARY KEY, resale_transaction_id TEXT NOT NULL, '
+        'refunded_amount TEXT NOT NULL, created_at REAL NOT NULL)',
+        'CREATE TABLE IF NOT EXISTS braintree_failed_resale ('
+        'original_transaction_id TEXT PRIMARY KEY, amount TEXT NOT NULL, refunded_amount TEXT NOT NULL, '
+        'error TEXT, created_at REAL NOT NULL)',
+    )
+
+    def get(self, original_transaction_id) -> str:
+        _rowcount, rows = self._execute(
+            'SELECT resale_transaction_id FROM braintree_resale WHERE original_transaction_id = ?', (original_transaction_id,)
+        )
+        return rows[0][0] if rows else None
+
+    def record(self, original_transaction_id, resale_transaction_id, refunded_amount):
+        self._execute(
+            'INSERT INTO braintree_resale (original_transaction_id, resale_transaction_id, refunded_amount, created_at) '
+            'VALUES (?, ?, ?, ?)',
+            (original_transaction_id, resale_transaction_id, str(refunded_amount), time.time()),
+        )
+
+    def record_failure(self, original_transaction_id, amount, refunded_amount, error):
+        """Record that ``original_transaction_id`` was voided but ``amount`` could not be charged in its place."""
+        self._execute(
+            'INSERT OR REPLACE INTO braintree_failed_resale '
+            '(original_transaction_id, amount, refunded_amount, error, created_at) VALUES (?, ?, ?, ?, ?)',
+            (original_transaction_id, str(amount), str(refunded_amount), error, time.time()),
+        )
+
+    def failures(self) -> 'list[dict]':
+        """Failed resales to reconcile, oldest first."""
+        _rowcount, rows = self._execute(
+            'SELECT original_transaction_id, amount, refunded_amount, error FROM braintree_failed_resale ORDER BY created_at'
+        )
+        return [
+            {'original_transaction_id': original_id, 'amount': amount, 'refunded_amount': refunded_amount, 'error': error}
+            for original_id, amount, refunded_amount, error in rows
+        ]
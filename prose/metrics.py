@@ -0,0 +1,177 @@
+"""
+Latency, outcome and concurrency metrics of BraintreeClient methods.
+
+    metrics = ClientMetrics(sink=PrometheusTextSink('/var/lib/node_exporter/braintree.prom'))
+    client = BraintreeClient(metrics=metrics)
+    ...
+    metrics.export()
+
+Methods decorated with ``instrumented`` only pay for an attribute lookup when the client has no metrics.
+"""
+import functools
+import os
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+
+# Each power of two is split in 2 ** SUB_BUCKET_BITS buckets, keeping values within about 3% of what was recorded
+SUB_BUCKET_BITS = 5
+SUB_BUCKET_COUNT = 1 << SUB_BUCKET_BITS
+# Latencies are recorded in microseconds
+UNIT = 1_000_000
+QUANTILES = (0.5, 0.9, 0.99, 0.999)
+
+
+class LatencyHistogram:
+    """Log-linear histogram in the manner of HdrHistogram, with exact buckets below 2 * SUB_BUCKET_COUNT microseconds."""
+
+    def __init__(self):
+        self.counts = []
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    @staticmethod
+    def _index(value) -> int:
+        if value < 2 * SUB_BUCKET_COUNT:
+            return value
+        shift = value.bit_length() - SUB_BUCKET_BITS - 1
+        return 2 * SUB_BUCKET_COUNT + (shift - 1) * SUB_BUCKET_COUNT + (value >> shift) - SUB_BUCKET_COUNT
+
+    @staticmethod
+    def _highest_value(index) -> int:
+        if index < 2 * SUB_BUCKET_COUNT:
+            return index
+        shift, sub_bucket = divmod(index - 2 * SUB_BUCKET_COUNT, SUB_BUCKET_COUNT)
+        return ((sub_bucket + SUB_BUCKET_COUNT + 1) << (shift + 1)) - 1
+
+    def record(self, seconds):
+        index = self._index(max(int(seconds * UNIT), 0))
+        if index >= len(self.counts):
+            self.counts.extend([0] * (index + 1 - len(self.counts)))
+        self.counts[index] += 1
+        self.count += 1
+        self.total += seconds
+        self.max = max(self.max, seconds)
+
+    def percentile(self, quantile) -> float:
+        """Highest latency, in seconds, of the bucket holding the ``quantile`` of the recorded values."""
+        if not self.count:
+            return 0.0
+        rank = max(1, round(quantile * self.count))
+        seen = 0
+        for index, count in enumerate(self.counts):
+            seen += count
+            if seen >= rank:
+                return min(self._highest_value(index) / UNIT, self.max)
+        return self.max
+
+
+class ClientMetrics:
+    def __init__(self, sink=None, clock=time.perf_counter):
+        self.sink = sink
+        self.clock = clock
+        self.latencies = defaultdict(LatencyHistogram)
+        # (method, error class, error code) -> calls, with an empty error class for successful calls
+        self.outcomes = defaultdict(int)
+        self.in_flight = defaultdict(int)
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def observe(self, method):
+        with self._lock:
+            self.in_flight[method] += 1
+        started_at = self.clock()
+        outcome = (method, '', '')
+        try:
+            yield
+        except Exception as err:
+            outcome = (method, type(err).__name__, str(getattr(err, 'code', None) or ''))
+            raise
+        finally:
+            latency = self.clock() - started_at
+            with self._lock:
+                self.in_flight[method] -= 1
+                self.latencies[method].record(latency)
+                self.outcomes[outcome] += 1
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            return {
+                method: {
+                    'count': histogram.count,
+                    'errors': sum(calls for (name, error, _code), calls in self.outcomes.items() if name == method and error),
+                    'in_flight': self.in_flight[method],
+                    'mean': histogram.total / histogram.count if histogram.count else 0.0,
+                    'max': histogram.max,
+                    **{f'p{quantile * 100:g}': histogram.percentile(quantile) for quantile in QUANTILES},
+                }
+                for method, histogram in self.latencies.items()
+            }
+
+    def render_prometheus(self, prefix='braintree_client') -> str:
+        lines = [
+            f'# HELP {prefix}_request_duration_seconds Latency of BraintreeClient calls.',
+            f'# TYPE {prefix}_request_duration_seconds summary',
+        ]
+        with self._lock:
+            for method, histogram in sorted(self.latencies.items()):
+                for quantile in QUANTILES:
+                    labels = f'method="{method}",quantile="{quantile}"'
+                    lines.append(f'{prefix}_request_duration_seconds{{{labels}}} {histogram.percentile(quantile)}')
+                lines.append(f'{prefix}_request_duration_seconds_sum{{method="{method}"}} {histogram.total}')
+                lines.append(f'{prefix}_request_duration_seconds_count{{method="{method}"}} {histogram.count}')
+            lines.append(f'# HELP {prefix}_requests_total BraintreeClient calls by outcome.')
+            lines.append(f'# TYPE {prefix}_requests_total counter')
+            for (method, error, code), calls in sorted(self.outcomes.items()):
+                lines.append(f'{prefix}_requests_total{{method="{method}",error="{error}",code="{code}"}} {calls}')
+            lines.append(f'# HELP {prefix}_requests_in_flight BraintreeClient calls in progress.')
+            lines.append(f'# TYPE {prefix}_requests_in_flight gauge')
+            for method, in_flight in sorted(self.in_flight.items()):
+                lines.append(f'{prefix}_requests_in_flight{{method="{method}"}} {in_flight}')
+        return '\n'.join(lines) + '\n'
+
+    def export(self):
+        if self.sink is not None:
+            self.sink.export(self)
+
+
+class PrometheusTextSink:
+    """Write the metrics in the Prometheus text format to ``path``, for the node_exporter textfile collector."""
+
+    def __init__(self, path, prefix='braintree_client'):
+        self.path = path
+        self.prefix = prefix
+
+    def export(self, metrics):
+        tmp_path = f'{self.path}.tmp'
+        with open(tmp_path, 'w') as metrics_file:
+            metrics_file.write(metrics.render_prometheus(self.prefix))
+        os.replace(tmp_path, self.path)
+
+
+class CallbackSink:
+    """Hand a ``ClientMetrics.snapshot()`` to ``callback``."""
+
+    def __init__(self, callback):
+        self.callback = callback
+
+    def export(self, metrics):
+        self.callback(metrics.snapshot())
+
+
+def instrumented(method):
+    """Record calls of the decorated method in the ``metrics`` of its instance, when it has some."""
+
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(self, *args, **kwargs):
+            if self.metrics is None:
+                return func(self, *args, **kwargs)
+            with self.metrics.observe(method):
+                return func(self, *args, **kwargs)
+
+        return wrapper
+
+    return decorator
@@ -0,0 +1,32 @@
+"""
+Conversion of currency amounts to and from integer minor units (cents, or yen for zero-decimal currencies).
+"""
+from decimal import Decimal
+
+# ISO 4217 minor unit exponents other than the usual 2
+CURRENCY_EXPONENTS = {
+    **dict.fromkeys(
+        ('BIF', 'CLP', 'DJF', 'GNF', 'ISK', 'JPY', 'KMF', 'KRW', 'PYG', 'RWF', 'UGX', 'UYI', 'VND', 'VUV', 'XAF', 'XOF', 'XPF'),
+        0,
+    ),
+    **dict.fromkeys(('BHD', 'IQD', 'JOD', 'KWD', 'LYD', 'OMR', 'TND'), 3),
+    **dict.fromkeys(('CLF', 'UYW'), 4),
+}
+DEFAULT_EXPONENT = 2
+
+
+def currency_exponent(currency) -> int:
+    return CURRENCY_EXPONENTS.get(currency.upper(), DEFAULT_EXPONENT)
+
+
+def to_minor_units(amount, currency) -> int:
+    """``amount`` in minor units of ``currency``, raising ValueError if it is more precise than those."""
+    scaled = (amount if isinstance(amount, Decimal) else Decimal(str(amount))).scaleb(currency_exponent(currency))
+    units = int(scaled)
+    if units != scaled:
+        raise ValueError(f'{amount} {currency} has more decimals than the currency allows')
+    return units
+
+
+def from_minor_units(units, currency) -> Decimal:
+    return Decimal(units).scaleb(-currency_exponent(currency))
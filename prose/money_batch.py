@@ -0,0 +1,127 @@
+"""
+Batches of amounts stored as int64 minor units with a parallel array of currency codes.
+
+    batch = MoneyBatch.from_pairs((transaction.amount, transaction.currency_iso_code) for transaction in transactions)
+    batch.totals()  # {'CAD': Money('40.00', 'CAD'), 'USD': Money('31.50', 'USD')}
+    batch == MoneyBatch.from_money(expected_amounts)
+
+Sums and comparisons run over the integer arrays, with numpy when it is installed, instead of over ``Money`` objects,
+which are only built on the way out. Sums that could overflow int64 are left to Python integers.
+"""
+from array import array
+from decimal import Decimal
+
+from money import Money
+
+from prose.minor_units import currency_exponent, to_minor_units
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+INT64_MAX = 2**63 - 1
+
+
+class MoneyBatch:
+    """
+    ``units[i]`` minor units of ``currencies[codes[i]]``, for each ``i``.
+
+    ``units`` and ``codes`` can be any int64 and int32 buffers, such as the columns of a ``TransactionColumns`` file.
+    """
+
+    def __init__(self, units=None, codes=None, currencies=None):
+        self.units = array('q') if units is None else units
+        self.codes = array('i') if codes is None else codes
+        self.currencies = [] if currencies is None else list(currencies)
+        if len(self.units) != len(self.codes):
+            raise ValueError('units and codes must have the same length')
+        self._exponents = [currency_exponent(currency) for currency in self.currencies]
+        self._code_of = {currency: code for code, currency in enumerate(self.currencies)}
+
+    @classmethod
+    def from_pairs(cls, pairs) -> 'MoneyBatch':
+        """Batch of ``(amount, currency)`` pairs, raising ValueError for amounts more precise than their currency."""
+        batch = cls()
+        for amount, currency in pairs:
+            batch.append(amount, currency)
+        return batch
+
+    @classmethod
+    def from_money(cls, moneys) -> 'MoneyBatch':
+        return cls.from_pairs((money.amount, money.currency) for money in moneys)
+
+    def _code(self, currency) -> int:
+        code = self._code_of.get(currency)
+        if code is None:
+            code = self._code_of[currency] = len(self.currencies)
+            self.currencies.append(currency)
+            self._exponents.append(currency_exponent(currency))
+        return code
+
+    def append(self, amount, currency):
+        units = to_minor_units(amount, currency)
+        self.units.append(units)
+        self.codes.append(self._code(currency))
+
+    def __len__(self):
+        return len(self.units)
+
+    def _money(self, units, code) -> 'Money':
+        return Money(Decimal(units).scaleb(-self._exponents[code]), self.currencies[code])
+
+    def __getitem__(self, index) -> 'Money':
+        return self._money(self.units[index], self.codes[index])
+
+    def __iter__(self):
+        return map(self._money, self.units, self.codes)
+
+    def to_money(self) -> 'list[Money]':
+        return list(self)
+
+    def __repr__(self):
+        return f'MoneyBatch({[f"{money.amount} {money.currency}" for money in self]})'
+
+    def __eq__(self, other):
+        """Equal when both batches hold the same amounts in the same currencies, in the same order."""
+        if not isinstance(other, MoneyBatch):
+            return NotImplemented
+        if len(self) != len(other):
+            return False
+        if self.currencies == other.currencies:
+            codes_equal = self._arrays_equal(self.codes, other.codes)
+        else:
+            codes_equal = [self.currencies[code] for code in self.codes] == [other.currencies[code] for code in other.codes]
+        return codes_equal and self._arrays_equal(self.units, other.units)
+
+    @staticmethod
+    def _arrays_equal(left, right) -> bool:
+        if numpy is not None:
+            return bool(numpy.array_equal(numpy.asarray(left), numpy.asarray(right)))
+        return memoryview(left) == memoryview(right)
+
+    def _sums(self) -> 'dict[int, int]':
+        """Minor units per code of the currencies present."""
+        if numpy is not None and len(self):
+            units = numpy.asarray(self.units, dtype=numpy.int64)
+            # numpy sums wrap around silently, only use them when no sum can leave int64
+            if max(-int(units.min()), int(units.max())) * len(units) <= INT64_MAX:
+                codes = numpy.asarray(self.codes)
+                return {code: int(units[codes == code].sum()) for code in numpy.unique(codes).tolist()}
+        if len(self.currencies) == 1 and len(self):
+            return {0: sum(self.units)}
+        sums = {}
+        for units, code in zip(self.units, self.codes):
+            sums[code] = sums.get(code, 0) + units
+        return sums
+
+    def totals(self) -> 'dict[str, Money]':
+        """Sum of the amounts per currency."""
+        return {self.currencies[code]: self._money(units, code) for code, units in sorted(self._sums().items())}
+
+    def sum(self) -> 'Money':
+        """Sum of the amounts, which must share one currency."""
+        totals = self.totals()
+        if len(totals) != 1:
+            raise ValueError(f'Cannot sum amounts in {len(totals)} currencies into one')
+        return next(iter(totals.values()))
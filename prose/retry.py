@@ -0,0 +1,112 @@
+"""
+Retries of gateway calls.
+
+Transient errors are raised before the gateway acted on the request, so any call can be retried after them. Ambiguous
+errors (read timeouts, dropped connections, 5xx responses) may come after the request was processed: only idempotent
+calls, such as reads or sales guarded by an ``order_id``, are retried after those.
+"""
+import random
+import threading
+import time
+
+import braintree
+import requests
+from braintree.exceptions.http.connection_error import ConnectionError as GatewayConnectionError
+from braintree.exceptions.http.timeout_error import ConnectTimeoutError
+from braintree.exceptions.http.timeout_error import TimeoutError as GatewayTimeoutError
+
+DEFAULT_ATTEMPTS = 3
+DEFAULT_BACKOFF = 0.5
+DEFAULT_MAX_BACKOFF = 5
+DEFAULT_RETRY_RATIO = 0.1
+DEFAULT_MAX_RETRY_TOKENS = 10
+
+TRANSIENT_ERRORS = (
+    braintree.exceptions.TooManyRequestsError,
+    braintree.exceptions.ServiceUnavailableError,
+    ConnectTimeoutError,
+    requests.exceptions.ConnectTimeout,
+)
+AMBIGUOUS_ERRORS = (
+    braintree.exceptions.ServerError,
+    braintree.exceptions.GatewayTimeoutError,
+    braintree.exceptions.RequestTimeoutError,
+    GatewayConnectionError,
+    GatewayTimeoutError,
+    requests.exceptions.ConnectionError,
+    requests.exceptions.Timeout,
+)
+
+
+def is_transient(err) -> bool:
+    return isinstance(err, TRANSIENT_ERRORS)
+
+
+def is_retryable(err, idempotent=False) -> bool:
+    return is_transient(err) or (idempotent and isinstance(err, AMBIGUOUS_ERRORS))
+
+
+class RetryBudget:
+    """
+    Retries allowed as a share of calls: each call earns ``ratio`` of a retry, up to ``max_tokens`` saved.
+
+    During an outage the savings run out and calls fail on their first error, instead of multiplying the load.
+    """
+
+    def __init__(self, ratio=DEFAULT_RETRY_RATIO, max_tokens=DEFAULT_MAX_RETRY_TOKENS):
+        self.ratio = ratio
+        self.max_tokens = max_tokens
+        self.tokens = max_tokens
+        self.exhausted = 0
+        self._lock = threading.Lock()
+
+    def deposit(self):
+        with self._lock:
+            self.tokens = min(self.max_tokens, self.tokens + self.ratio)
+
+    def withdraw(self) -> bool:
+        with self._lock:
+            if self.tokens < 1:
+                self.exhausted += 1
+                return False
+            self.tokens -= 1
+            return True
+
+
+class RetryPolicy:
+    """
+    Exponential backoff with full jitter: retry ``n`` waits a random time up to ``backoff * 2 ** (n - 1)``, capped at
+    ``max_backoff``. Share one policy, and so one budget, between the clients of a process.
+    """
+
+    def __init__(
+        self,
+        attempts=DEFAULT_ATTEMPTS,
+        backoff=DEFAULT_BACKOFF,
+        max_backoff=DEFAULT_MAX_BACKOFF,
+        budget=None,
+        sleep=time.sleep,
+        jitter=random.random,
+    ):
+        self.attempts = attempts
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.budget = RetryBudget() if budget is None else budget
+        self.sleep = sleep
+        self.jitter = jitter
+        self.retries = 0
+
+    def delay(self, retry) -> float:
+        return self.jitter() * min(self.max_backoff, self.backoff * 2 ** (retry - 1))
+
+    def call(self, func, idempotent=False):
+        """Call ``func``, retrying after transient errors, and after ambiguous ones too if it is ``idempotent``."""
+        self.budget.deposit()
+        for attempt in range(1, self.attempts + 1):
+            try:
+                return func()
+            except Exception as err:
+                if attempt == self.attempts or not is_retryable(err, idempotent) or not self.budget.withdraw():
+                    raise
+            self.retries += 1
+            self.sleep(self.delay(attempt))
@@ -0,0 +1,79 @@
+"""
+Merchant account routing of sales by currency, with region and card brand overrides.
+
+    router = MerchantAccountRouter.from_config({
+        'currencies': {'USD': 'prose-usd', 'CAD': 'prose-cad'},
+        'regions': {'QC': {'CAD': 'prose-cad-qc'}},
+        'card_brands': {'American Express': {'USD': 'prose-usd-amex'}},
+    })
+    router.resolve('USD', card_brand='American Express')  # 'prose-usd-amex'
+
+A card brand override wins over a region one, which wins over the currency account. Every combination of configured
+currency, region and card brand is resolved when the router is built, so ``resolve`` is a single dict lookup.
+
+``default_router`` builds the router from the ``BRAINTREE_MERCHANT_ACCOUNTS`` Django setting, in the same format, so
+each environment can configure its merchant accounts.
+"""
+import itertools
+from types import MappingProxyType
+
+from django.conf import settings
+
+MERCHANT_ACCOUNTS_SETTING = 'BRAINTREE_MERCHANT_ACCOUNTS'
+
+
+class NoMerchantAccountError(Exception):
+    pass
+
+
+class MerchantAccountRouter:
+    def __init__(self, currencies, regions=None, card_brands=None):
+        currencies = {currency.upper(): account for currency, account in currencies.items()}
+        regions = {region: {c.upper(): a for c, a in accounts.items()} for region, accounts in (regions or {}).items()}
+        card_brands = {brand: {c.upper(): a for c, a in accounts.items()} for brand, accounts in (card_brands or {}).items()}
+        self._regions = frozenset(regions)
+        self._card_brands = frozenset(card_brands)
+        table = {}
+        all_currencies = set(currencies).union(*regions.values(), *card_brands.values())
+        for currency, region, card_brand in itertools.product(all_currencies, [None, *regions], [None, *card_brands]):
+            account = (
+                card_brands.get(card_brand, {}).get(currency)
+                or regions.get(region, {}).get(currency)
+                or currencies.get(currency)
+            )
+            if account is not None:
+                table[currency, region, card_brand] = account
+        self._table = MappingProxyType(table)
+
+    @classmethod
+    def from_config(cls, config) -> 'MerchantAccountRouter':
+        return cls(config['currencies'], regions=config.get('regions'), card_brands=config.get('card_brands'))
+
+    def resolve(self, currency, region=None, card_brand=None) -> str:
+        """Merchant account id of sales in ``currency``, made from ``region`` with a card of ``card_brand``."""
+        key = (
+            currency.upper(),
+            region if region in self._regions else None,
+            card_brand if card_brand in self._card_brands else None,
+        )
+        try:
+            return self._table[key]
+        except KeyError:
+            raise NoMerchantAccountError(f'No merchant account accepts {currency} payments') from None
+
+
+_default_router = (None, None)
+
+
+def default_router(fallback_config) -> 'MerchantAccountRouter':
+    """
+    The router of the ``BRAINTREE_MERCHANT_ACCOUNTS`` setting, or of ``fallback_config`` when it is not set, rebuilt
+    only when the setting changes.
+    """
+    global _default_router
+    config = getattr(settings, MERCHANT_ACCOUNTS_SETTING, None) or fallback_config
+    built_config, router = _default_router
+    if config is not built_config:
+        router = MerchantAccountRouter.from_config(config)
+        _default_router = (config, router)
+    return router
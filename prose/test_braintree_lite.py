@@ -1,25 +1,111 @@
+import asyncio
+import contextvars
+import copy
+import itertools
 import logging
-from dataclasses import dataclass
-from decimal import Decimal
+import math
+import os
+import sys
+import tempfile
+import threading
+from array import array
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, replace
+from datetime import datetime, timezone
+from decimal import Decimal, InvalidOperation
+from pathlib import Path
+from unittest import skipUnless
 from uuid import uuid4
 
 import braintree
+from braintree.resource import Resource
 from django.db import models
-from django.test import TestCase
+from django.test import SimpleTestCase, TestCase, override_settings
 from factory import Faker, LazyAttribute, Sequence, base
 from money import Money
 
+from prose.aio_transport import DEFAULT_MAX_CONCURRENCY, AsyncHttp
+from prose.bulk import DEFAULT_MAX_WORKERS, BulkStats, Checkpoint, RateLimiter, bounded_map, error_message
+from prose.caching import (
+    MISSING,
+    ClientTokenCache,
+    CustomerLookupCache,
+    DjangoCacheStorage,
+    LocMemStorage,
+    PaymentSourceInfoCache,
+    TransactionStatusCache,
+)
+from prose.cassette import Cassette, CassetteError
+from prose.circuit_breaker import CircuitBreaker, CircuitBreakers, guarded
+from prose.columnar import DICTIONARY_COLUMNS, TransactionColumns, export_transactions, numpy
+from prose.error_logging import RepeatedErrorFilter, log_error
+from prose.fake_gateway import FakeBraintreeGateway
+from prose.fast_xml import NotACollectionError, RawXmlHttp, parse_transactions
+from prose.gateway_pool import (
+    DEFAULT_POOL_SIZE,
+    DEFAULT_TIMEOUT,
+    GatewayRegistry,
+    PooledHttp,
+    get_gateway,
+    request_latency_observer,
+    request_timeout,
+)
+from prose.ledger import IdempotencyLedger, OrderInProgressError, ResaleLedger
+from prose.metrics import CallbackSink, ClientMetrics, LatencyHistogram, PrometheusTextSink, instrumented
+from prose.minor_units import from_minor_units, to_minor_units
+from prose import money_batch
+from prose.money_batch import MoneyBatch
+from prose.retry import RetryBudget, RetryPolicy
+from prose.routing import MerchantAccountRouter, NoMerchantAccountError, default_router
+
 logger = logging.getLogger(__name__)
 
+CASSETTES_DIR = Path(__file__).resolve().parent / 'cassettes'
+
+UNSETTLED_STATUSES = (
+    braintree.Transaction.Status.Authorized,
+    braintree.Transaction.Status.SubmittedForSettlement,
+    braintree.Transaction.Status.SettlementPending,
+)
+SETTLED_STATUSES = (braintree.Transaction.Status.Settled, braintree.Transaction.Status.Settling)
+# Transactions returned per advanced_search call
+SEARCH_PAGE_SIZE = 50
+
 
 class CURRENCY_MERCHANT_ACCOUNT_MAP:
     USD = 'prose-usd'
     CAD = 'prose-cad'
 
 
+# Merchant accounts used when the BRAINTREE_MERCHANT_ACCOUNTS setting is not set
+DEFAULT_MERCHANT_ACCOUNTS = {'currencies': {'USD': CURRENCY_MERCHANT_ACCOUNT_MAP.USD, 'CAD': CURRENCY_MERCHANT_ACCOUNT_MAP.CAD}}
+
+
 class PaymentClientError(Exception):
-    def __init__(self, message=None, user_message=None, *args, **kwargs):
+    def __init__(self, message=None, user_message=None, *args, code=None, **kwargs):
+        super().__init__(message, *args, **kwargs)
+        # Braintree validation error code, or processor response code of a declined transaction
+        self.code = code
+
+    @classmethod
+    def from_result(cls, result) -> 'PaymentClientError':
+        if result.errors.deep_errors:
+            code = result.errors.deep_errors[0].code
+        else:
+            code = getattr(result.transaction, 'processor_response_code', None)
+        return cls(message=result.message, code=code)
+
+
+class ResaleFailedError(PaymentClientError):
+    """
+    The sale of the remaining amount of a partial refund failed after its transaction was voided, leaving the order
+    uncharged until it is reconciled.
+    """
+
+    def __init__(self, message=None, *args, transaction_id=None, amount=None, **kwargs):
         super().__init__(message, *args, **kwargs)
+        self.transaction_id = transaction_id
+        self.amount = amount
 
 
 @dataclass
@@ -33,6 +119,76 @@ class DeletedObjectDataClass:
     id: str
     deleted: bool
     object: str
+    error: str = None
+
+
+@dataclass
+class RefundedObjectDataClass:
+    transaction_id: str
+    id: str
+    action: str
+    refunded: bool
+    error: str = None
+
+
+@dataclass
+class TransactionRecord:
+    """Projection of a braintree.Transaction small enough to hold millions of search results in memory."""
+
+    __slots__ = (
+        'id',
+        'type',
+        'status',
+        'amount',
+        'currency_iso_code',
+        'merchant_account_id',
+        'order_id',
+        'customer_id',
+        'created_at',
+        'updated_at',
+    )
+
+    id: str
+    type: str
+    status: str
+    amount: Decimal
+    currency_iso_code: str
+    merchant_account_id: str
+    order_id: str
+    customer_id: str
+    created_at: datetime
+    updated_at: datetime
+
+    @classmethod
+    def from_fields(cls, fields: dict) -> 'TransactionRecord':
+        """Build the record from a ``prose.fast_xml`` transaction dict."""
+        # Values with few distinct occurrences are shared between records
+        transaction_type, status, currency_iso_code, merchant_account_id = (
+            value and sys.intern(value)
+            for value in (fields['type'], fields['status'], fields['currency_iso_code'], fields['merchant_account_id'])
+        )
+        created_at, updated_at = fields['created_at'], fields['updated_at']
+        return cls(
+            id=fields['id'],
+            type=transaction_type,
+            status=status,
+            amount=fields['amount'],
+            currency_iso_code=currency_iso_code,
+            merchant_account_id=merchant_account_id,
+            order_id=fields['order_id'],
+            customer_id=fields['customer'] and fields['customer']['id'],
+            created_at=created_at,
+            updated_at=created_at if updated_at == created_at else updated_at,
+        )
+
+
+@dataclass
+class CreatedObjectDataClass:
+    index: int
+    id: str
+    created: bool
+    object: str
+    error: str = None
 
 
 class PaymentModes(models.TextChoices):
@@ -67,89 +223,695 @@ class CustomerFactory(base.Factory):
 
 
 class BraintreeClient:
-    def __init__(self):
-        self.gateway = braintree.BraintreeGateway(
-            braintree.Configuration(
-                environment=braintree.Environment.Sandbox,
-                merchant_id='znqjm7gc8nv6q3g9',
-                public_key='4y6mbj59fr3qyzb6',
-                private_key='0aa5ad759873dd453d3485cb962f4f7c',
-            )
+    def __init__(
+        self,
+        environment=None,
+        pool_size=DEFAULT_POOL_SIZE,
+        gateway=None,
+        token_cache: 'ClientTokenCache' = None,
+        customer_cache: 'CustomerLookupCache' = None,
+        idempotency_ledger: 'IdempotencyLedger' = None,
+        resale_ledger: 'ResaleLedger' = None,
+        status_cache: 'TransactionStatusCache' = None,
+        metrics: 'ClientMetrics' = None,
+        circuit_breakers: 'CircuitBreakers' = None,
+        retry_policy: 'RetryPolicy' = None,
+        payment_source_info_cache: 'PaymentSourceInfoCache' = None,
+        merchant_account_router: 'MerchantAccountRouter' = None,
+        fast_xml=False,
+    ):
+        # Gateways are shared process-wide so every client reuses the same keep-alive connection pool
+        self.gateway = gateway or get_gateway(
+            environment=environment or braintree.Environment.Sandbox,
+            merchant_id='znqjm7gc8nv6q3g9',
+            public_key='4y6mbj59fr3qyzb6',
+            private_key='0aa5ad759873dd453d3485cb962f4f7c',
+            pool_size=pool_size,
         )
+        self.token_cache = token_cache
+        self.customer_cache = customer_cache
+        self.idempotency_ledger = idempotency_ledger
+        self.resale_ledger = resale_ledger
+        self.status_cache = status_cache
+        self.metrics = metrics
+        self.circuit_breakers = circuit_breakers
+        self.retry_policy = retry_policy
+        self.payment_source_info_cache = payment_source_info_cache
+        self.merchant_account_router = merchant_account_router or default_router(DEFAULT_MERCHANT_ACCOUNTS)
+        # Parse search responses with prose.fast_xml where only its selected fields are read
+        self.fast_xml = fast_xml
+
+    def _call(self, func, *args, idempotent=False):
+        if self.retry_policy is None:
+            return func(*args)
+        return self.retry_policy.call(lambda: func(*args), idempotent=idempotent)
 
+    @instrumented('get_token')
+    @guarded('token', PaymentClientError)
     def get_token(self, customer_pubkey: str) -> str:
         try:
-            client_token = self.gateway.client_token.generate({'customer_id': str(customer_pubkey)})
+            params = {'customer_id': str(customer_pubkey)}
+            if self.token_cache is not None:
+                return self.token_cache.get_or_set(
+                    str(customer_pubkey), lambda: self._call(self.gateway.client_token.generate, params, idempotent=True)
+                )
+            client_token = self._call(self.gateway.client_token.generate, params, idempotent=True)
             return client_token
         except Exception as err:
-            logger.error(f'Error getting token: {str(err)}', extra={'err__dict': err.__dict__})
+            log_error(logger, 'Error getting token: %s', err)
             raise err
 
+    @instrumented('create_customer')
+    @guarded('customer', PaymentClientError)
     def create_customer(self, **kwargs) -> str:
         try:
-            result = self.gateway.customer.create(kwargs)
+            result = self._call(self.gateway.customer.create, kwargs)
+            if not result.is_success:
+                raise PaymentClientError.from_result(result)
+            if self.customer_cache is not None:
+                # Only once created, so a lookup racing the creation cannot cache the customer as not found again
+                self.customer_cache.invalidate(str(result.customer.id))
             return result.customer.id
         except Exception as err:
-            logger.error(f'Error creating customer: {str(err)}', extra={'err__dict': err.__dict__})
+            log_error(logger, 'Error creating customer: %s', err)
             raise err
 
+    def create_customers(self, payloads, max_workers=DEFAULT_MAX_WORKERS, checkpoint_path=None, checkpoint_every=100):
+        """
+        Create customers from an iterable of create_customer payloads, yielding a CreatedObjectDataClass per record in input order.
+
+        The input is streamed through a pool of ``max_workers`` threads. With ``checkpoint_path``, the number of records
+        processed is persisted so a rerun with the same input resumes after them; records that were in flight during a
+        crash are then reported as already taken.
+        """
+        checkpoint = Checkpoint(checkpoint_path, every=checkpoint_every) if checkpoint_path else None
+        records = itertools.islice(enumerate(payloads), checkpoint.position if checkpoint else 0, None)
+        results = bounded_map(lambda record: self.create_customer(**record[1]), records, max_workers=max_workers)
+        try:
+            for (index, payload), customer_id, error in results:
+                if checkpoint is not None:
+                    checkpoint.advance(index + 1)
+                yield CreatedObjectDataClass(
+                    index=index,
+                    id=customer_id or payload.get('id'),
+                    created=error is None,
+                    object='customer',
+                    error=error_message(error) if error else None,
+                )
+        finally:
+            results.close()
+            if checkpoint is not None:
+                checkpoint.save()
+
     def retrieve_customer(self, customer_id) -> str:
+        if self.customer_cache is not None:
+            cached_customer_id = self.customer_cache.get(str(customer_id), MISSING)
+            if cached_customer_id is not MISSING:
+                return cached_customer_id
         try:
-            braintree_customer = self.gateway.customer.find(customer_id)
+            braintree_customer = self._call(self.gateway.customer.find, customer_id, idempotent=True)
+            if self.customer_cache is not None:
+                self.customer_cache.set(str(customer_id), braintree_customer.id)
             return braintree_customer.id
         except Exception as err:
-            logger.warning(f'Error retrieving customer: {str(err)}', extra={'err__dict': err.__dict__})
+            log_error(logger, 'Error retrieving customer: %s', err, level=logging.WARNING)
+            if self.customer_cache is not None and isinstance(err, braintree.exceptions.NotFoundError):
+                self.customer_cache.set(str(customer_id), None)
         return None
 
+    def _invalidate_customer(self, customer_id):
+        if self.token_cache is not None:
+            self.token_cache.invalidate(str(customer_id))
+        if self.customer_cache is not None:
+            self.customer_cache.invalidate(str(customer_id))
+
+    @guarded('customer', PaymentClientError)
     def delete_customer(self, customer_id) -> 'DeletedObjectDataClass':
         try:
-            deleted_customer = self.gateway.customer.delete(customer_id)
+            try:
+                deleted_customer = self._call(self.gateway.customer.delete, customer_id)
+            except braintree.exceptions.NotFoundError:
+                # The customer is gone either way
+                self._invalidate_customer(customer_id)
+                raise
+            self._invalidate_customer(customer_id)
             return DeletedObjectDataClass(id=customer_id, deleted=deleted_customer.is_success, object='customer')
         except Exception as err:
-            logger.error(f'Error deleting customer: {str(err)}', extra={'err__dict': err.__dict__})
+            log_error(logger, 'Error deleting customer: %s', err)
             raise err
 
+    def delete_customers(self, customer_ids, max_workers=DEFAULT_MAX_WORKERS, rate_limit=None, stats: 'BulkStats' = None):
+        """
+        Delete customers concurrently, yielding a DeletedObjectDataClass per id in input order, failures included.
+
+        At most ``max_workers`` deletions run at once and, with ``rate_limit``, no more than that many start per second.
+        Pass a BulkStats to follow throughput and latency while the purge runs.
+        """
+        rate_limiter = RateLimiter(rate_limit, burst=max_workers) if rate_limit else None
+        results = bounded_map(self.delete_customer, customer_ids, max_workers=max_workers, rate_limiter=rate_limiter, stats=stats)
+        try:
+            for customer_id, deleted_customer, error in results:
+                if error is not None:
+                    deleted_customer = DeletedObjectDataClass(
+                        id=customer_id, deleted=False, object='customer', error=error_message(error)
+                    )
+                yield deleted_customer
+        finally:
+            results.close()
+
+    @staticmethod
+    def _search_criteria(query) -> dict:
+        criteria = {}
+        for term in query:
+            # Range terms on the same field, such as amount >= x and amount <= y, merge into one criterion
+            if criteria.get(term.name):
+                criteria[term.name] = dict(criteria[term.name], **term.to_param())
+            else:
+                criteria[term.name] = term.to_param()
+        return criteria
+
+    def _search_transactions_page(self, criteria: dict, ids, fast=False) -> 'list[dict]':
+        """
+        Raw attributes of the transactions among ``ids`` (at most a page of them) matching ``criteria``.
+
+        With ``fast``, the response is parsed by ``prose.fast_xml``, which only returns the fields it selects.
+        """
+        criteria = dict(criteria, ids=braintree.TransactionSearch.ids.in_list(ids).to_param())
+        path = self.gateway.config.base_merchant_path() + '/transactions/advanced_search'
+        if fast:
+            xml = self._call(RawXmlHttp(self.gateway.config).post, path, {'search': criteria}, idempotent=True)
+            try:
+                return parse_transactions(xml)
+            except NotACollectionError:
+                raise braintree.exceptions.RequestTimeoutError('search timeout')
+        response = self._call(self.gateway.config.http().post, path, {'search': criteria}, idempotent=True)
+        if 'credit_card_transactions' not in response:
+            raise braintree.exceptions.RequestTimeoutError('search timeout')
+        return braintree.ResourceCollection._extract_as_array(response['credit_card_transactions'], 'transaction')
+
+    def _fetch_transactions_page(self, criteria: dict, ids) -> 'list[braintree.Transaction]':
+        return [braintree.Transaction(self.gateway, item) for item in self._search_transactions_page(criteria, ids)]
+
+    def _fetch_transaction_records_page(self, criteria: dict, ids) -> 'list[TransactionRecord]':
+        return [TransactionRecord.from_fields(fields) for fields in self._search_transactions_page(criteria, ids, fast=True)]
+
+    def iter_transactions(self, *query):
+        """
+        Yield the transactions matching the TransactionSearch ``query`` terms, newest first.
+
+        Only the matching ids are fetched up front; transactions are then fetched a page at a time, the next page in
+        the background while the current one is consumed, so at most two pages are held in memory.
+        """
+        return self._iter_search(query, self._fetch_transactions_page)
+
+    def search_transaction_records(self, *query):
+        """
+        Yield a TransactionRecord per transaction matching the TransactionSearch ``query`` terms, newest first.
+
+        Pages are fetched as by ``iter_transactions`` and parsed by ``prose.fast_xml`` without building braintree
+        Transactions.
+        """
+        return self._iter_search(query, self._fetch_transaction_records_page)
+
+    def _iter_search(self, query, fetch_page):
+        criteria = self._search_criteria(query)
+        response = self._call(
+            self.gateway.config.http().post,
+            self.gateway.config.base_merchant_path() + '/transactions/advanced_search_ids',
+            {'search': criteria},
+            idempotent=True,
+        )
+        if 'search_results' not in response:
+            raise braintree.exceptions.RequestTimeoutError('search timeout')
+        ids, page_size = response['search_results']['ids'], int(response['search_results']['page_size'])
+        executor = ThreadPoolExecutor(max_workers=1)
+        try:
+            page = None
+            for start in range(0, len(ids), page_size):
+                # Copy the context so the fetch keeps the timeout of the caller's circuit breaker
+                next_page = executor.submit(contextvars.copy_context().run, fetch_page, criteria, ids[start : start + page_size])
+                if page is not None:
+                    yield from page.result()
+                page = next_page
+            if page is not None:
+                yield from page.result()
+        finally:
+            executor.shutdown(wait=True, cancel_futures=True)
+
+    @staticmethod
+    def _resale_options(original: 'braintree.Transaction', refund_amount: Decimal) -> dict:
+        """Options of the sale replacing ``original`` once ``refund_amount`` is refunded, or None for a full refund."""
+        remaining = original.amount - refund_amount
+        if remaining < 0:
+            raise PaymentClientError(message='Refund amount is too large.')
+        if remaining == 0:
+            return None
+        if not original.credit_card_details.token:
+            raise PaymentClientError(message=f'Transaction {original.id} has no vaulted payment method to charge the rest to')
+        return {
+            'amount': str(remaining),
+            'options': {'submit_for_settlement': original.status == braintree.Transaction.Status.SubmittedForSettlement},
+            'order_id': original.order_id,
+            'merchant_account_id': original.merchant_account_id,
+            'customer_id': original.customer_details.id,
+            'payment_method_token': original.credit_card_details.token,
+            'transaction_source': 'unscheduled',
+        }
+
+    @staticmethod
+    def _resale_failed(resale_ledger, transaction_id, sale_options, refund_amount, err) -> 'ResaleFailedError':
+        remaining, error = sale_options['amount'], error_message(err)
+        logger.error('Transaction %s was voided but the sale of the remaining %s failed: %s', transaction_id, remaining, error)
+        if resale_ledger is not None:
+            resale_ledger.record_failure(transaction_id, remaining, refund_amount, error)
+        return ResaleFailedError(
+            message=f'Transaction {transaction_id} was voided but the sale of the remaining {remaining} failed: {error}',
+            code=getattr(err, 'code', None),
+            transaction_id=transaction_id,
+            amount=Decimal(remaining),
+        )
+
+    def _void_and_resale(self, transaction_id, refund_amount: Decimal) -> str:
+        """
+        Partially refund an unsettled transaction: void it, then charge the remaining amount to its vaulted payment method.
+
+        The sale is only sent once the void went through, so the card is never authorized for both at once. A sale
+        failing after the void cannot be undone: it is recorded in the resale ledger and raised as a ResaleFailedError
+        for the order to be reconciled.
+        """
+        if self.resale_ledger is not None:
+            resale_id = self.resale_ledger.get(transaction_id)
+            if resale_id is not None:
+                return resale_id
+        original = self._call(self.gateway.transaction.find, transaction_id, idempotent=True)
+        sale_options = self._resale_options(original, refund_amount)
+        voided_id = self._void(transaction_id)
+        if sale_options is None:
+            return voided_id
+        try:
+            resale = self._call(self.gateway.transaction.sale, sale_options)
+            if not resale.is_success:
+                raise PaymentClientError.from_result(resale)
+        except Exception as err:
+            raise self._resale_failed(self.resale_ledger, transaction_id, sale_options, refund_amount, err) from err
+        self._record_status(resale.transaction)
+        if self.resale_ledger is not None:
+            self.resale_ledger.record(transaction_id, resale.transaction.id, refund_amount)
+        return resale.transaction.id
+
+    def _record_status(self, transaction):
+        if self.status_cache is not None:
+            self.status_cache.update(transaction.id, transaction.status)
+
+    def _void(self, transaction_id) -> str:
+        voided = self._call(self.gateway.transaction.void, transaction_id)
+        if voided.is_success is False:
+            raise PaymentClientError.from_result(voided)
+        self._record_status(voided.transaction)
+        return voided.transaction.id
+
+    def _cancel_unsettled(self, transaction_id, refund_amount) -> str:
+        if refund_amount:
+            return self._void_and_resale(transaction_id, Decimal(refund_amount))
+        return self._void(transaction_id)  # Full refund, void the transaction
+
+    @instrumented('refund_payment')
+    @guarded('refund', PaymentClientError)
     def refund_payment(self, refund_kwargs, order_total_price) -> str:
         try:
-            refund = self.gateway.transaction.refund(refund_kwargs['transaction_id'], refund_kwargs.get('refund_data'))
-            if refund.is_success is False and refund.errors.deep_errors and refund.errors.deep_errors[0].code == '91506':
-                if refund_kwargs.get('refund_data', {}).get('amount'):
-                    # A logic to void a transaction and create a new one with the new amount is needed
-                    logger.error('Trying to refund a partial amount for an authorized or submitted for settlement transaction')
-                    raise NotImplementedError('Refund for authorized and submitted for settlement transactions is not supported')
+            transaction_id = refund_kwargs['transaction_id']
+            refund_amount = (refund_kwargs.get('refund_data') or {}).get('amount')
+            if self.status_cache is not None and self.status_cache.get(transaction_id) in UNSETTLED_STATUSES:
+                # Unsettled transactions cannot be refunded, skip the refund call that would fail with 91506
+                try:
+                    cancelled_id = self._cancel_unsettled(transaction_id, refund_amount)
+                except ResaleFailedError:
+                    raise
+                except PaymentClientError:
+                    # The cached status may be stale, let the gateway decide
+                    self.status_cache.invalidate(transaction_id)
                 else:
-                    voided = self.gateway.transaction.void(refund_kwargs['transaction_id'])  # Full refund, void the transaction
-                    if voided.is_success is False:
-                        raise PaymentClientError(message=voided.message)
-                    return voided.transaction.id
+                    self.status_cache.count_round_trip_saved()
+                    return cancelled_id
+            refund = self._call(self.gateway.transaction.refund, transaction_id, refund_kwargs.get('refund_data'))
+            if refund.is_success is False and refund.errors.deep_errors and refund.errors.deep_errors[0].code == '91506':
+                return self._cancel_unsettled(transaction_id, refund_amount)
             return refund.transaction.id
         except Exception as e:
-            logger.error(f'Error refunding payment: {str(e)}', extra={'err__dict': e.__dict__})
+            log_error(logger, 'Error refunding payment: %s', e)
             raise e
 
-    def create_payment_mode(self, payment_source_id, payment_mode_kwargs: dict) -> str:
+    def _refund_actions(self, refund_kwargs_batch, chunk_size):
+        """Yield ``(refund_kwargs, action, status)`` per request, looking transaction statuses up ``chunk_size`` at a time."""
+        refund_kwargs_batch = iter(refund_kwargs_batch)
+        for chunk in iter(lambda: list(itertools.islice(refund_kwargs_batch, chunk_size)), []):
+            query = braintree.TransactionSearch.ids.in_list([refund_kwargs['transaction_id'] for refund_kwargs in chunk])
+            transactions = list(self.iter_transactions(query))
+            for transaction in transactions:
+                self._record_status(transaction)
+            statuses = {transaction.id: transaction.status for transaction in transactions}
+            actions = []
+            for refund_kwargs in chunk:
+                status = statuses.get(refund_kwargs['transaction_id'])
+                if status in UNSETTLED_STATUSES:
+                    action = 'resale' if (refund_kwargs.get('refund_data') or {}).get('amount') else 'void'
+                else:
+                    action = 'refund' if status in SETTLED_STATUSES else None
+                actions.append((refund_kwargs, action, status))
+            # Unsettled transactions only stay voidable until the next settlement batch, cancel them first
+            actions.sort(key=lambda item: item[1] == 'refund')
+            yield from actions
+
+    def _refund_by_action(self, refund_kwargs, action, status) -> str:
+        if action is None:
+            raise PaymentClientError(message=f'Transaction {refund_kwargs["transaction_id"]} cannot be refunded in status {status}')
+        return self._refund_or_cancel(refund_kwargs, action)
+
+    @guarded('refund', PaymentClientError)
+    def _refund_or_cancel(self, refund_kwargs, action) -> str:
+        transaction_id = refund_kwargs['transaction_id']
+        if action != 'refund':
+            return self._cancel_unsettled(transaction_id, (refund_kwargs.get('refund_data') or {}).get('amount'))
+        refund = self._call(self.gateway.transaction.refund, transaction_id, refund_kwargs.get('refund_data'))
+        if not refund.is_success:
+            raise PaymentClientError.from_result(refund)
+        return refund.transaction.id
+
+    def refund_payments(
+        self,
+        refund_kwargs_batch,
+        max_workers=DEFAULT_MAX_WORKERS,
+        rate_limit=None,
+        retry_policy: 'RetryPolicy' = None,
+        stats: 'BulkStats' = None,
+        chunk_size=500,
+    ):
+        """
+        Refund a batch of refund_payment payloads, yielding a RefundedObjectDataClass per payload, failures included.
+
+        Statuses are looked up with one search per ``chunk_size`` payloads, then each chunk is voided (or voided and
+        resold, for partial refunds) or refunded according to its status, unsettled transactions first. Calls run on
+        ``max_workers`` threads, no more than ``rate_limit`` starting per second. Each gateway call is retried by
+        ``retry_policy``, by default the client's one or, if it has none, a RetryPolicy for the batch.
+        """
+        retry_policy = retry_policy or self.retry_policy or RetryPolicy()
+        client = self
+        if retry_policy is not self.retry_policy:
+            client = copy.copy(self)
+            client.retry_policy = retry_policy
+        rate_limiter = RateLimiter(rate_limit, burst=max_workers) if rate_limit else None
+        results = bounded_map(
+            lambda item: client._refund_by_action(*item),
+            client._refund_actions(refund_kwargs_batch, chunk_size),
+            max_workers=max_workers,
+            rate_limiter=rate_limiter,
+            stats=stats,
+        )
+        try:
+            for (refund_kwargs, action, _status), refunded_id, error in results:
+                yield RefundedObjectDataClass(
+                    transaction_id=refund_kwargs['transaction_id'],
+                    id=refunded_id,
+                    action=action,
+                    refunded=error is None,
+                    error=error_message(error) if error else None,
+                )
+        finally:
+            results.close()
+
+    def _find_sale(self, order_id, amount) -> 'braintree.Transaction':
+        transactions = self.iter_transactions(
+            braintree.TransactionSearch.order_id == order_id,
+            braintree.TransactionSearch.type == braintree.Transaction.Type.Sale,
+            braintree.TransactionSearch.status.in_list(list(UNSETTLED_STATUSES + SETTLED_STATUSES)),
+        )
+        return next((transaction for transaction in transactions if transaction.amount == Decimal(str(amount))), None)
+
+    def _sale(self, payment_mode_kwargs: dict) -> str:
+        order_id = payment_mode_kwargs.get('order_id')
+        attempts = 0
+
+        def sale():
+            nonlocal attempts
+            attempts += 1
+            return self.gateway.transaction.sale(payment_mode_kwargs)
+
+        # Sales are only retried after ambiguous errors when the gateway can detect duplicates by order_id
+        result = self._call(sale, idempotent=bool(order_id))
+        if not result.is_success and attempts > 1 and result.transaction is not None:
+            if result.transaction.gateway_rejection_reason == braintree.Transaction.GatewayRejectionReason.Duplicate:
+                # An earlier attempt went through but its response was lost
+                transaction = self._find_sale(order_id, payment_mode_kwargs.get('amount'))
+                if transaction is not None:
+                    self._record_status(transaction)
+                    return transaction.id
+        if not result.is_success:
+            raise PaymentClientError.from_result(result)
+        self._record_status(result.transaction)
+        return result.transaction.id
+
+    @instrumented('create_payment_mode')
+    @guarded('sale', PaymentClientError)
+    def create_payment_mode(self, payment_source_id, payment_mode_kwargs: dict, region=None, card_brand=None) -> str:
+        """
+        Create a sale. A Money ``amount`` is sent in the merchant account of its currency, unless ``merchant_account_id``
+        is given, with ``region`` and ``card_brand`` selecting among the overrides of the merchant account router.
+        """
         try:
-            sale = self.gateway.transaction.sale(payment_mode_kwargs)
-            if not sale.is_success:
-                raise PaymentClientError(message=sale.message)
-            return sale.transaction.id
+            amount = payment_mode_kwargs.get('amount')
+            if isinstance(amount, Money):
+                payment_mode_kwargs = dict(payment_mode_kwargs, amount=str(amount.amount))
+                if not payment_mode_kwargs.get('merchant_account_id'):
+                    try:
+                        payment_mode_kwargs['merchant_account_id'] = self.merchant_account_router.resolve(
+                            amount.currency, region=region, card_brand=card_brand
+                        )
+                    except NoMerchantAccountError as err:
+                        raise PaymentClientError(message=str(err))
+            order_id = payment_mode_kwargs.get('order_id')
+            if self.idempotency_ledger is not None and order_id:
+                # Retries of an order get the original transaction id back without reaching the gateway
+                try:
+                    return self.idempotency_ledger.run_once(str(order_id), lambda: self._sale(payment_mode_kwargs))
+                except OrderInProgressError as err:
+                    raise PaymentClientError(message=str(err))
+            return self._sale(payment_mode_kwargs)
         except Exception as err:
-            logger.error(f'Error creating payment mode: {str(err)}', extra={'err__dict': err.__dict__})
+            log_error(logger, 'Error creating payment mode: %s', err)
             raise err
 
+    @staticmethod
+    def _paypal_payment_info(paypal: dict) -> 'PaypalPaymentInfoDataClass':
+        # Payers may have no first or last name on file
+        names = (paypal.get('payer_first_name'), paypal.get('payer_last_name'))
+        return PaypalPaymentInfoDataClass(email=paypal.get('payer_email'), name=' '.join(filter(None, names)) or None)
+
+    def _fetch_payment_source_info(self, payment_mode_id) -> 'PaypalPaymentInfoDataClass':
+        # Read the payer straight from the response rather than building the whole braintree.Transaction
+        try:
+            response = self._call(
+                self.gateway.config.http().get,
+                self.gateway.config.base_merchant_path() + '/transactions/' + str(payment_mode_id),
+                idempotent=True,
+            )
+        except braintree.exceptions.NotFoundError:
+            raise braintree.exceptions.NotFoundError('transaction with id ' + repr(str(payment_mode_id)) + ' not found')
+        return self._paypal_payment_info(response['transaction']['paypal'])
+
+    @instrumented('get_payment_source_info')
     def get_payment_source_info(self, payment_mode_id) -> 'PaypalPaymentInfoDataClass':
-        transaction = self.gateway.transaction.find(payment_mode_id)
-        return PaypalPaymentInfoDataClass(
-            email=transaction.paypal_details.payer_email,
-            name=transaction.paypal_details.payer_first_name + ' ' + transaction.paypal_details.payer_last_name,
-        )
+        if self.payment_source_info_cache is not None:
+            return self.payment_source_info_cache.get_or_set(
+                str(payment_mode_id), lambda: self._fetch_payment_source_info(payment_mode_id)
+            )
+        return self._fetch_payment_source_info(payment_mode_id)
+
+    def get_payment_source_infos(self, payment_mode_ids) -> 'dict[str, PaypalPaymentInfoDataClass]':
+        """
+        Return the PaypalPaymentInfoDataClass of each PayPal payment mode id.
+
+        Uncached ids are looked up by a single search call per SEARCH_PAGE_SIZE of them, skipping the id search round
+        trip of a regular transaction search.
+
+        Unknown ids and payment modes other than PayPal are left out.
+        """
+        cache = self.payment_source_info_cache
+        payment_source_infos = {}
+        missing_ids = []
+        for payment_mode_id in dict.fromkeys(map(str, payment_mode_ids)):
+            cached = MISSING if cache is None else cache.get(payment_mode_id, MISSING)
+            if cached is MISSING:
+                missing_ids.append(payment_mode_id)
+            else:
+                payment_source_infos[payment_mode_id] = cached
+        for start in range(0, len(missing_ids), SEARCH_PAGE_SIZE):
+            page_ids = missing_ids[start : start + SEARCH_PAGE_SIZE]
+            for transaction in self._search_transactions_page({}, page_ids, fast=self.fast_xml):
+                if not transaction.get('paypal'):
+                    continue
+                payment_source_infos[transaction['id']] = self._paypal_payment_info(transaction['paypal'])
+                if cache is not None:
+                    cache.set(transaction['id'], payment_source_infos[transaction['id']])
+        return payment_source_infos
+
+
+class AsyncBraintreeClient:
+    """
+    Asyncio flavour of BraintreeClient, running on a non-blocking keep-alive transport.
+
+    At most ``max_concurrency`` gateway calls are in flight at once, the others wait for a free slot.
+    """
+
+    def __init__(
+        self,
+        environment=None,
+        max_concurrency=DEFAULT_MAX_CONCURRENCY,
+        gateway=None,
+        resale_ledger: 'ResaleLedger' = None,
+    ):
+        # The shared gateway is only used for its configuration and to build braintree result objects
+        self.gateway = gateway or BraintreeClient(environment=environment).gateway
+        self.http = AsyncHttp(self.gateway.config, max_concurrency=max_concurrency)
+        self.resale_ledger = resale_ledger
+
+    async def close(self):
+        await self.http.close()
+
+    async def get_token(self, customer_pubkey: str) -> str:
+        try:
+            response = await self.http.post('/client_token', {'client_token': {'customer_id': str(customer_pubkey), 'version': 2}})
+            if 'client_token' not in response:
+                raise ValueError(response['api_error_response']['message'])
+            return response['client_token']['value']
+        except Exception as err:
+            log_error(logger, 'Error getting token: %s', err)
+            raise err
+
+    async def create_customer(self, **kwargs) -> str:
+        try:
+            Resource.verify_keys(kwargs, braintree.Customer.create_signature())
+            response = await self.http.post('/customers', {'customer': kwargs})
+            if 'customer' not in response:
+                raise PaymentClientError(message=response['api_error_response']['message'])
+            return response['customer']['id']
+        except Exception as err:
+            log_error(logger, 'Error creating customer: %s', err)
+            raise err
+
+    async def retrieve_customer(self, customer_id) -> str:
+        try:
+            try:
+                response = await self.http.get('/customers/' + str(customer_id))
+            except braintree.exceptions.NotFoundError:
+                raise braintree.exceptions.NotFoundError('customer with id ' + repr(str(customer_id)) + ' not found')
+            return response['customer']['id']
+        except Exception as err:
+            log_error(logger, 'Error retrieving customer: %s', err, level=logging.WARNING)
+        return None
+
+    async def delete_customer(self, customer_id) -> 'DeletedObjectDataClass':
+        try:
+            await self.http.delete('/customers/' + str(customer_id))
+            return DeletedObjectDataClass(id=customer_id, deleted=True, object='customer')
+        except Exception as err:
+            log_error(logger, 'Error deleting customer: %s', err)
+            raise err
+
+    def _transaction_result(self, response):
+        if 'transaction' in response:
+            return braintree.SuccessfulResult({'transaction': braintree.Transaction(self.gateway, response['transaction'])})
+        return braintree.ErrorResult(self.gateway, response['api_error_response'])
+
+    async def _void(self, transaction_id) -> str:
+        voided = self._transaction_result(await self.http.put(f'/transactions/{transaction_id}/void'))
+        if voided.is_success is False:
+            raise PaymentClientError.from_result(voided)
+        return voided.transaction.id
+
+    async def _sale(self, payment_mode_kwargs: dict) -> str:
+        params = dict(payment_mode_kwargs, type='sale')
+        Resource.verify_keys(params, braintree.Transaction.create_signature())
+        sale = self._transaction_result(await self.http.post('/transactions', {'transaction': params}))
+        if not sale.is_success:
+            raise PaymentClientError.from_result(sale)
+        return sale.transaction.id
+
+    async def _void_and_resale(self, transaction_id, refund_amount: Decimal) -> str:
+        """Void an unsettled transaction, then charge the remaining amount, as BraintreeClient._void_and_resale does."""
+        if self.resale_ledger is not None:
+            resale_id = await asyncio.to_thread(self.resale_ledger.get, transaction_id)
+            if resale_id is not None:
+                return resale_id
+        try:
+            response = await self.http.get('/transactions/' + str(transaction_id))
+        except braintree.exceptions.NotFoundError:
+            raise braintree.exceptions.NotFoundError('transaction with id ' + repr(str(transaction_id)) + ' not found')
+        sale_options = BraintreeClient._resale_options(braintree.Transaction(self.gateway, response['transaction']), refund_amount)
+        voided_id = await self._void(transaction_id)
+        if sale_options is None:
+            return voided_id
+        try:
+            resale_id = await self._sale(sale_options)
+        except Exception as err:
+            raise await asyncio.to_thread(
+                BraintreeClient._resale_failed, self.resale_ledger, transaction_id, sale_options, refund_amount, err
+            ) from err
+        if self.resale_ledger is not None:
+            await asyncio.to_thread(self.resale_ledger.record, transaction_id, resale_id, refund_amount)
+        return resale_id
+
+    async def refund_payment(self, refund_kwargs, order_total_price) -> str:
+        try:
+            transaction_id = refund_kwargs['transaction_id']
+            refund_options = refund_kwargs.get('refund_data') or {}
+            Resource.verify_keys(refund_options, braintree.Transaction.refund_signature())
+            refund = self._transaction_result(
+                await self.http.post(f'/transactions/{transaction_id}/refund', {'transaction': refund_options})
+            )
+            if refund.is_success is False and refund.errors.deep_errors and refund.errors.deep_errors[0].code == '91506':
+                if refund_options.get('amount'):
+                    return await self._void_and_resale(transaction_id, Decimal(refund_options['amount']))
+                return await self._void(transaction_id)  # Full refund, void the transaction
+            return refund.transaction.id
+        except Exception as e:
+            log_error(logger, 'Error refunding payment: %s', e)
+            raise e
+
+    async def create_payment_mode(self, payment_source_id, payment_mode_kwargs: dict) -> str:
+        try:
+            return await self._sale(payment_mode_kwargs)
+        except Exception as err:
+            log_error(logger, 'Error creating payment mode: %s', err)
+            raise err
+
+    async def get_payment_source_info(self, payment_mode_id) -> 'PaypalPaymentInfoDataClass':
+        try:
+            response = await self.http.get('/transactions/' + str(payment_mode_id))
+        except braintree.exceptions.NotFoundError:
+            raise braintree.exceptions.NotFoundError('transaction with id ' + repr(str(payment_mode_id)) + ' not found')
+        return BraintreeClient._paypal_payment_info(response['transaction']['paypal'])
 
 
 class BraintreeClientTest(TestCase):
     @classmethod
-    def setUpTestData(cls):
-        cls.braintree_client = BraintreeClient()
-        super().setUpTestData()
+    def setUpClass(cls):
+        super().setUpClass()
+        # BRAINTREE_SANDBOX=1 runs the suite against the live Sandbox instead of the local fake gateway,
+        # BRAINTREE_CASSETTE=record|replay records the traffic to (or replays it from) prose/cassettes
+        if os.environ.get('BRAINTREE_SANDBOX') or os.environ.get('BRAINTREE_CASSETTE') == Cassette.REPLAY:
+            cls.braintree_client = BraintreeClient()
+        else:
+            cls.fake_gateway = FakeBraintreeGateway().start()
+            cls.addClassCleanup(cls.fake_gateway.stop)
+            cls.braintree_client = BraintreeClient(environment=cls.fake_gateway.environment)
+
+    def setUp(self):
+        super().setUp()
+        cassette_mode = os.environ.get('BRAINTREE_CASSETTE')
+        if cassette_mode:
+            cassette = Cassette(CASSETTES_DIR / f'{type(self).__name__}.{self._testMethodName}.json.gz', mode=cassette_mode)
+            self.addCleanup(cassette.save)
+            self.braintree_client = BraintreeClient(gateway=cassette.wrap(type(self).braintree_client.gateway))
 
     def _get_customer_creation_payload(self, customer: Customer):
         customer_creation_payload = {
@@ -357,12 +1119,9 @@ class BraintreeClientTest(TestCase):
             ],
         )
 
-    # @skip(
-    #     'This test is failing because transaction is in submitted_for_settlement status and refund is not authorized. Waiting response from Braintree how to put it as settled.'  # noqa: E501
-    # )
     def test_refund_payment(self):
         """
-        Given a customer
+        Given a settled transaction
         When refund_payment for a partial refund is called
         Then a refund is created in Braintree
         """
@@ -382,15 +1141,54 @@ class BraintreeClientTest(TestCase):
             'transaction_source': 'recurring_first',
         }
         sale_id = self.braintree_client.create_payment_mode(None, sale_options)
+        self.braintree_client.gateway.testing.settle_transaction(sale_id)
         refund_payload = {'transaction_id': sale_id, 'refund_data': {'amount': '25.00'}}
         refund_id = self.braintree_client.refund_payment(refund_payload, Money('25.00', 'USD'))
         self.assertIsNotNone(refund_id)
 
+        refund = self.braintree_client.gateway.transaction.find(refund_id)
+        self.assertEqual(refund.type, 'credit')
+        self.assertEqual(refund.refunded_transaction_id, sale_id)
         self._assert_customer_transactions_values(
             customer,
             [
-                (Money('100', 'USD'), 'submitted_for_settlement'),
-                (Money('-25', 'USD'), 'submitted_for_settlement'),
+                (Money('25', 'USD'), 'submitted_for_settlement'),
+                (Money('100', 'USD'), 'settled'),
+            ],
+        )
+
+    def test_refund_payment_partial_unsettled(self):
+        """
+        Given a submitted for settlement transaction
+        When refund_payment for a partial refund is called
+        Then the transaction is voided and the remaining amount is charged to the vaulted card
+        """
+        customer = self._create_customer()
+        sale_options = {
+            'amount': '100',
+            'device_data': {},
+            'options': {
+                'submit_for_settlement': True,
+                'store_in_vault_on_success': True,
+            },
+            'order_id': str(uuid4()),
+            'merchant_account_id': CURRENCY_MERCHANT_ACCOUNT_MAP.USD,
+            'customer_id': str(customer.pubkey),
+            'payment_method_nonce': 'fake-valid-nonce',
+            'transaction_source': 'recurring_first',
+        }
+        sale_id = self.braintree_client.create_payment_mode(None, sale_options)
+        refund_payload = {'transaction_id': sale_id, 'refund_data': {'amount': '25.00'}}
+        resale_id = self.braintree_client.refund_payment(refund_payload, Money('25.00', 'USD'))
+        self.assertNotEqual(resale_id, sale_id)
+
+        resale = self.braintree_client.gateway.transaction.find(resale_id)
+        self.assertEqual(resale.order_id, sale_options['order_id'])
+        self._assert_customer_transactions_values(
+            customer,
+            [
+                (Money('75', 'USD'), 'submitted_for_settlement'),
+                (Money('100', 'USD'), 'voided'),
             ],
         )
 
@@ -424,3 +1222,1851 @@ class BraintreeClientTest(TestCase):
         self.assertIsNotNone(voided_id)
 
         self._assert_customer_transactions_values(customer, [(Money('100', 'USD'), 'voided')])
+
+
+class GatewayRegistryTest(SimpleTestCase):
+    def _get_gateway(self, registry, **kwargs):
+        credentials = {
+            'environment': braintree.Environment.Sandbox,
+            'merchant_id': 'merchant-id',
+            'public_key': 'public-key',
+            'private_key': 'private-key',
+        }
+        credentials.update(kwargs)
+        return registry.get_gateway(**credentials)
+
+    def test_clients_share_gateway(self):
+        """
+        Given two BraintreeClient instances with the same credentials
+        When their gateways are compared
+        Then they are the same pooled gateway
+        """
+        self.assertIs(BraintreeClient().gateway, BraintreeClient().gateway)
+        self.assertIsInstance(BraintreeClient().gateway.config.http_strategy(), PooledHttp)
+
+    def test_gateway_keyed_by_credentials(self):
+        """
+        Given a registry
+        When gateways are requested for different credentials or environments
+        Then a distinct gateway is returned for each of them
+        """
+        registry = GatewayRegistry()
+        gateway = self._get_gateway(registry)
+        self.assertIs(self._get_gateway(registry), gateway)
+        self.assertIsNot(self._get_gateway(registry, private_key='other-private-key'), gateway)
+        self.assertIsNot(self._get_gateway(registry, environment=braintree.Environment.Production), gateway)
+        self.assertEqual(len(registry), 3)
+        registry.clear()
+        self.assertEqual(len(registry), 0)
+
+    def test_pool_size(self):
+        """
+        Given a pool size
+        When a gateway is created
+        Then its HTTP adapter keeps that many connections alive
+        """
+        registry = GatewayRegistry()
+        gateway = self._get_gateway(registry, pool_size=3)
+        adapter = gateway.config.http_strategy().session.get_adapter('https://api.sandbox.braintreegateway.com')
+        self.assertEqual(adapter._pool_maxsize, 3)
+        registry.clear()
+
+
+class CassetteTest(SimpleTestCase):
+    def setUp(self):
+        super().setUp()
+        tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp_dir.cleanup)
+        self.cassette_path = Path(tmp_dir.name) / 'cassette.json.gz'
+
+    def _create_customer_and_payment(self, braintree_client):
+        customer = CustomerFactory.build()
+        customer_id = braintree_client.create_customer(
+            id=str(customer.pubkey),
+            first_name=customer.first_name,
+            last_name=customer.last_name,
+            email=customer.username,
+            phone=customer.phone,
+        )
+        order_id = str(uuid4())
+        sale_id = braintree_client.create_payment_mode(
+            None,
+            {
+                'amount': '100',
+                'options': {'submit_for_settlement': True},
+                'order_id': order_id,
+                'merchant_account_id': CURRENCY_MERCHANT_ACCOUNT_MAP.USD,
+                'customer_id': customer_id,
+                'payment_method_nonce': 'fake-valid-nonce',
+            },
+        )
+        return customer, order_id, braintree_client.gateway.transaction.find(sale_id)
+
+    def test_record_and_replay(self):
+        """
+        Given a cassette recorded against the gateway
+        When the same calls are replayed with new pubkeys and order ids while the gateway is down
+        Then the recorded responses are served back with the new volatile values
+        """
+        with FakeBraintreeGateway() as fake_gateway:
+            cassette = Cassette(self.cassette_path, mode=Cassette.RECORD)
+            gateway = BraintreeClient(environment=fake_gateway.environment).gateway
+            self._create_customer_and_payment(BraintreeClient(gateway=cassette.wrap(gateway)))
+            cassette.save()
+        self.assertEqual(fake_gateway.requests_count, 3)
+
+        cassette = Cassette(self.cassette_path)
+        customer, order_id, transaction = self._create_customer_and_payment(BraintreeClient(gateway=cassette.wrap(gateway)))
+        self.assertEqual(transaction.customer_details.id, str(customer.pubkey))
+        self.assertEqual(transaction.customer_details.email, customer.username)
+        self.assertEqual(transaction.order_id, order_id)
+        self.assertEqual(transaction.status, 'submitted_for_settlement')
+        self.assertEqual(transaction.amount, Decimal('100'))
+
+    def test_replay_unrecorded_request(self):
+        """
+        Given a recorded cassette
+        When a request that was not recorded is replayed
+        Then a CassetteError is raised
+        """
+        with FakeBraintreeGateway() as fake_gateway:
+            cassette = Cassette(self.cassette_path, mode=Cassette.RECORD)
+            gateway = BraintreeClient(environment=fake_gateway.environment).gateway
+            self._create_customer_and_payment(BraintreeClient(gateway=cassette.wrap(gateway)))
+            cassette.save()
+
+        replay_client = BraintreeClient(gateway=Cassette(self.cassette_path).wrap(gateway))
+        with self.assertRaises(CassetteError):
+            replay_client.gateway.transaction.find('unrecorded')
+
+
+class AsyncBraintreeClientTest(SimpleTestCase):
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.fake_gateway = FakeBraintreeGateway().start()
+        cls.addClassCleanup(cls.fake_gateway.stop)
+
+    async def _create_customer(self, braintree_client):
+        customer = CustomerFactory.build()
+        await braintree_client.create_customer(
+            id=str(customer.pubkey),
+            first_name=customer.first_name,
+            last_name=customer.last_name,
+            email=customer.username,
+            phone=customer.phone,
+        )
+        return customer
+
+    def _sale_options(self, customer):
+        return {
+            'amount': '100',
+            'device_data': {},
+            'options': {
+                'submit_for_settlement': True,
+                'store_in_vault_on_success': True,
+            },
+            'order_id': str(uuid4()),
+            'merchant_account_id': CURRENCY_MERCHANT_ACCOUNT_MAP.USD,
+            'customer_id': str(customer.pubkey),
+            'payment_method_nonce': 'fake-valid-nonce',
+            'transaction_source': 'recurring_first',
+        }
+
+    async def test_customer_lifecycle(self):
+        """
+        Given an async client
+        When a customer is created, retrieved, given a token and deleted
+        Then each call behaves like the blocking client
+        """
+        braintree_client = AsyncBraintreeClient(environment=self.fake_gateway.environment)
+        customer = await self._create_customer(braintree_client)
+        self.assertEqual(await braintree_client.retrieve_customer(customer.pubkey), str(customer.pubkey))
+        self.assertIsNotNone(await braintree_client.get_token(customer.pubkey))
+
+        deleted_customer = await braintree_client.delete_customer(customer.pubkey)
+        self.assertTrue(deleted_customer.deleted)
+        with self.assertLogs('prose.test_braintree_lite', level='WARNING') as cm:
+            self.assertIsNone(await braintree_client.retrieve_customer(customer.pubkey))
+        self.assertEqual(
+            cm.output,
+            [f"WARNING:prose.test_braintree_lite:Error retrieving customer: customer with id '{str(customer.pubkey)}' not found"],
+        )
+        with self.assertRaises(ValueError) as e:
+            await braintree_client.get_token(customer.pubkey)
+        self.assertEqual(str(e.exception), 'Customer specified by customer_id does not exist')
+        await braintree_client.close()
+
+    async def test_create_payment_and_void(self):
+        """
+        Given an async client
+        When a payment is created, duplicated and fully refunded
+        Then the duplicate raises a PaymentClientError and the refund voids the payment
+        """
+        braintree_client = AsyncBraintreeClient(environment=self.fake_gateway.environment)
+        customer = await self._create_customer(braintree_client)
+        sale_options = self._sale_options(customer)
+        sale_id = await braintree_client.create_payment_mode(None, sale_options)
+        with self.assertRaises(PaymentClientError) as e:
+            await braintree_client.create_payment_mode(None, sale_options)
+        self.assertEqual(str(e.exception), 'Gateway Rejected: duplicate')
+
+        voided_id = await braintree_client.refund_payment({'transaction_id': sale_id}, Money('100.00', 'USD'))
+        self.assertEqual(voided_id, sale_id)
+        self.assertEqual(self.fake_gateway.transactions[sale_id]['status'], 'voided')
+        await braintree_client.close()
+
+    async def test_bounded_concurrency(self):
+        """
+        Given an async client with a concurrency limit
+        When many calls are made at once
+        Then they all succeed over at most that many connections
+        """
+        braintree_client = AsyncBraintreeClient(environment=self.fake_gateway.environment, max_concurrency=10)
+        customer = await self._create_customer(braintree_client)
+        tokens = await asyncio.gather(*(braintree_client.get_token(customer.pubkey) for _ in range(200)))
+        self.assertEqual(len(tokens), 200)
+        self.assertLessEqual(braintree_client.http.connections_opened, 10)
+        await braintree_client.close()
+
+    def test_client_built_outside_loop(self):
+        """
+        Given an async client with a concurrency limit built outside any event loop
+        When it makes more concurrent calls than the limit in successive event loops
+        Then they all succeed
+        """
+        braintree_client = AsyncBraintreeClient(environment=self.fake_gateway.environment, max_concurrency=2)
+        customer = asyncio.run(self._create_customer(braintree_client))
+
+        async def get_tokens():
+            return await asyncio.gather(*(braintree_client.get_token(customer.pubkey) for _ in range(20)))
+
+        self.assertEqual(len(asyncio.run(get_tokens())), 20)
+        self.assertEqual(len(asyncio.run(get_tokens())), 20)
+        asyncio.run(braintree_client.close())
+
+    async def test_partial_refund_unsettled(self):
+        """
+        Given an async client with a resale ledger and an unsettled payment
+        When a partial refund is requested twice
+        Then the payment is voided and the rest charged once, like with the blocking client
+        """
+        tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp_dir.cleanup)
+        resale_ledger = ResaleLedger(database=os.path.join(tmp_dir.name, 'ledger.sqlite3'))
+        self.addCleanup(resale_ledger.close)
+        braintree_client = AsyncBraintreeClient(environment=self.fake_gateway.environment, resale_ledger=resale_ledger)
+        customer = await self._create_customer(braintree_client)
+        sale_id = await braintree_client.create_payment_mode(None, self._sale_options(customer))
+
+        refund_payload = {'transaction_id': sale_id, 'refund_data': {'amount': '40.00'}}
+        resale_id = await braintree_client.refund_payment(refund_payload, Money('40.00', 'USD'))
+        self.assertEqual(await braintree_client.refund_payment(refund_payload, Money('40.00', 'USD')), resale_id)
+        self.assertEqual(resale_ledger.get(sale_id), resale_id)
+        self.assertEqual(self.fake_gateway.transactions[sale_id]['status'], 'voided')
+        self.assertEqual(self.fake_gateway.transactions[resale_id]['amount'], '60.00')
+        self.assertEqual(self.fake_gateway.transactions[resale_id]['status'], 'submitted_for_settlement')
+        await braintree_client.close()
+
+    class DroppedConnectionWriter:
+        """Writer of a pooled connection that the server closes without answering the next request."""
+
+        def __init__(self, reader):
+            self.reader = reader
+            self.requests = 0
+
+        def write(self, data):
+            self.requests += 1
+            self.reader.feed_eof()
+
+        async def drain(self):
+            pass
+
+        def is_closing(self):
+            return False
+
+        def close(self):
+            pass
+
+        async def wait_closed(self):
+            pass
+
+    def _pool_dropped_connection(self, braintree_client):
+        reader = asyncio.StreamReader()
+        writer = self.DroppedConnectionWriter(reader)
+        braintree_client.http._idle_connections.append((reader, writer))
+        return writer
+
+    async def test_dropped_pooled_connection(self):
+        """
+        Given pooled connections closed by the server as requests are sent on them
+        When a GET and a POST are sent
+        Then the GET is resent once on a fresh connection and the POST, which may have been processed, is not resent
+        """
+        braintree_client = AsyncBraintreeClient(environment=self.fake_gateway.environment)
+        customer = await self._create_customer(braintree_client)
+        await braintree_client.close()
+        dropped = [self._pool_dropped_connection(braintree_client) for _ in range(2)]
+        self.assertEqual(await braintree_client.retrieve_customer(customer.pubkey), str(customer.pubkey))
+        self.assertEqual([writer.requests for writer in dropped], [0, 1])
+
+        await braintree_client.close()
+        dropped = self._pool_dropped_connection(braintree_client)
+        requests_count = self.fake_gateway.requests_count
+        with self.assertLogs('prose.test_braintree_lite', level='ERROR'):
+            with self.assertRaises(braintree.exceptions.http.connection_error.ConnectionError):
+                await braintree_client.create_customer(id=str(CustomerFactory.build().pubkey))
+        self.assertEqual(dropped.requests, 1)
+        self.assertEqual(self.fake_gateway.requests_count, requests_count)
+        await braintree_client.close()
+
+
+class ClientTokenCacheTest(SimpleTestCase):
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.fake_gateway = FakeBraintreeGateway().start()
+        cls.addClassCleanup(cls.fake_gateway.stop)
+
+    def _create_customer(self, braintree_client):
+        customer = CustomerFactory.build()
+        braintree_client.create_customer(id=str(customer.pubkey), email=customer.username)
+        return customer
+
+    def test_get_token_cached(self):
+        """
+        Given a client with a token cache
+        When get_token is called twice for the same customer
+        Then the gateway is only called once
+        """
+        braintree_client = BraintreeClient(environment=self.fake_gateway.environment, token_cache=ClientTokenCache())
+        customer = self._create_customer(braintree_client)
+        requests_count = self.fake_gateway.requests_count
+        token = braintree_client.get_token(customer.pubkey)
+        self.assertEqual(braintree_client.get_token(customer.pubkey), token)
+        self.assertEqual(self.fake_gateway.requests_count, requests_count + 1)
+        self.assertEqual(braintree_client.token_cache.stats, {'hits': 1, 'misses': 1})
+
+    def test_delete_customer_invalidates_token(self):
+        """
+        Given a cached token
+        When the customer is deleted
+        Then get_token goes back to the gateway
+        """
+        braintree_client = BraintreeClient(environment=self.fake_gateway.environment, token_cache=ClientTokenCache())
+        customer = self._create_customer(braintree_client)
+        braintree_client.get_token(customer.pubkey)
+        braintree_client.delete_customer(str(customer.pubkey))
+        with self.assertRaises(ValueError):
+            braintree_client.get_token(customer.pubkey)
+
+    def test_token_expiry_and_eviction(self):
+        """
+        Given an in-process storage
+        When entries outlive their TTL or exceed the maximum number of entries
+        Then they are dropped, least recently used first
+        """
+        now = [0]
+        storage = LocMemStorage(max_entries=2, clock=lambda: now[0])
+        token_cache = ClientTokenCache(storage=storage, ttl=60)
+        token_cache.set('a', 'token-a')
+        token_cache.set('b', 'token-b')
+        self.assertEqual(token_cache.get('a'), 'token-a')
+        token_cache.set('c', 'token-c')
+        self.assertIsNone(token_cache.get('b'))
+        self.assertEqual(token_cache.get('a'), 'token-a')
+        now[0] = 61
+        self.assertIsNone(token_cache.get('a'))
+        self.assertEqual(len(storage), 1)
+
+    def test_django_cache_storage(self):
+        """
+        Given a token cache backed by the Django cache
+        When a token is stored and invalidated
+        Then it is read back from and removed from the Django cache
+        """
+        token_cache = ClientTokenCache(storage=DjangoCacheStorage())
+        token_cache.set('customer', 'token')
+        self.assertEqual(token_cache.get('customer'), 'token')
+        token_cache.invalidate('customer')
+        self.assertIsNone(token_cache.get('customer'))
+
+
+class CustomerLookupCacheTest(SimpleTestCase):
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.fake_gateway = FakeBraintreeGateway().start()
+        cls.addClassCleanup(cls.fake_gateway.stop)
+
+    def setUp(self):
+        super().setUp()
+        self.braintree_client = BraintreeClient(environment=self.fake_gateway.environment, customer_cache=CustomerLookupCache())
+
+    def test_retrieve_customer_cached(self):
+        """
+        Given a client with a customer cache
+        When retrieve_customer is called repeatedly for an existing customer
+        Then the gateway is only called once
+        """
+        customer = CustomerFactory.build()
+        self.braintree_client.create_customer(id=str(customer.pubkey), email=customer.username)
+        requests_count = self.fake_gateway.requests_count
+        for _ in range(3):
+            self.assertEqual(self.braintree_client.retrieve_customer(customer.pubkey), str(customer.pubkey))
+        self.assertEqual(self.fake_gateway.requests_count, requests_count + 1)
+        self.assertEqual(self.braintree_client.customer_cache.stats, {'hits': 2, 'misses': 1})
+
+    def test_retrieve_customer_not_found_cached(self):
+        """
+        Given a customer that does not exist in Braintree
+        When retrieve_customer is called repeatedly and the customer is then created
+        Then the miss is cached and logged once, and create_customer invalidates it
+        """
+        customer = CustomerFactory.build()
+        with self.assertLogs('prose.test_braintree_lite', level='WARNING') as cm:
+            for _ in range(3):
+                self.assertIsNone(self.braintree_client.retrieve_customer(customer.pubkey))
+        self.assertEqual(len(cm.output), 1)
+
+        self.braintree_client.create_customer(id=str(customer.pubkey), email=customer.username)
+        self.assertEqual(self.braintree_client.retrieve_customer(customer.pubkey), str(customer.pubkey))
+
+    def test_delete_customer_invalidates(self):
+        """
+        Given a cached customer
+        When the customer is deleted
+        Then retrieve_customer returns None
+        """
+        customer = CustomerFactory.build()
+        self.braintree_client.create_customer(id=str(customer.pubkey), email=customer.username)
+        self.braintree_client.retrieve_customer(customer.pubkey)
+        self.braintree_client.delete_customer(str(customer.pubkey))
+        with self.assertLogs('prose.test_braintree_lite', level='WARNING'):
+            self.assertIsNone(self.braintree_client.retrieve_customer(customer.pubkey))
+
+    def test_delete_missing_customer_invalidates(self):
+        """
+        Given a cached customer deleted from Braintree behind the client's back
+        When delete_customer is called
+        Then the NotFoundError is raised and retrieve_customer returns None
+        """
+        customer = CustomerFactory.build()
+        self.braintree_client.create_customer(id=str(customer.pubkey), email=customer.username)
+        self.braintree_client.retrieve_customer(customer.pubkey)
+        self.braintree_client.gateway.customer.delete(str(customer.pubkey))
+        with self.assertLogs('prose.test_braintree_lite', level='WARNING'):
+            with self.assertRaises(braintree.exceptions.NotFoundError):
+                self.braintree_client.delete_customer(str(customer.pubkey))
+            self.assertIsNone(self.braintree_client.retrieve_customer(customer.pubkey))
+
+    def test_not_found_ttl(self):
+        """
+        Given a customer cache with separate TTLs
+        When a found and a not found customer are cached
+        Then the not found entry expires first
+        """
+        now = [0]
+        customer_cache = CustomerLookupCache(storage=LocMemStorage(clock=lambda: now[0]), ttl=300, not_found_ttl=30)
+        customer_cache.set('found', 'found')
+        customer_cache.set('missing', None)
+        self.assertIsNone(customer_cache.get('missing', MISSING))
+        now[0] = 31
+        self.assertIs(customer_cache.get('missing', MISSING), MISSING)
+        self.assertEqual(customer_cache.get('found'), 'found')
+
+
+class BulkCreateCustomersTest(SimpleTestCase):
+    def setUp(self):
+        super().setUp()
+        self.fake_gateway = FakeBraintreeGateway().start()
+        self.addCleanup(self.fake_gateway.stop)
+        self.braintree_client = BraintreeClient(environment=self.fake_gateway.environment)
+        self.customers = CustomerFactory.build_batch(20)
+
+    def _payloads(self):
+        for customer in self.customers:
+            yield {'id': str(customer.pubkey), 'first_name': customer.first_name, 'email': customer.username}
+
+    def test_create_customers(self):
+        """
+        Given a stream of customer payloads, one of them already in Braintree
+        When create_customers is called
+        Then every record gets a result in input order, with an error for the existing customer
+        """
+        self.braintree_client.create_customer(id=str(self.customers[3].pubkey))
+        with self.assertLogs('prose.test_braintree_lite', level='ERROR'):
+            results = list(self.braintree_client.create_customers(self._payloads(), max_workers=4))
+
+        self.assertEqual([result.index for result in results], list(range(20)))
+        self.assertEqual([result.id for result in results], [str(customer.pubkey) for customer in self.customers])
+        self.assertEqual([result.index for result in results if not result.created], [3])
+        self.assertEqual(results[3].error, 'Customer ID has already been taken.')
+        self.assertEqual(len(self.fake_gateway.customers), 20)
+
+    def test_create_customers_resume_from_checkpoint(self):
+        """
+        Given a bulk creation interrupted after 8 records
+        When create_customers is called again with the same input and checkpoint
+        Then only the remaining records are processed, the one in flight at interruption being reported as taken
+        """
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            checkpoint_path = os.path.join(tmp_dir, 'customers.checkpoint')
+            results = self.braintree_client.create_customers(self._payloads(), max_workers=1, checkpoint_path=checkpoint_path)
+            for result in itertools.islice(results, 8):
+                self.assertTrue(result.created)
+            results.close()
+            self.assertEqual(Checkpoint(checkpoint_path).position, 8)
+
+            resumed = list(self.braintree_client.create_customers(self._payloads(), max_workers=4, checkpoint_path=checkpoint_path))
+            self.assertEqual(resumed[0].index, 8)
+            self.assertLessEqual({result.index for result in resumed if not result.created}, {8})
+            self.assertEqual(Checkpoint(checkpoint_path).position, 20)
+        self.assertEqual(len(self.fake_gateway.customers), 20)
+
+
+class BulkDeleteCustomersTest(SimpleTestCase):
+    def setUp(self):
+        super().setUp()
+        self.fake_gateway = FakeBraintreeGateway().start()
+        self.addCleanup(self.fake_gateway.stop)
+        self.braintree_client = BraintreeClient(environment=self.fake_gateway.environment)
+
+    def test_delete_customers(self):
+        """
+        Given existing customers and an unknown id
+        When delete_customers is called
+        Then every id gets a result, the unknown one as a failure, and the stats count them
+        """
+        customer_ids = [str(customer.pubkey) for customer in CustomerFactory.build_batch(10)]
+        for customer_id in customer_ids:
+            self.braintree_client.create_customer(id=customer_id)
+        stats = BulkStats()
+        with self.assertLogs('prose.test_braintree_lite', level='ERROR'):
+            results = list(self.braintree_client.delete_customers(customer_ids + ['unknown'], max_workers=4, stats=stats))
+
+        self.assertEqual([result.id for result in results], customer_ids + ['unknown'])
+        self.assertTrue(all(result.deleted for result in results[:-1]))
+        self.assertEqual(results[-1], DeletedObjectDataClass(id='unknown', deleted=False, object='customer', error='NotFoundError'))
+        self.assertEqual(self.fake_gateway.customers, {})
+        self.assertEqual((stats.succeeded, stats.failed), (10, 1))
+        self.assertGreater(stats.throughput, 0)
+        self.assertGreater(stats.max_latency, 0)
+
+    def test_rate_limiter(self):
+        """
+        Given a rate limiter of 10 calls per second with bursts of 2
+        When 6 calls are made at once
+        Then the calls beyond the burst wait for their slot
+        """
+        now = [0.0]
+        waits = []
+        rate_limiter = RateLimiter(10, burst=2, clock=lambda: now[0], sleep=waits.append)
+        for _ in range(6):
+            rate_limiter.acquire()
+        self.assertEqual([round(wait, 2) for wait in waits], [0.1, 0.2, 0.3, 0.4])
+
+
+class IdempotencyLedgerTest(SimpleTestCase):
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.fake_gateway = FakeBraintreeGateway().start()
+        cls.addClassCleanup(cls.fake_gateway.stop)
+
+    def setUp(self):
+        super().setUp()
+        tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp_dir.cleanup)
+        self.database = os.path.join(tmp_dir.name, 'ledger.sqlite3')
+        self.idempotency_ledger = IdempotencyLedger(database=self.database)
+        self.addCleanup(self.idempotency_ledger.close)
+        self.braintree_client = BraintreeClient(environment=self.fake_gateway.environment, idempotency_ledger=self.idempotency_ledger)
+        self.customer = CustomerFactory.build()
+        self.braintree_client.create_customer(id=str(self.customer.pubkey))
+        self.order_id = str(uuid4())
+
+    def _sale_options(self, nonce='fake-valid-nonce'):
+        return {
+            'amount': '100',
+            'options': {'submit_for_settlement': True},
+            'order_id': self.order_id,
+            'merchant_account_id': CURRENCY_MERCHANT_ACCOUNT_MAP.USD,
+            'customer_id': str(self.customer.pubkey),
+            'payment_method_nonce': nonce,
+        }
+
+    def _customer_transactions(self):
+        return [t for t in self.fake_gateway.transactions.values() if t['customer']['id'] == str(self.customer.pubkey)]
+
+    def test_create_payment_retry(self):
+        """
+        Given a payment created with an idempotency ledger
+        When create_payment_mode is retried with the same order_id, from this client or a new one on the same database
+        Then the original transaction id is returned without a new sale
+        """
+        sale_id = self.braintree_client.create_payment_mode(None, self._sale_options())
+        self.assertEqual(self.braintree_client.create_payment_mode(None, self._sale_options()), sale_id)
+
+        other_ledger = IdempotencyLedger(database=self.database)
+        self.addCleanup(other_ledger.close)
+        other_client = BraintreeClient(environment=self.fake_gateway.environment, idempotency_ledger=other_ledger)
+        self.assertEqual(other_client.create_payment_mode(None, self._sale_options()), sale_id)
+        self.assertEqual([t['status'] for t in self._customer_transactions()], ['submitted_for_settlement'])
+
+    def test_cached_orders_bounded(self):
+        """
+        Given a ledger keeping 2 orders in memory
+        When 3 orders are paid and the first one is retried
+        Then only 2 orders are kept in memory and the retry is answered from the table
+        """
+        idempotency_ledger = IdempotencyLedger(database=self.database, max_cached_orders=2)
+        self.addCleanup(idempotency_ledger.close)
+        braintree_client = BraintreeClient(environment=self.fake_gateway.environment, idempotency_ledger=idempotency_ledger)
+        order_ids = [str(uuid4()) for _ in range(3)]
+        sale_ids = [
+            braintree_client.create_payment_mode(None, dict(self._sale_options(), order_id=order_id)) for order_id in order_ids
+        ]
+        self.assertEqual(len(idempotency_ledger._transaction_ids), 2)
+        self.assertEqual(braintree_client.create_payment_mode(None, dict(self._sale_options(), order_id=order_ids[0])), sale_ids[0])
+        self.assertEqual(len(self._customer_transactions()), 3)
+
+    def test_concurrent_create_payment(self):
+        """
+        Given concurrent submissions of the same order
+        When create_payment_mode is called from several threads
+        Then a single sale reaches the gateway and every call gets its transaction id
+        """
+        barrier = threading.Barrier(8)
+        sale_ids = []
+
+        def create_payment():
+            barrier.wait()
+            sale_ids.append(self.braintree_client.create_payment_mode(None, self._sale_options()))
+
+        threads = [threading.Thread(target=create_payment) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(set(sale_ids)), 1)
+        self.assertEqual(len(sale_ids), 8)
+        self.assertEqual(len(self._customer_transactions()), 1)
+
+    def test_failed_sale_released(self):
+        """
+        Given a declined payment
+        When create_payment_mode is retried with another payment method for the same order
+        Then the retry reaches the gateway
+        """
+        with self.assertLogs('prose.test_braintree_lite', level='ERROR'):
+            with self.assertRaises(PaymentClientError):
+                self.braintree_client.create_payment_mode(None, self._sale_options('fake-processor-declined-visa-nonce'))
+        sale_id = self.braintree_client.create_payment_mode(None, self._sale_options())
+        self.assertEqual(self.idempotency_ledger.get(self.order_id), sale_id)
+
+    def test_order_in_progress_elsewhere(self):
+        """
+        Given an order claimed by another worker that has not recorded its sale yet
+        When create_payment_mode is called for that order
+        Then a PaymentClientError is raised once the wait times out
+        """
+        self.idempotency_ledger.wait_timeout = 0.1
+        self.idempotency_ledger._claim(self.order_id)
+        with self.assertLogs('prose.test_braintree_lite', level='ERROR'):
+            with self.assertRaises(PaymentClientError) as e:
+                self.braintree_client.create_payment_mode(None, self._sale_options())
+        self.assertEqual(str(e.exception), f'Payment for order {self.order_id} is already in progress')
+
+
+class IterTransactionsTest(SimpleTestCase):
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.fake_gateway = FakeBraintreeGateway().start()
+        cls.addClassCleanup(cls.fake_gateway.stop)
+        cls.braintree_client = BraintreeClient(environment=cls.fake_gateway.environment)
+        cls.customer = CustomerFactory.build()
+        cls.braintree_client.create_customer(id=str(cls.customer.pubkey))
+        for amount in range(1, 121):
+            cls.braintree_client.create_payment_mode(
+                None,
+                {
+                    'amount': str(amount),
+                    'order_id': str(uuid4()),
+                    'merchant_account_id': CURRENCY_MERCHANT_ACCOUNT_MAP.USD,
+                    'customer_id': str(cls.customer.pubkey),
+                    'payment_method_nonce': 'fake-valid-nonce',
+                },
+            )
+
+    def test_iter_transactions(self):
+        """
+        Given a customer with more transactions than a search page holds
+        When iter_transactions is consumed
+        Then it yields the same transactions as the SDK search, newest first
+        """
+        query = braintree.TransactionSearch.customer_id == str(self.customer.pubkey)
+        transactions = [t.id for t in self.braintree_client.iter_transactions(query)]
+        self.assertEqual(len(transactions), 120)
+        self.assertEqual(transactions, [t.id for t in self.braintree_client.gateway.transaction.search(query).items])
+
+    def test_iter_transactions_lazy(self):
+        """
+        Given a customer with three pages of transactions
+        When only the first transaction is taken
+        Then only the ids and at most the first two pages are fetched
+        """
+        requests_count = self.fake_gateway.requests_count
+        transactions = self.braintree_client.iter_transactions(braintree.TransactionSearch.customer_id == str(self.customer.pubkey))
+        self.assertEqual(next(transactions).amount, Decimal('120'))
+        transactions.close()
+        self.assertLessEqual(self.fake_gateway.requests_count - requests_count, 3)
+
+    def test_iter_transactions_prefetch_context(self):
+        """
+        Given a request timeout set by a circuit breaker
+        When pages are fetched in the background
+        Then the page fetches apply the timeout
+        """
+        applied_timeouts = []
+
+        def fetch_page(criteria, ids):
+            applied_timeouts.append(request_timeout.get())
+            return ids
+
+        query = braintree.TransactionSearch.customer_id == str(self.customer.pubkey)
+        token = request_timeout.set(5)
+        try:
+            self.assertEqual(len(list(self.braintree_client._iter_search((query,), fetch_page))), 120)
+        finally:
+            request_timeout.reset(token)
+        self.assertEqual(applied_timeouts, [5, 5, 5])
+
+    def test_iter_transactions_range(self):
+        """
+        Given a query with both bounds of an amount range
+        When iter_transactions is consumed
+        Then both bounds apply
+        """
+        transactions = self.braintree_client.iter_transactions(
+            braintree.TransactionSearch.customer_id == str(self.customer.pubkey),
+            braintree.TransactionSearch.amount >= '10',
+            braintree.TransactionSearch.amount <= '12',
+        )
+        self.assertEqual([t.amount for t in transactions], [Decimal('12'), Decimal('11'), Decimal('10')])
+
+    def test_search_transaction_records(self):
+        """
+        Given a customer with more transactions than a search page holds
+        When search_transaction_records is consumed
+        Then it yields compact records of the same values as the braintree Transactions, in the same order
+        """
+        query = braintree.TransactionSearch.customer_id == str(self.customer.pubkey)
+        records = list(self.braintree_client.search_transaction_records(query))
+        transactions = list(self.braintree_client.iter_transactions(query))
+        self.assertEqual(len(records), 120)
+        for record, transaction in zip(records, transactions):
+            self.assertEqual(
+                (record.id, record.type, record.status, record.amount, record.currency_iso_code, record.merchant_account_id),
+                (
+                    transaction.id,
+                    transaction.type,
+                    transaction.status,
+                    transaction.amount,
+                    transaction.currency_iso_code,
+                    transaction.merchant_account_id,
+                ),
+            )
+            self.assertEqual(
+                (record.order_id, record.customer_id, record.created_at, record.updated_at),
+                (transaction.order_id, transaction.customer_details.id, transaction.created_at, transaction.updated_at),
+            )
+        self.assertFalse(hasattr(records[0], '__dict__'))
+        self.assertIs(records[0].status, records[1].status)
+        self.assertEqual(
+            MoneyBatch.from_pairs((record.amount, record.currency_iso_code) for record in records),
+            MoneyBatch.from_money(Money(transaction.amount, transaction.currency_iso_code) for transaction in transactions),
+        )
+
+
+class ResaleLedgerTest(SimpleTestCase):
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.fake_gateway = FakeBraintreeGateway().start()
+        cls.addClassCleanup(cls.fake_gateway.stop)
+
+    def setUp(self):
+        super().setUp()
+        tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp_dir.cleanup)
+        self.resale_ledger = ResaleLedger(database=os.path.join(tmp_dir.name, 'ledger.sqlite3'))
+        self.addCleanup(self.resale_ledger.close)
+        self.braintree_client = BraintreeClient(environment=self.fake_gateway.environment, resale_ledger=self.resale_ledger)
+        self.customer_id = self.braintree_client.create_customer(id=str(CustomerFactory.build().pubkey))
+        self.sale_id = self.braintree_client.create_payment_mode(
+            None,
+            {
+                'amount': '100',
+                'options': {'submit_for_settlement': True, 'store_in_vault_on_success': True},
+                'order_id': str(uuid4()),
+                'merchant_account_id': CURRENCY_MERCHANT_ACCOUNT_MAP.USD,
+                'customer_id': self.customer_id,
+                'payment_method_nonce': 'fake-valid-nonce',
+            },
+        )
+
+    def _customer_transactions(self):
+        return {t['id']: t['status'] for t in self.fake_gateway.transactions.values() if t['customer']['id'] == self.customer_id}
+
+    def test_partial_refund_recorded(self):
+        """
+        Given a partial refund of an unsettled transaction
+        When refund_payment is retried
+        Then the recorded resale is returned without a second void and sale
+        """
+        refund_payload = {'transaction_id': self.sale_id, 'refund_data': {'amount': '40.00'}}
+        resale_id = self.braintree_client.refund_payment(refund_payload, Money('40.00', 'USD'))
+        self.assertEqual(self.resale_ledger.get(self.sale_id), resale_id)
+        self.assertEqual(self.fake_gateway.transactions[resale_id]['amount'], '60.00')
+
+        self.assertEqual(self.braintree_client.refund_payment(refund_payload, Money('40.00', 'USD')), resale_id)
+        self.assertEqual(self._customer_transactions(), {self.sale_id: 'voided', resale_id: 'submitted_for_settlement'})
+
+    def test_full_amount_voided(self):
+        """
+        Given a partial refund of the whole amount of an unsettled transaction
+        When refund_payment is called
+        Then the transaction is voided without a resale
+        """
+        refund_payload = {'transaction_id': self.sale_id, 'refund_data': {'amount': '100.00'}}
+        self.assertEqual(self.braintree_client.refund_payment(refund_payload, Money('100.00', 'USD')), self.sale_id)
+        self.assertEqual(self._customer_transactions(), {self.sale_id: 'voided'})
+        self.assertIsNone(self.resale_ledger.get(self.sale_id))
+
+    def test_failed_void_not_resold(self):
+        """
+        Given a transaction voided outside of this client
+        When refund_payment for a partial refund is called
+        Then the failing void raises a PaymentClientError and no sale is sent
+        """
+        self.braintree_client.gateway.transaction.void(self.sale_id)
+        refund_payload = {'transaction_id': self.sale_id, 'refund_data': {'amount': '40.00'}}
+        with self.assertLogs('prose.test_braintree_lite', level='ERROR'):
+            with self.assertRaises(PaymentClientError):
+                self.braintree_client.refund_payment(refund_payload, Money('40.00', 'USD'))
+        self.assertEqual(self._customer_transactions(), {self.sale_id: 'voided'})
+        self.assertIsNone(self.resale_ledger.get(self.sale_id))
+
+    def test_failed_resale_recorded(self):
+        """
+        Given a gateway failing the sale of the remaining amount
+        When refund_payment for a partial refund is called
+        Then the failure is recorded for reconciliation and raised as a ResaleFailedError
+        """
+        self.fake_gateway.fail_next(1, status=503, route='sale')
+        refund_payload = {'transaction_id': self.sale_id, 'refund_data': {'amount': '40.00'}}
+        with self.assertLogs('prose.test_braintree_lite', level='ERROR'):
+            with self.assertRaises(ResaleFailedError) as e:
+                self.braintree_client.refund_payment(refund_payload, Money('40.00', 'USD'))
+        self.assertEqual((e.exception.transaction_id, e.exception.amount), (self.sale_id, Decimal('60.00')))
+        self.assertEqual(self._customer_transactions(), {self.sale_id: 'voided'})
+        self.assertEqual(
+            self.resale_ledger.failures(),
+            [
+                {
+                    'original_transaction_id': self.sale_id,
+                    'amount': '60.00',
+                    'refunded_amount': '40.00',
+                    'error': 'ServiceUnavailableError',
+                }
+            ],
+        )
+
+
+class TransactionStatusCacheTest(SimpleTestCase):
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.fake_gateway = FakeBraintreeGateway().start()
+        cls.addClassCleanup(cls.fake_gateway.stop)
+
+    def setUp(self):
+        super().setUp()
+        self.status_cache = TransactionStatusCache()
+        self.braintree_client = BraintreeClient(environment=self.fake_gateway.environment, status_cache=self.status_cache)
+        customer_id = self.braintree_client.create_customer(id=str(CustomerFactory.build().pubkey))
+        self.sale_id = self.braintree_client.create_payment_mode(
+            None,
+            {
+                'amount': '100',
+                'options': {'submit_for_settlement': True, 'store_in_vault_on_success': True},
+                'order_id': str(uuid4()),
+                'merchant_account_id': CURRENCY_MERCHANT_ACCOUNT_MAP.USD,
+                'customer_id': customer_id,
+                'payment_method_nonce': 'fake-valid-nonce',
+            },
+        )
+
+    def test_void_up_front(self):
+        """
+        Given a sale whose status was cached when it was created
+        When refund_payment for a full refund is called
+        Then the transaction is voided without a refund attempt
+        """
+        requests_count = self.fake_gateway.requests_count
+        self.assertEqual(self.braintree_client.refund_payment({'transaction_id': self.sale_id}, Money('100', 'USD')), self.sale_id)
+        self.assertEqual(self.fake_gateway.requests_count - requests_count, 1)
+        self.assertEqual(self.fake_gateway.transactions[self.sale_id]['status'], 'voided')
+        self.assertEqual(self.status_cache.get(self.sale_id), 'voided')
+        self.assertEqual(self.status_cache.stats['round_trips_saved'], 1)
+
+    def test_resale_up_front(self):
+        """
+        Given a sale whose status was cached when it was created
+        When refund_payment for a partial refund is called
+        Then the transaction is voided and resold without a refund attempt
+        """
+        requests_count = self.fake_gateway.requests_count
+        refund_payload = {'transaction_id': self.sale_id, 'refund_data': {'amount': '25.00'}}
+        resale_id = self.braintree_client.refund_payment(refund_payload, Money('25.00', 'USD'))
+        # find, void and sale
+        self.assertEqual(self.fake_gateway.requests_count - requests_count, 3)
+        self.assertEqual(self.status_cache.get(resale_id), 'submitted_for_settlement')
+        self.assertEqual(self.status_cache.round_trips_saved, 1)
+
+    def test_settled_by_feed(self):
+        """
+        Given a sale settled since, as reported by the status feed
+        When refund_payment is called
+        Then the transaction is refunded
+        """
+        self.braintree_client.gateway.testing.settle_transaction(self.sale_id)
+        self.status_cache.update(self.sale_id, 'settled')
+        refund_id = self.braintree_client.refund_payment({'transaction_id': self.sale_id}, Money('100', 'USD'))
+        self.assertEqual(self.fake_gateway.transactions[refund_id]['type'], 'credit')
+        self.assertEqual(self.status_cache.round_trips_saved, 0)
+
+    def test_stale_status(self):
+        """
+        Given a sale settled since, while its cached status is still submitted for settlement
+        When refund_payment is called
+        Then the failed void invalidates the status and the transaction is refunded
+        """
+        self.braintree_client.gateway.testing.settle_transaction(self.sale_id)
+        refund_id = self.braintree_client.refund_payment({'transaction_id': self.sale_id}, Money('100', 'USD'))
+        self.assertEqual(self.fake_gateway.transactions[refund_id]['refunded_transaction_id'], self.sale_id)
+        self.assertEqual(self.status_cache.round_trips_saved, 0)
+
+
+class BulkRefundPaymentsTest(SimpleTestCase):
+    def setUp(self):
+        super().setUp()
+        self.fake_gateway = FakeBraintreeGateway().start()
+        self.addCleanup(self.fake_gateway.stop)
+        self.braintree_client = BraintreeClient(environment=self.fake_gateway.environment)
+        self.customer_id = self.braintree_client.create_customer(id=str(CustomerFactory.build().pubkey))
+
+    def _create_sale(self):
+        return self.braintree_client.create_payment_mode(
+            None,
+            {
+                'amount': '100',
+                'options': {'submit_for_settlement': True, 'store_in_vault_on_success': True},
+                'order_id': str(uuid4()),
+                'merchant_account_id': CURRENCY_MERCHANT_ACCOUNT_MAP.USD,
+                'customer_id': self.customer_id,
+                'payment_method_nonce': 'fake-valid-nonce',
+            },
+        )
+
+    def test_refund_payments(self):
+        """
+        Given settled, unsettled, voided and unknown transactions
+        When refund_payments is called
+        Then unsettled ones are voided or resold first, settled ones refunded, and the others reported as failures
+        """
+        settled_ids = [self._create_sale() for _ in range(3)]
+        for sale_id in settled_ids:
+            self.braintree_client.gateway.testing.settle_transaction(sale_id)
+        unsettled_ids = [self._create_sale() for _ in range(3)]
+        voided_id = self._create_sale()
+        self.braintree_client.gateway.transaction.void(voided_id)
+        batch = [{'transaction_id': sale_id} for sale_id in settled_ids + unsettled_ids[:2]]
+        batch += [{'transaction_id': unsettled_ids[2], 'refund_data': {'amount': '10.00'}}]
+        batch += [{'transaction_id': voided_id}, {'transaction_id': 'unknown'}]
+
+        stats = BulkStats()
+        results = list(self.braintree_client.refund_payments(batch, max_workers=4, rate_limit=100, stats=stats, chunk_size=5))
+
+        self.assertEqual(
+            [result.transaction_id for result in results], unsettled_ids[:2] + settled_ids + unsettled_ids[2:] + [voided_id, 'unknown']
+        )
+        self.assertEqual([result.action for result in results], ['void'] * 2 + ['refund'] * 3 + ['resale', None, None])
+        self.assertTrue(all(result.refunded for result in results[:6]))
+        self.assertEqual(results[-1].error, 'Transaction unknown cannot be refunded in status None')
+        self.assertEqual((stats.succeeded, stats.failed), (6, 2))
+        self.assertEqual(self.fake_gateway.transactions[results[5].id]['amount'], '90.00')
+        for result in results[2:5]:
+            self.assertEqual(self.fake_gateway.transactions[result.id]['refunded_transaction_id'], result.transaction_id)
+
+    def test_refund_payments_retry(self):
+        """
+        Given a gateway answering 503 to a refund
+        When refund_payments is called
+        Then the refund is retried after a backoff
+        """
+        sale_id = self._create_sale()
+        self.braintree_client.gateway.testing.settle_transaction(sale_id)
+        self.fake_gateway.fail_next(2, status=503, route='refund')
+        retry_policy = RetryPolicy(attempts=3, sleep=lambda delay: None)
+        results = list(self.braintree_client.refund_payments([{'transaction_id': sale_id}], retry_policy=retry_policy))
+        self.assertTrue(results[0].refunded)
+        self.assertEqual(self.fake_gateway.transactions[results[0].id]['type'], 'credit')
+        self.assertEqual(retry_policy.retries, 2)
+
+        self.fake_gateway.fail_next(3, status=429, route='refund')
+        sale_id = self._create_sale()
+        self.braintree_client.gateway.testing.settle_transaction(sale_id)
+        results = list(self.braintree_client.refund_payments([{'transaction_id': sale_id}], retry_policy=retry_policy))
+        self.assertEqual(
+            results[0],
+            RefundedObjectDataClass(transaction_id=sale_id, id=None, action='refund', refunded=False, error='TooManyRequestsError'),
+        )
+        self.assertEqual(retry_policy.retries, 4)
+
+    def test_refund_payments_retry_budget(self):
+        """
+        Given a client whose retry policy has a budget of one retry
+        When refund_payments meets repeated 503s
+        Then its calls are retried by the client's policy alone, within the budget
+        """
+        sale_id = self._create_sale()
+        self.braintree_client.gateway.testing.settle_transaction(sale_id)
+        retry_policy = RetryPolicy(attempts=3, budget=RetryBudget(ratio=0, max_tokens=1), sleep=lambda delay: None)
+        self.braintree_client.retry_policy = retry_policy
+        requests_count = self.fake_gateway.requests_count
+        self.fake_gateway.fail_next(3, status=503, route='refund')
+        results = list(self.braintree_client.refund_payments([{'transaction_id': sale_id}]))
+        self.assertEqual(results[0].error, 'ServiceUnavailableError')
+        self.assertEqual((retry_policy.retries, retry_policy.budget.exhausted), (1, 1))
+        # ids search, transactions page and two refund attempts
+        self.assertEqual(self.fake_gateway.requests_count - requests_count, 4)
+
+
+class ErrorLoggingTest(SimpleTestCase):
+    class GatewayError(Exception):
+        def __init__(self, message):
+            super().__init__(message)
+            self.message = message
+            self.code = '91506'
+            self.response = {'transaction': {'id': 'abc'}}
+            self.formatted = 0
+
+        def __str__(self):
+            self.formatted += 1
+            return self.message
+
+    def test_log_error(self):
+        """
+        Given a gateway error with many attributes
+        When log_error is called
+        Then the message is formatted from the error and only the selected attributes are kept, bounded, in a record
+        pointing at the caller
+        """
+        err = self.GatewayError('x' * 1000)
+        with self.assertLogs('prose.test_braintree_lite', level='ERROR') as cm:
+            log_error(logger, 'Error refunding payment: %s', err)
+        self.assertEqual(cm.output, [f'ERROR:prose.test_braintree_lite:Error refunding payment: {"x" * 1000}'])
+        self.assertEqual(cm.records[0].err__dict, {'code': '91506', 'message': 'x' * 256})
+        self.assertEqual((cm.records[0].pathname, cm.records[0].funcName), (__file__, 'test_log_error'))
+
+    def test_log_error_disabled(self):
+        """
+        Given a logger that drops errors
+        When log_error is called
+        Then the error is neither formatted nor inspected
+        """
+        err = self.GatewayError('Cannot refund transaction unless it is settled.')
+        silent_logger = logging.getLogger('prose.test_braintree_lite.silent')
+        silent_logger.setLevel(logging.CRITICAL)
+        self.addCleanup(silent_logger.setLevel, logging.NOTSET)
+        log_error(silent_logger, 'Error refunding payment: %s', err)
+        self.assertEqual(err.formatted, 0)
+
+    def test_repeated_error_filter(self):
+        """
+        Given a filter letting 2 records of the same logging call through per minute
+        When an error is logged repeatedly
+        Then the repeats are dropped, without being formatted, until the next minute, whose first record counts them
+        """
+        now = [0.0]
+        repeated_error_filter = RepeatedErrorFilter(burst=2, interval=60, clock=lambda: now[0])
+        logger.addFilter(repeated_error_filter)
+        self.addCleanup(logger.removeFilter, repeated_error_filter)
+        err = self.GatewayError('Service unavailable')
+
+        def get_token():
+            log_error(logger, 'Error getting token: %s', err)
+
+        with self.assertLogs('prose.test_braintree_lite', level='ERROR') as cm:
+            for _ in range(5):
+                get_token()
+            log_error(logger, 'Error creating customer: %s', err)
+            now[0] = 60
+            get_token()
+        self.assertEqual(len(cm.records), 4)
+        self.assertEqual([record.suppressed for record in cm.records], [0, 0, 0, 3])
+        self.assertEqual(repeated_error_filter.suppressed, 3)
+        self.assertEqual(err.formatted, 4)
+
+    def test_repeated_error_filter_distinct_errors(self):
+        """
+        Given a filter letting 2 records of the same logging call through per minute
+        When that call logs a repeated error, then an error of another class or code
+        Then the other errors are let through
+        """
+        repeated_error_filter = RepeatedErrorFilter(burst=2, interval=60, clock=lambda: 0.0)
+        logger.addFilter(repeated_error_filter)
+        self.addCleanup(logger.removeFilter, repeated_error_filter)
+        declined = self.GatewayError('Do Not Honor')
+        other_code = self.GatewayError('Insufficient Funds')
+        other_code.code = '2001'
+        with self.assertLogs('prose.test_braintree_lite', level='ERROR') as cm:
+            for err in (declined, declined, declined, other_code, braintree.exceptions.ServiceUnavailableError()):
+                log_error(logger, 'Error creating payment mode: %s', err)
+        self.assertEqual(len(cm.records), 4)
+        self.assertEqual([record.args[0] for record in cm.records[:3]], [declined, declined, other_code])
+        self.assertIsInstance(cm.records[3].args[0], braintree.exceptions.ServiceUnavailableError)
+        self.assertEqual(repeated_error_filter.suppressed, 1)
+
+
+class ClientMetricsTest(SimpleTestCase):
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.fake_gateway = FakeBraintreeGateway().start()
+        cls.addClassCleanup(cls.fake_gateway.stop)
+
+    def test_latency_histogram(self):
+        """
+        Given latencies from 1 to 10000 microseconds
+        When percentiles are read from the histogram
+        Then they are within the bucket precision of the exact ones
+        """
+        histogram = LatencyHistogram()
+        for microseconds in range(1, 10001):
+            histogram.record(microseconds / 1_000_000)
+        self.assertEqual(histogram.count, 10000)
+        self.assertAlmostEqual(histogram.percentile(0.5), 0.005, delta=0.005 * 0.04)
+        self.assertAlmostEqual(histogram.percentile(0.99), 0.0099, delta=0.0099 * 0.04)
+        self.assertEqual(histogram.percentile(1), 0.01)
+        histogram = LatencyHistogram()
+        histogram.record(0.000042)
+        self.assertEqual(histogram.percentile(0.5), 0.000042)
+
+    def test_client_metrics(self):
+        """
+        Given a client with metrics
+        When its methods succeed and fail
+        Then latencies and outcomes by error class and code are exported to the sinks
+        """
+        snapshots = []
+        metrics = ClientMetrics(sink=CallbackSink(snapshots.append))
+        braintree_client = BraintreeClient(environment=self.fake_gateway.environment, metrics=metrics)
+        customer_id = braintree_client.create_customer(id=str(CustomerFactory.build().pubkey))
+        for _ in range(3):
+            braintree_client.get_token(customer_id)
+        sale_options = {
+            'amount': '100',
+            'order_id': str(uuid4()),
+            'merchant_account_id': CURRENCY_MERCHANT_ACCOUNT_MAP.USD,
+            'customer_id': customer_id,
+            'payment_method_nonce': 'fake-processor-declined-visa-nonce',
+        }
+        with self.assertLogs('prose.test_braintree_lite', level='ERROR'):
+            with self.assertRaises(PaymentClientError) as e:
+                braintree_client.create_payment_mode(None, sale_options)
+        self.assertEqual(e.exception.code, '2001')
+
+        metrics.export()
+        self.assertEqual(set(snapshots[0]), {'create_customer', 'get_token', 'create_payment_mode'})
+        self.assertEqual(snapshots[0]['get_token']['count'], 3)
+        self.assertEqual(snapshots[0]['create_payment_mode']['errors'], 1)
+        self.assertEqual(snapshots[0]['get_token']['in_flight'], 0)
+        self.assertGreater(snapshots[0]['get_token']['p99'], 0)
+
+        tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp_dir.cleanup)
+        metrics.sink = PrometheusTextSink(os.path.join(tmp_dir.name, 'braintree.prom'))
+        metrics.export()
+        with open(metrics.sink.path) as metrics_file:
+            lines = metrics_file.read().splitlines()
+        self.assertIn('braintree_client_request_duration_seconds_count{method="get_token"} 3', lines)
+        self.assertIn('braintree_client_requests_total{method="get_token",error="",code=""} 3', lines)
+        self.assertIn('braintree_client_requests_total{method="create_payment_mode",error="PaymentClientError",code="2001"} 1', lines)
+        self.assertIn('braintree_client_requests_in_flight{method="get_token"} 0', lines)
+
+    def test_in_flight(self):
+        """
+        Given calls in progress
+        When a snapshot is taken
+        Then they are counted as in flight
+        """
+        metrics = ClientMetrics()
+        with metrics.observe('refund_payment'), metrics.observe('refund_payment'):
+            self.assertEqual(metrics.in_flight['refund_payment'], 2)
+        self.assertEqual(metrics.snapshot()['refund_payment']['in_flight'], 0)
+
+
+class CircuitBreakerTest(SimpleTestCase):
+    def setUp(self):
+        super().setUp()
+        self.fake_gateway = FakeBraintreeGateway().start()
+        self.addCleanup(self.fake_gateway.stop)
+        self.now = 0.0
+        self.circuit_breakers = CircuitBreakers(failure_threshold=3, recovery_timeout=30, clock=lambda: self.now)
+        self.braintree_client = BraintreeClient(environment=self.fake_gateway.environment, circuit_breakers=self.circuit_breakers)
+        self.customer_id = self.braintree_client.create_customer(id=str(CustomerFactory.build().pubkey))
+
+    def test_open_and_recover(self):
+        """
+        Given a gateway failing token generation
+        When get_token keeps being called
+        Then the circuit opens after 3 failures and fails fast, and a successful probe after the recovery timeout closes it
+        """
+        self.fake_gateway.fail_next(3, status=503)
+        for _ in range(3):
+            with self.assertLogs('prose.test_braintree_lite', level='ERROR'):
+                with self.assertRaises(braintree.exceptions.ServiceUnavailableError):
+                    self.braintree_client.get_token(self.customer_id)
+        requests_count = self.fake_gateway.requests_count
+        with self.assertRaises(PaymentClientError) as e:
+            self.braintree_client.get_token(self.customer_id)
+        self.assertEqual(str(e.exception), 'Braintree token calls are suspended after repeated failures')
+        self.assertEqual(self.fake_gateway.requests_count, requests_count)
+        self.assertEqual(self.circuit_breakers['token'].rejected, 1)
+        # Other operations have their own circuit
+        self.assertTrue(self.braintree_client.delete_customer(self.customer_id).deleted)
+
+        self.now = 30
+        self.customer_id = self.braintree_client.create_customer(id=str(CustomerFactory.build().pubkey))
+        self.assertIsNotNone(self.braintree_client.get_token(self.customer_id))
+        self.assertEqual(self.circuit_breakers['token'].state, CircuitBreaker.CLOSED)
+
+    def test_failed_probe(self):
+        """
+        Given an open circuit
+        When the probe after the recovery timeout fails
+        Then the circuit opens again for another recovery timeout
+        """
+        self.fake_gateway.fail_next(4, status=503)
+        with self.assertLogs('prose.test_braintree_lite', level='ERROR'):
+            for _ in range(3):
+                with self.assertRaises(braintree.exceptions.ServiceUnavailableError):
+                    self.braintree_client.get_token(self.customer_id)
+        self.assertEqual(self.circuit_breakers['token'].state, CircuitBreaker.OPEN)
+        self.now = 30
+        with self.assertLogs('prose.test_braintree_lite', level='ERROR'):
+            with self.assertRaises(braintree.exceptions.ServiceUnavailableError):
+                self.braintree_client.get_token(self.customer_id)
+        self.now = 59
+        with self.assertRaises(PaymentClientError):
+            self.braintree_client.get_token(self.customer_id)
+        self.now = 60
+        self.assertIsNotNone(self.braintree_client.get_token(self.customer_id))
+
+    def test_declines_are_not_failures(self):
+        """
+        Given declined payments
+        When create_payment_mode is called repeatedly
+        Then the sale circuit stays closed
+        """
+        sale_options = {
+            'amount': '100',
+            'merchant_account_id': CURRENCY_MERCHANT_ACCOUNT_MAP.USD,
+            'customer_id': self.customer_id,
+            'payment_method_nonce': 'fake-processor-declined-visa-nonce',
+        }
+        with self.assertLogs('prose.test_braintree_lite', level='ERROR'):
+            for _ in range(5):
+                with self.assertRaises(PaymentClientError):
+                    self.braintree_client.create_payment_mode(None, dict(sale_options, order_id=str(uuid4())))
+        self.assertEqual(self.circuit_breakers['sale'].state, CircuitBreaker.CLOSED)
+
+    def test_adaptive_timeout(self):
+        """
+        Given fast gateway requests
+        When enough of them have been observed
+        Then the timeout applied to the requests drops from the configured one to the minimum
+        """
+        circuit_breaker = CircuitBreaker('token', min_timeout=0.5, max_timeout=60)
+        applied_timeouts = []
+        for _ in range(20):
+            with circuit_breaker.guard():
+                applied_timeouts.append(request_timeout.get())
+                request_latency_observer.get()(0.01)
+        self.assertEqual(applied_timeouts, [60] * 20)
+        self.assertEqual(circuit_breaker.timeout, 0.5)
+        with circuit_breaker.guard():
+            self.assertEqual(request_timeout.get(), 0.5)
+        self.assertIsNone(request_timeout.get())
+        self.assertIsNone(request_latency_observer.get())
+
+    def test_timeout_follows_requests(self):
+        """
+        Given a slow gateway and a token cache
+        When get_token is mostly answered from the cache
+        Then only the gateway requests are timed, and the timeout stays above their latency
+        """
+        self.fake_gateway.latency = 0.05
+        circuit_breakers = CircuitBreakers(min_timeout=0.01)
+        braintree_client = BraintreeClient(
+            environment=self.fake_gateway.environment, token_cache=ClientTokenCache(), circuit_breakers=circuit_breakers
+        )
+        for _ in range(40):
+            braintree_client.get_token(self.customer_id)
+        self.assertEqual(circuit_breakers['token'].timeout, DEFAULT_TIMEOUT)
+
+        braintree_client.token_cache = None
+        for _ in range(20):
+            braintree_client.get_token(self.customer_id)
+        self.assertGreaterEqual(circuit_breakers['token'].timeout, 0.15)
+        self.assertLess(circuit_breakers['token'].timeout, DEFAULT_TIMEOUT)
+
+    def test_refund_payments_guarded(self):
+        """
+        Given a gateway failing refunds
+        When refund_payments is called
+        Then the refund circuit opens and the following refunds of the batch fail fast
+        """
+        sale_ids = []
+        for _ in range(5):
+            sale = self.braintree_client.gateway.transaction.sale(
+                {
+                    'amount': '100',
+                    'options': {'submit_for_settlement': True},
+                    'customer_id': self.customer_id,
+                    'payment_method_nonce': 'fake-valid-nonce',
+                }
+            )
+            self.braintree_client.gateway.testing.settle_transaction(sale.transaction.id)
+            sale_ids.append(sale.transaction.id)
+        self.fake_gateway.fail_next(3, status=503, route='refund')
+        results = list(
+            self.braintree_client.refund_payments(
+                [{'transaction_id': sale_id} for sale_id in sale_ids], max_workers=1, retry_policy=RetryPolicy(attempts=1)
+            )
+        )
+        self.assertEqual([result.error for result in results[:3]], ['ServiceUnavailableError'] * 3)
+        self.assertEqual(
+            [result.error for result in results[3:]], ['Braintree refund calls are suspended after repeated failures'] * 2
+        )
+        self.assertEqual(self.circuit_breakers['refund'].rejected, 2)
+
+
+class RetryPolicyTest(SimpleTestCase):
+    def setUp(self):
+        super().setUp()
+        self.fake_gateway = FakeBraintreeGateway().start()
+        self.addCleanup(self.fake_gateway.stop)
+        self.delays = []
+        self.retry_policy = RetryPolicy(attempts=3, backoff=0.1, sleep=self.delays.append, jitter=lambda: 1)
+        self.braintree_client = BraintreeClient(environment=self.fake_gateway.environment, retry_policy=self.retry_policy)
+        self.customer_id = self.braintree_client.create_customer(id=str(CustomerFactory.build().pubkey))
+
+    def _sale_options(self, **kwargs):
+        return {
+            'amount': '100',
+            'options': {'submit_for_settlement': True},
+            'merchant_account_id': CURRENCY_MERCHANT_ACCOUNT_MAP.USD,
+            'customer_id': self.customer_id,
+            'payment_method_nonce': 'fake-valid-nonce',
+            **kwargs,
+        }
+
+    def test_retry_reads(self):
+        """
+        Given a gateway answering 500 twice to a customer lookup
+        When retrieve_customer is called
+        Then the lookup is retried with exponential backoff
+        """
+        self.fake_gateway.fail_next(2, status=500, route='find_customer')
+        self.assertEqual(self.braintree_client.retrieve_customer(self.customer_id), self.customer_id)
+        self.assertEqual(self.delays, [0.1, 0.2])
+
+    def test_retry_sale_with_order_id(self):
+        """
+        Given a sale processed by the gateway whose response is lost
+        When create_payment_mode is called with an order_id
+        Then the retry, rejected as a duplicate, returns the transaction of the first attempt
+        """
+        self.fake_gateway.fail_next(1, status=500, route='sale', processed=True)
+        sale_id = self.braintree_client.create_payment_mode(None, self._sale_options(order_id=str(uuid4())))
+        self.assertEqual(self.fake_gateway.transactions[sale_id]['status'], 'submitted_for_settlement')
+        self.assertEqual(
+            sorted(t['status'] for t in self.fake_gateway.transactions.values()), ['gateway_rejected', 'submitted_for_settlement']
+        )
+
+    def test_no_retry_unguarded_sale(self):
+        """
+        Given a sale without order_id
+        When the gateway fails with an ambiguous 500 or a transient 503
+        Then only the 503 is retried
+        """
+        self.fake_gateway.fail_next(1, status=503, route='sale')
+        self.assertIsNotNone(self.braintree_client.create_payment_mode(None, self._sale_options()))
+        self.fake_gateway.fail_next(1, status=500, route='sale', processed=True)
+        with self.assertLogs('prose.test_braintree_lite', level='ERROR'):
+            with self.assertRaises(braintree.exceptions.ServerError):
+                self.braintree_client.create_payment_mode(None, self._sale_options())
+        self.assertEqual(self.delays, [0.1])
+
+    def test_retry_budget(self):
+        """
+        Given a retry budget of one retry
+        When gateway calls keep failing
+        Then the first call is retried once and the next ones are not retried at all
+        """
+        self.retry_policy.budget = RetryBudget(ratio=0, max_tokens=1)
+        self.fake_gateway.fail_next(6, status=503)
+        with self.assertLogs('prose.test_braintree_lite', level='WARNING'):
+            for _ in range(3):
+                self.assertIsNone(self.braintree_client.retrieve_customer(self.customer_id))
+        self.assertEqual(self.retry_policy.retries, 1)
+        self.assertEqual(self.retry_policy.budget.exhausted, 3)
+        self.assertEqual(self.fake_gateway.requests_count, 5)
+
+
+class PaymentSourceInfoTest(SimpleTestCase):
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.fake_gateway = FakeBraintreeGateway().start()
+        cls.addClassCleanup(cls.fake_gateway.stop)
+        braintree_client = BraintreeClient(environment=cls.fake_gateway.environment)
+        customer_id = braintree_client.create_customer(id=str(CustomerFactory.build().pubkey))
+        cls.sale_ids = [
+            braintree_client.create_payment_mode(
+                None,
+                {
+                    'amount': '100',
+                    'order_id': str(uuid4()),
+                    'merchant_account_id': CURRENCY_MERCHANT_ACCOUNT_MAP.USD,
+                    'customer_id': customer_id,
+                    'payment_method_nonce': nonce,
+                },
+            )
+            for nonce in ['fake-paypal-one-time-nonce'] * 3 + ['fake-valid-nonce']
+        ]
+        # A payer without last name
+        cls.fake_gateway.transactions[cls.sale_ids[2]]['paypal'].pop('payer_last_name')
+
+    def setUp(self):
+        super().setUp()
+        self.braintree_client = BraintreeClient(
+            environment=self.fake_gateway.environment, payment_source_info_cache=PaymentSourceInfoCache()
+        )
+
+    def test_get_payment_source_info_cached(self):
+        """
+        Given a PayPal transaction
+        When get_payment_source_info is called twice
+        Then the payer info is fetched once
+        """
+        requests_count = self.fake_gateway.requests_count
+        for _ in range(2):
+            self.assertEqual(
+                self.braintree_client.get_payment_source_info(self.sale_ids[0]),
+                PaypalPaymentInfoDataClass(email='payer@example.com', name='John Doe'),
+            )
+        self.assertEqual(self.fake_gateway.requests_count, requests_count + 1)
+        self.assertEqual(self.braintree_client.payment_source_info_cache.stats, {'hits': 1, 'misses': 1})
+
+    def test_get_payment_source_info_missing_name(self):
+        """
+        Given a PayPal payer without last name
+        When get_payment_source_info is called
+        Then the name is the first name alone
+        """
+        self.assertEqual(
+            self.braintree_client.get_payment_source_info(self.sale_ids[2]),
+            PaypalPaymentInfoDataClass(email='payer@example.com', name='John'),
+        )
+
+    def test_get_payment_source_infos(self):
+        """
+        Given PayPal, card and unknown payment mode ids, one of them cached
+        When get_payment_source_infos is called
+        Then the uncached PayPal ones are resolved by a search and the others left out
+        """
+        self.braintree_client.get_payment_source_info(self.sale_ids[0])
+        requests_count = self.fake_gateway.requests_count
+        payment_source_infos = self.braintree_client.get_payment_source_infos(self.sale_ids + ['unknown'])
+        self.assertEqual(
+            payment_source_infos,
+            {
+                self.sale_ids[0]: PaypalPaymentInfoDataClass(email='payer@example.com', name='John Doe'),
+                self.sale_ids[1]: PaypalPaymentInfoDataClass(email='payer@example.com', name='John Doe'),
+                self.sale_ids[2]: PaypalPaymentInfoDataClass(email='payer@example.com', name='John'),
+            },
+        )
+        self.assertEqual(self.fake_gateway.requests_count, requests_count + 1)
+
+    def test_get_payment_source_infos_chunked(self):
+        """
+        Given more payment mode ids than a search page holds
+        When get_payment_source_infos is called
+        Then they are looked up one page at a time
+        """
+        requests_count = self.fake_gateway.requests_count
+        payment_mode_ids = self.sale_ids[:2] + [f'unknown-{index}' for index in range(60)]
+        self.assertEqual(set(self.braintree_client.get_payment_source_infos(payment_mode_ids)), set(self.sale_ids[:2]))
+        self.assertEqual(self.fake_gateway.requests_count, requests_count + 2)
+
+    def test_get_payment_source_infos_fast_xml(self):
+        """
+        Given a client parsing search responses with prose.fast_xml
+        When get_payment_source_infos is called
+        Then the payer infos are the same as with the default parser
+        """
+        braintree_client = BraintreeClient(environment=self.fake_gateway.environment, fast_xml=True)
+        self.assertEqual(
+            braintree_client.get_payment_source_infos(self.sale_ids + ['unknown']),
+            BraintreeClient(environment=self.fake_gateway.environment).get_payment_source_infos(self.sale_ids + ['unknown']),
+        )
+
+    def test_parse_transactions(self):
+        """
+        Given a raw transaction search response
+        When parse_transactions is called
+        Then the selected fields match those of the braintree Transactions, and other responses are rejected
+        """
+        gateway = self.braintree_client.gateway
+        path = gateway.config.base_merchant_path() + '/transactions/advanced_search'
+        params = {'search': {'ids': braintree.TransactionSearch.ids.in_list(self.sale_ids).to_param()}}
+        xml = RawXmlHttp(gateway.config).post(path, params)
+        transactions = {transaction['id']: transaction for transaction in parse_transactions(xml)}
+        self.assertEqual(set(transactions), set(self.sale_ids))
+        for expected in self.braintree_client.iter_transactions(braintree.TransactionSearch.ids.in_list(self.sale_ids)):
+            transaction = transactions[expected.id]
+            self.assertEqual(
+                (transaction['amount'], transaction['currency_iso_code'], transaction['status'], transaction['order_id']),
+                (expected.amount, expected.currency_iso_code, expected.status, expected.order_id),
+            )
+            self.assertEqual(transaction['customer']['id'], expected.customer_details.id)
+            paypal_details = getattr(expected, 'paypal_details', None)
+            if paypal_details is None:
+                self.assertFalse(transaction['paypal'])
+            else:
+                self.assertEqual(transaction['paypal'], {name: getattr(paypal_details, name) for name in paypal_details._setattrs})
+        with self.assertRaises(NotACollectionError):
+            parse_transactions(RawXmlHttp(gateway.config).post(path + '_ids', params))
+        with self.assertRaises(NotACollectionError):
+            parse_transactions('')
+        malformed_amount = xml.replace('<amount>', '<amount>x', 1)
+        with self.assertRaises(InvalidOperation):
+            parse_transactions(malformed_amount)
+
+    def test_search_parse_error_not_retried(self):
+        """
+        Given a search response with a malformed timestamp
+        When transaction records are searched with a retry policy
+        Then the parse error is raised without a retry
+        """
+        transaction = self.fake_gateway.transactions[self.sale_ids[0]]
+        self.addCleanup(transaction.pop, 'updated_at')
+        transaction['updated_at'] = 'yesterday'
+        retry_policy = RetryPolicy(sleep=lambda delay: None)
+        braintree_client = BraintreeClient(environment=self.fake_gateway.environment, retry_policy=retry_policy)
+        with self.assertRaises(ValueError):
+            list(braintree_client.search_transaction_records(braintree.TransactionSearch.ids.in_list(self.sale_ids)))
+        self.assertEqual(retry_policy.retries, 0)
+
+
+class MerchantAccountRouterTest(SimpleTestCase):
+    router = MerchantAccountRouter.from_config(
+        {
+            'currencies': {'USD': 'prose-usd', 'cad': 'prose-cad'},
+            'regions': {'QC': {'CAD': 'prose-cad-qc'}, 'EU': {'EUR': 'prose-eur'}},
+            'card_brands': {'American Express': {'USD': 'prose-usd-amex', 'CAD': 'prose-cad-amex'}},
+        }
+    )
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.fake_gateway = FakeBraintreeGateway().start()
+        cls.addClassCleanup(cls.fake_gateway.stop)
+        cls.braintree_client = BraintreeClient(environment=cls.fake_gateway.environment, merchant_account_router=cls.router)
+
+    def test_resolve(self):
+        """
+        Given currency accounts with region and card brand overrides
+        When resolve is called
+        Then the most specific account is returned, card brand overrides winning over region ones
+        """
+        self.assertEqual(self.router.resolve('USD'), 'prose-usd')
+        self.assertEqual(self.router.resolve('cad'), 'prose-cad')
+        self.assertEqual(self.router.resolve('CAD', region='QC'), 'prose-cad-qc')
+        self.assertEqual(self.router.resolve('CAD', region='ON'), 'prose-cad')
+        self.assertEqual(self.router.resolve('CAD', region='QC', card_brand='American Express'), 'prose-cad-amex')
+        self.assertEqual(self.router.resolve('USD', card_brand='Visa'), 'prose-usd')
+        self.assertEqual(self.router.resolve('EUR', region='EU'), 'prose-eur')
+        with self.assertRaises(NoMerchantAccountError):
+            self.router.resolve('EUR')
+        with self.assertRaises(NoMerchantAccountError):
+            self.router.resolve('GBP', region='EU')
+
+    def test_default_router_from_settings(self):
+        """
+        Given merchant accounts configured in the BRAINTREE_MERCHANT_ACCOUNTS setting, or not
+        When a client is built without a router
+        Then its router uses the setting, or falls back to the currency merchant account map
+        """
+        gateway = self.braintree_client.gateway
+        self.assertEqual(BraintreeClient(gateway=gateway).merchant_account_router.resolve('CAD'), 'prose-cad')
+        with override_settings(BRAINTREE_MERCHANT_ACCOUNTS={'currencies': {'CAD': 'prose-cad-staging'}}):
+            router = BraintreeClient(gateway=gateway).merchant_account_router
+            self.assertEqual(router.resolve('CAD'), 'prose-cad-staging')
+            with self.assertRaises(NoMerchantAccountError):
+                router.resolve('USD')
+            self.assertIs(BraintreeClient(gateway=gateway).merchant_account_router, router)
+        self.assertEqual(BraintreeClient(gateway=gateway).merchant_account_router.resolve('CAD'), 'prose-cad')
+
+    def _sale_options(self, amount, **kwargs):
+        return {
+            'amount': amount,
+            'options': {'submit_for_settlement': True},
+            'payment_method_nonce': 'fake-valid-nonce',
+            **kwargs,
+        }
+
+    def test_create_payment_mode_money_amount(self):
+        """
+        Given Money amounts
+        When create_payment_mode is called without a merchant_account_id
+        Then the sale goes to the merchant account of the amount currency
+        """
+        for amount in (Money('100', 'USD'), Money('25.50', 'CAD')):
+            with self.subTest(amount=amount):
+                transaction_id = self.braintree_client.create_payment_mode(None, self._sale_options(amount))
+                transaction = self.braintree_client.gateway.transaction.find(transaction_id)
+                self.assertEqual(transaction.currency_iso_code, amount.currency)
+                self.assertEqual(transaction.amount, amount.amount)
+
+    def test_create_payment_mode_explicit_merchant_account(self):
+        """
+        Given a Money amount and a merchant_account_id
+        When create_payment_mode is called
+        Then the given merchant account is kept
+        """
+        sale_options = self._sale_options(Money('100', 'USD'), merchant_account_id=CURRENCY_MERCHANT_ACCOUNT_MAP.CAD)
+        transaction_id = self.braintree_client.create_payment_mode(None, sale_options)
+        self.assertEqual(self.braintree_client.gateway.transaction.find(transaction_id).currency_iso_code, 'CAD')
+
+    def test_create_payment_mode_unroutable_currency(self):
+        """
+        Given a Money amount in a currency without merchant account
+        When create_payment_mode is called
+        Then a PaymentClientError is raised before reaching the gateway
+        """
+        requests_count = self.fake_gateway.requests_count
+        with self.assertLogs('prose.test_braintree_lite', level='ERROR'):
+            with self.assertRaisesRegex(PaymentClientError, 'No merchant account accepts GBP payments'):
+                self.braintree_client.create_payment_mode(None, self._sale_options(Money('100', 'GBP')))
+        self.assertEqual(self.fake_gateway.requests_count, requests_count)
+
+
+class ColumnarExportTest(SimpleTestCase):
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.fake_gateway = FakeBraintreeGateway().start()
+        cls.addClassCleanup(cls.fake_gateway.stop)
+        cls.braintree_client = BraintreeClient(environment=cls.fake_gateway.environment)
+        cls.customer_id = cls.braintree_client.create_customer(id=str(CustomerFactory.build().pubkey))
+        sale_ids = [
+            cls.braintree_client.create_payment_mode(
+                None,
+                {
+                    'amount': amount,
+                    'options': {'submit_for_settlement': True},
+                    'customer_id': cls.customer_id,
+                    'payment_method_nonce': 'fake-valid-nonce',
+                },
+            )
+            for amount in [Money('10.50', 'USD')] * 3 + [Money('20', 'CAD')] * 2
+        ]
+        cls.braintree_client.gateway.testing.settle_transaction(sale_ids[0])
+
+    def setUp(self):
+        super().setUp()
+        tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp_dir.cleanup)
+        self.path = Path(tmp_dir.name) / 'transactions.col'
+        self.query = braintree.TransactionSearch.customer_id == self.customer_id
+        self.columns = export_transactions(self.braintree_client, self.path, self.query)
+
+    def test_export_transactions(self):
+        """
+        Given transactions in two currencies and statuses
+        When they are exported and the file is opened
+        Then the mapped columns hold the search results, and total per currency and status
+        """
+        columns = TransactionColumns.open(self.path)
+        self.addCleanup(columns.close)
+        records = list(self.braintree_client.search_transaction_records(self.query))
+        self.assertEqual(len(columns), 5)
+        for index, record in enumerate(records):
+            self.assertEqual(
+                (columns.value('id', index), columns.value('status', index), columns.value('customer_id', index)),
+                (record.id, record.status, record.customer_id),
+            )
+            amount = from_minor_units(columns.value('amount', index), columns.value('currency_iso_code', index))
+            self.assertEqual(amount, record.amount)
+            created_at = datetime.fromtimestamp(columns.value('created_at', index), timezone.utc).replace(tzinfo=None)
+            self.assertEqual(created_at, record.created_at)
+        self.assertEqual(columns.value('order_id', 0), '')
+        for incomplete in (replace(records[0], amount=None), replace(records[0], currency_iso_code=None)):
+            with self.assertRaises(ValueError):
+                TransactionColumns().append(incomplete)
+        expected_totals = {
+            ('CAD', 'submitted_for_settlement'): (Decimal('40.00'), 2),
+            ('USD', 'submitted_for_settlement'): (Decimal('21.00'), 2),
+            ('USD', 'settled'): (Decimal('10.50'), 1),
+        }
+        self.assertEqual(columns.totals(by=('currency_iso_code', 'status')), expected_totals)
+        self.assertEqual(self.columns.totals(by=('currency_iso_code', 'status')), expected_totals)
+        self.assertEqual(columns.totals(), {('CAD',): (Decimal('40.00'), 2), ('USD',): (Decimal('31.50'), 3)})
+        self.assertEqual(columns.amounts().totals(), {'CAD': Money('40', 'CAD'), 'USD': Money('31.50', 'USD')})
+        with self.assertRaises(ValueError):
+            columns.totals(by=('status',))
+
+    @skipUnless(numpy, 'numpy is not installed')
+    def test_totals_numpy(self):
+        """
+        Given exported transactions
+        When they are totalled with numpy
+        Then the totals are those of the pure Python path
+        """
+        by = ('currency_iso_code', 'status', 'customer_id')
+        self.assertEqual(self.columns._sums_numpy(by), self.columns._sums_python(by))
+
+    @skipUnless(numpy, 'numpy is not installed')
+    def test_totals_numpy_wide(self):
+        """
+        Given columns whose dictionaries are too large to combine their codes into int64 keys
+        When they are totalled with numpy
+        Then the rows of codes are grouped instead, giving the totals of the pure Python path
+        """
+        record = next(self.braintree_client.search_transaction_records(self.query))
+        columns = TransactionColumns()
+        for index in list(range(6500)) * 2:
+            values = {name: f'{name}-{index}' for name in DICTIONARY_COLUMNS}
+            columns.append(replace(record, **values, amount=Decimal(index)))
+        self.assertGreater(math.prod(len(columns.dictionaries[name]) for name in DICTIONARY_COLUMNS), numpy.iinfo(numpy.int64).max)
+        sums = columns._sums_numpy(DICTIONARY_COLUMNS)
+        self.assertEqual(sums, columns._sums_python(DICTIONARY_COLUMNS))
+        self.assertEqual(sums[tuple(f'{name}-42' for name in DICTIONARY_COLUMNS)], (8400, 2))
+
+    def test_totals_overflow(self):
+        """
+        Given amounts whose sum does not fit in int64 minor units
+        When they are totalled
+        Then the total is exact rather than wrapped around
+        """
+        record = next(self.braintree_client.search_transaction_records(self.query))
+        columns = TransactionColumns()
+        columns.extend([replace(record, amount=Decimal(2**62).scaleb(-2), currency_iso_code='USD')] * 2)
+        by = ('currency_iso_code', 'status')
+        self.assertEqual(columns.totals(by=by), {('USD', record.status): (Decimal(2**63).scaleb(-2), 2)})
+
+    def test_minor_units(self):
+        """
+        Given amounts in currencies with 2, 0 and 3 decimals
+        When they are converted to minor units and back
+        Then they round trip, and amounts more precise than their currency are rejected
+        """
+        conversions = ((Decimal('10.50'), 'USD', 1050), (Decimal('1000'), 'JPY', 1000), (Decimal('1.234'), 'bhd', 1234))
+        for amount, currency, units in conversions:
+            with self.subTest(currency=currency):
+                self.assertEqual(to_minor_units(amount, currency), units)
+                self.assertEqual(from_minor_units(units, currency), amount)
+        with self.assertRaises(ValueError):
+            to_minor_units(Decimal('10.505'), 'USD')
+
+
+class MoneyBatchTest(SimpleTestCase):
+    def setUp(self):
+        super().setUp()
+        self.moneys = [Money('10.50', 'USD'), Money('1000', 'JPY'), Money('20', 'USD'), Money('1.234', 'BHD')]
+        self.batch = MoneyBatch.from_money(self.moneys)
+
+    def test_round_trip(self):
+        """
+        Given Money amounts in currencies with 2, 0 and 3 decimals
+        When they are batched and converted back
+        Then the same amounts come out, and amounts more precise than their currency are rejected
+        """
+        self.assertEqual(list(self.batch.units), [1050, 1000, 2000, 1234])
+        self.assertEqual(self.batch.to_money(), self.moneys)
+        self.assertEqual(self.batch[2], Money('20', 'USD'))
+        with self.assertRaises(ValueError):
+            MoneyBatch.from_pairs([(Decimal('10.505'), 'USD')])
+
+    def test_totals_and_sum(self):
+        """
+        Given a batch of amounts in several currencies
+        When they are totalled
+        Then the sums are per currency, and summing them all into one is refused
+        """
+        self.assertEqual(
+            self.batch.totals(), {'USD': Money('30.50', 'USD'), 'JPY': Money('1000', 'JPY'), 'BHD': Money('1.234', 'BHD')}
+        )
+        self.assertEqual(MoneyBatch.from_money(self.moneys[::2]).sum(), Money('30.50', 'USD'))
+        with self.assertRaises(ValueError):
+            self.batch.sum()
+
+    def test_equality(self):
+        """
+        Given batches built from the same amounts as pairs or in another order
+        When they are compared
+        Then only the same amounts in the same order are equal, whatever the order currencies were first met in
+        """
+        pairs = [(money.amount, money.currency) for money in self.moneys]
+        self.assertEqual(MoneyBatch.from_pairs(pairs), self.batch)
+        self.assertNotEqual(MoneyBatch.from_pairs(pairs[::-1]), self.batch)
+        self.assertNotEqual(MoneyBatch.from_pairs(pairs[:-1]), self.batch)
+        self.assertNotEqual(MoneyBatch.from_pairs(pairs[:-1] + [(Decimal('1.234'), 'KWD')]), self.batch)
+        reordered = MoneyBatch(currencies=['BHD', 'JPY', 'USD'])
+        for amount, currency in pairs:
+            reordered.append(amount, currency)
+        self.assertEqual(reordered, self.batch)
+
+    @skipUnless(numpy, 'numpy is not installed')
+    def test_numpy_parity(self):
+        """
+        Given batches of amounts
+        When they are totalled and compared with and without numpy
+        Then both give the same answers
+        """
+        other = MoneyBatch.from_money(self.moneys[:-1] + [Money('1.235', 'BHD')])
+        answers = []
+        for module_numpy in (numpy, None):
+            with self.subTest(numpy=module_numpy is not None):
+                self.addCleanup(setattr, money_batch, 'numpy', money_batch.numpy)
+                money_batch.numpy = module_numpy
+                answers.append((self.batch.totals(), self.batch == MoneyBatch.from_money(self.moneys), self.batch == other))
+        self.assertEqual(answers[0], answers[1])
+        self.assertEqual(answers[0][1:], (True, False))
+
+    def test_totals_overflow(self):
+        """
+        Given amounts whose sum does not fit in int64 minor units
+        When they are totalled
+        Then the total is exact rather than wrapped around
+        """
+        batch = MoneyBatch(array('q', [2**62, 2**62, 1]), array('i', [0, 0, 1]), ['USD', 'JPY'])
+        self.assertEqual(batch.totals(), {'USD': Money(Decimal(2**63).scaleb(-2), 'USD'), 'JPY': Money('1', 'JPY')})